@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+"""
+asyncio (ASGI) front-end for the Local File Vault.
+
+Slow clients only cost a pending coroutine here instead of a pinned worker
+thread: request bodies are read with ``await receive()``, and blocking work
+(staging writes, hashing, SQLite) runs on a bounded executor. /api/upload is
+parsed natively with Werkzeug's sans-IO multipart decoder and /api/events is
+served from the shared event hub by coroutines; every other route,
+including /api/files and downloads, is answered by the Flask app of
+ServerFileuploader, with request bodies fed to it through a bounded queue
+and response bodies pulled chunk by chunk, so a slow client holds no thread
+between chunks. The JSON contract is the Flask one.
+
+Run with ``python AsgiFileuploader.py`` (needs uvicorn) or point any ASGI
+server at ``AsgiFileuploader:app``.
+"""
+import argparse
+import asyncio
+import io
+import json
+import sys
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.datastructures import FileStorage
+from werkzeug.exceptions import ClientDisconnected, RequestEntityTooLarge
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+import ServerFileuploader as vault
+
+try:
+    import uvicorn
+except ImportError:  # optional; any ASGI server can run ``app``
+    uvicorn = None
+
+# --------------------------
+# Config
+# --------------------------
+# Threads for staging writes, Flask routes and SQLite work
+ASYNC_EXECUTOR_THREADS = 16
+# Upload bytes received but not yet written to staging, across all connections;
+# once reached, no connection reads more of its body until writes catch up
+ASYNC_MAX_BUFFERED_BYTES = 64 * 1024 * 1024
+# Concurrent ingest_files() commits; SQLite serializes writers anyway
+ASYNC_MAX_COMMITS = 2
+# Body messages queued ahead of a Flask route that reads the request stream
+ASYNC_BODY_QUEUE = 16
+
+
+class ByteBudget:
+    """Global cap on in-flight upload bytes; acquire() waits while the budget is spent."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._cond = asyncio.Condition()
+
+    async def acquire(self, size: int) -> int:
+        # A single message larger than the whole budget may still pass alone
+        size = min(size, self.limit)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+        return size
+
+    async def release(self, size: int) -> None:
+        async with self._cond:
+            self.used -= size
+            self._cond.notify_all()
+
+
+class BodyStream(io.RawIOBase):
+    """
+    wsgi.input for a Flask route running on the executor: reads are served
+    from a bounded queue that the event loop fills with body messages, so a
+    large body is never held in memory and a slow client holds no thread.
+    """
+
+    def __init__(self, loop, maxsize: int):
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize)
+        self._buffer = b""
+        self._done = False
+
+    async def feed(self, receive, limit: int) -> None:
+        """Pump the request body into the queue; ends it with None or the error to raise."""
+        received, more = 0, True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return await self._queue.put(ClientDisconnected())
+            chunk = message.get("body", b"")
+            more = message.get("more_body", False)
+            received += len(chunk)
+            if received > limit:
+                return await self._queue.put(RequestEntityTooLarge())
+            if chunk:
+                await self._queue.put(chunk)
+        await self._queue.put(None)
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._done:
+            item = asyncio.run_coroutine_threadsafe(self._queue.get(), self._loop).result()
+            if isinstance(item, Exception):
+                self._done = True
+                raise item
+            if item is None:
+                self._done = True
+            else:
+                self._buffer = item
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class AsgiVault:
+    """ASGI application; ``app`` below is the instance servers should load."""
+
+    def __init__(self):
+        self.executor = ThreadPoolExecutor(max_workers=ASYNC_EXECUTOR_THREADS, thread_name_prefix="asgi")
+        self.budget = ByteBudget(ASYNC_MAX_BUFFERED_BYTES)
+        self._commits = None
+        self._events = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            if scope["method"] == "POST" and scope["path"] == "/api/upload":
+                await self._upload(scope, receive, send)
+            elif scope["method"] == "GET" and scope["path"] == "/api/events":
+                await self._event_stream(scope, receive, send)
+            else:
+                await self._wsgi(scope, receive, send)
+
+    def _run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    vault.check_storage_backend()
+                except RuntimeError as exc:
+                    await send({"type": "lifespan.startup.failed", "message": str(exc)})
+                    return
+                await self._run(vault.init_db)
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _json(self, send, status: int, body: dict):
+        payload = json.dumps(body, sort_keys=True, separators=(",", ":")).encode() + b"\n"
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(payload)).encode())],
+        })
+        await send({"type": "http.response.body", "body": payload})
+
+    # --------------------------
+    # /api/upload
+    # --------------------------
+    async def _upload(self, scope, receive, send):
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        mimetype, options = parse_options_header(headers.get("content-type", ""))
+        if mimetype != "multipart/form-data" or "boundary" not in options:
+            return await self._json(send, 400, {"error": "No file part in the request."})
+        if int(headers.get("content-length") or 0) > vault.app.config["MAX_CONTENT_LENGTH"]:
+            return await self._json(send, 413, {"error": "Request too large."})
+        if vault.STORAGE_QUOTA_BYTES is not None and headers.get("content-length"):
+            headroom = await self._run(self._headroom)
+            if int(headers["content-length"]) > headroom:
+                return await self._json(send, 507, {
+                    "error": "Storage quota exceeded.", "quota_bytes": vault.STORAGE_QUOTA_BYTES, "free_bytes": max(0, headroom),
+                })
+
+        # Counts as traffic for the idle-time maintenance like a Flask request
+        vault._request_started()
+        vault.UPLOADS_IN_FLIGHT.inc()
+        files = []
+        try:
+            error = await self._receive_files(receive, options["boundary"].encode("latin-1"), files)
+            if error is None and not files:
+                error = (400, {"error": "No file part in the request."})
+            if error is not None:
+                if error[0]:
+                    await self._json(send, *error)
+                return
+            if self._commits is None:
+                self._commits = asyncio.Semaphore(ASYNC_MAX_COMMITS)
+            async with self._commits:
+                report = await self._run(self._ingest, files)
+        finally:
+            for f in files:
+                await self._run(f.stream.close)
+            vault._request_finished(None)
+            vault.UPLOADS_IN_FLIGHT.inc(-1)
+        await self._json(send, 200, vault.upload_summary(report))
+
+    async def _receive_files(self, receive, boundary: bytes, files: list):
+        """
+        Stream the body into one IngestSink per "files" part. Returns None, or
+        (status, body) for an error response; status 0 means the client left.
+        """
+        limit = vault.app.config["MAX_CONTENT_LENGTH"]
+        decoder = MultipartDecoder(boundary)
+        current = None
+        received = 0
+        more = True
+        while more:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return 0, None
+            chunk = message.get("body", b"")
+            more = message.get("more_body", False)
+            received += len(chunk)
+            if received > limit:
+                return 413, {"error": "Request too large."}
+            try:
+                if chunk:
+                    decoder.receive_data(chunk)
+                if not more:
+                    decoder.receive_data(None)
+                event = decoder.next_event()
+            except ValueError:
+                return 400, {"error": "Malformed multipart body."}
+            # Only this message is in flight for the connection: the next
+            # receive() waits until it has reached the staging files
+            while not isinstance(event, (NeedData, Epilogue)):
+                if isinstance(event, File):
+                    current = None
+                    if event.name == "files":
+                        sink = await self._run(vault.IngestSink, event.filename, event.headers.get("content-type"))
+                        current = FileStorage(sink, event.filename, event.name, headers=event.headers)
+                        files.append(current)
+                elif isinstance(event, Field):
+                    current = None
+                elif isinstance(event, Data) and current is not None and event.data:
+                    if current.stream.rejection is not None:
+                        # Refused by name or signature: dropped without an executor hop
+                        current.stream.write(event.data)
+                    else:
+                        granted = await self.budget.acquire(len(event.data))
+                        try:
+                            await self._run(current.stream.write, event.data)
+                        finally:
+                            await self.budget.release(granted)
+                try:
+                    event = decoder.next_event()
+                except ValueError:
+                    return 400, {"error": "Malformed multipart body."}
+        return None
+
+    @staticmethod
+    def _ingest(files):
+        try:
+            return vault.ingest_files(files)
+        finally:
+            vault._pool.release_thread()
+
+    @staticmethod
+    def _headroom():
+        try:
+            return vault.quota_headroom()
+        finally:
+            vault._pool.release_thread()
+
+    # --------------------------
+    # /api/events
+    # --------------------------
+    async def _event_stream(self, scope, receive, send):
+        headers = {k.decode("latin-1").lower(): v.decode("latin-1") for k, v in scope["headers"]}
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        value = headers.get("last-event-id") or query.get("since", [""])[0]
+        since = int(value) if value.isdigit() else None
+
+        hub = await self._run(vault.event_hub)
+        if self._events is None:
+            # One condition for all subscribers, notified from the hub thread
+            loop = asyncio.get_running_loop()
+            self._events = asyncio.Condition()
+            hub.add_listener(lambda: loop.call_soon_threadsafe(asyncio.ensure_future, self._notify_events()))
+        closed = asyncio.Event()
+
+        async def watch():
+            while (await receive())["type"] != "http.disconnect":
+                pass
+            closed.set()
+            await self._notify_events()
+
+        watcher = asyncio.create_task(watch())
+        hub.hold()
+        try:
+            frames, cursor = await self._run(hub.frames_since, since)
+            await send({
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in vault.EVENT_STREAM_HEADERS.items()],
+            })
+            await send({"type": "http.response.body", "body": f"retry: {vault.EVENTS_RETRY_MS}\n\n".encode(), "more_body": True})
+            while True:
+                if frames:
+                    await send({"type": "http.response.body", "body": b"".join(frames), "more_body": True})
+                if closed.is_set():
+                    break
+                try:
+                    async with self._events:
+                        await asyncio.wait_for(
+                            self._events.wait_for(lambda: hub.last_seq > cursor or closed.is_set()), vault.EVENTS_HEARTBEAT
+                        )
+                except asyncio.TimeoutError:
+                    frames = [b": heartbeat\n\n"]
+                    continue
+                # Nearly always answered from the hub's buffer, but may fall back to SQLite
+                frames, cursor = await self._run(hub.frames_since, cursor)
+        finally:
+            hub.release()
+            watcher.cancel()
+
+    async def _notify_events(self):
+        async with self._events:
+            self._events.notify_all()
+
+    # --------------------------
+    # Everything else: the Flask app
+    # --------------------------
+    async def _wsgi(self, scope, receive, send):
+        limit = vault.app.config["MAX_CONTENT_LENGTH"]
+        length = next((v for k, v in scope["headers"] if k.lower() == b"content-length"), b"")
+        if length.isdigit() and int(length) > limit:
+            return await self._json(send, 413, {"error": "Request too large."})
+        body = BodyStream(asyncio.get_running_loop(), ASYNC_BODY_QUEUE)
+        # Runs alongside the route, which reads the body as it arrives
+        feeder = asyncio.create_task(body.feed(receive, limit))
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response["status"] = int(status.split(" ", 1)[0])
+            response["headers"] = [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers]
+
+        def pull(chunks):
+            for chunk in chunks:
+                if chunk:
+                    return chunk
+            return None
+
+        # Flask's teardown (which returns the pooled connection) runs inside this call
+        try:
+            result = await self._run(vault.app, _environ(scope, io.BufferedReader(body)), start_response)
+        except BaseException:
+            feeder.cancel()
+            raise
+        chunks = iter(result)
+        try:
+            first = await self._run(pull, chunks)
+            await send({"type": "http.response.start", "status": response["status"], "headers": response["headers"]})
+            chunk = first
+            while chunk is not None:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                chunk = await self._run(pull, chunks)
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            feeder.cancel()
+            if hasattr(result, "close"):
+                await self._run(result.close)
+
+
+def _environ(scope, body) -> dict:
+    """WSGI environ for an ASGI http scope."""
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        "PATH_INFO": scope["path"].encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope.get('http_version', '1.1')}",
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        # The body ends where the ASGI messages do, chunked or not; Werkzeug
+        # then applies MAX_CONTENT_LENGTH to the stream itself
+        "wsgi.input_terminated": True,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+    }
+    for key, value in scope["headers"]:
+        name = key.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+        elif f"HTTP_{name}" in environ:
+            environ[f"HTTP_{name}"] += "," + value
+        else:
+            environ[f"HTTP_{name}"] = value
+    return environ
+
+
+app = AsgiVault()
+
+
+def serve(host: str = "0.0.0.0", port: int = 5000) -> None:
+    if uvicorn is None:
+        raise RuntimeError("The ASGI front-end needs an ASGI server such as uvicorn.")
+    vault.init_db()
+    vault._start_background_tasks()
+    uvicorn.run(app, host=host, port=port, timeout_keep_alive=vault.KEEPALIVE_TIMEOUT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=f"{vault.APP_NAME} (ASGI)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    args = parser.parse_args(argv)
+    if uvicorn is None:
+        parser.error("uvicorn is not installed")
+    serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import collections
 import os
 import sys
 
@@ -182,8 +183,11 @@ DB_NAME = "file_manager.db"
 SERVER_BASE = "http://127.0.0.1:5000"
 UPLOAD_ENDPOINT = f"{SERVER_BASE}/api/upload"
 FILES_ENDPOINT = f"{SERVER_BASE}/api/files"
+CHANGES_ENDPOINT = f"{SERVER_BASE}/api/files/changes"
 DOWNLOAD_ENDPOINT_TEMPLATE = f"{SERVER_BASE}/files/{{id}}/download"
 DELETE_ENDPOINT_TEMPLATE = f"{SERVER_BASE}/files/{{id}}/delete"
+# Listing pages kept for If-None-Match revalidation, least recently used dropped first
+LISTING_CACHE_ENTRIES = 32
 
 class _CallableEvent(QEvent):
     def __init__(self, fn):
@@ -432,6 +436,11 @@ class MainWindow(QMainWindow):
         self.current_db_path = DB_NAME
         self.settings_window = None
         self.server_timeout = 30
+        # /api/files pages by query, with the ETag they were served with
+        self._listing_cache = collections.OrderedDict()
+        # Local copy of the catalogue, kept current from /api/files/changes
+        self._mirror = {}
+        self._change_seq = None
 
         # Menu bar
         self._create_menu()
@@ -740,15 +749,68 @@ class MainWindow(QMainWindow):
         Thread(target=self.upload_to_server, args=(valid,), daemon=True).start()
 
     def load_files(self):
-        self.file_widget.clear_list()
         try:
-            resp = requests.get(FILES_ENDPOINT, timeout=self.server_timeout)
-            resp.raise_for_status()
-            data = resp.json()
-            for f in data.get("files", []):
-                self.file_widget.add_file_item(f["id"], f["original_filename"], f.get("content_type") or "application/octet-stream")
+            if self._change_seq is None or not self._sync_changes():
+                self._reload_mirror()
         except requests.RequestException as exc:
+            self.file_widget.clear_list()
             QMessageBox.warning(self, "Server Error", f"Could not fetch file list from server.\n{exc}")
+            return
+        self.file_widget.clear_list()
+        for f in sorted(self._mirror.values(), key=lambda f: f["id"], reverse=True):
+            self.file_widget.add_file_item(f["id"], f["original_filename"], f.get("content_type") or "application/octet-stream")
+
+    def _reload_mirror(self):
+        """Fetch the whole catalogue; the listing is paginated, so follow the keyset cursor."""
+        mirror = {}
+        change_seq = None
+        params = {"fields": "id,original_filename,content_type"}
+        while True:
+            data = self._get_listing(params)
+            if change_seq is None:
+                change_seq = data.get("change_seq")
+            for f in data.get("files", []):
+                mirror[f["id"]] = f
+            if not data.get("next_after_id"):
+                break
+            params["after_id"] = data["next_after_id"]
+        self._mirror = mirror
+        self._change_seq = change_seq
+
+    def _sync_changes(self):
+        """Apply the server's change feed to the mirror; False if it asks for a full reload."""
+        while True:
+            resp = requests.get(CHANGES_ENDPOINT, params={"since": self._change_seq}, timeout=self.server_timeout)
+            resp.raise_for_status()
+            data = resp.json()
+            if data.get("resync"):
+                return False
+            for change in data.get("changes", []):
+                if change["op"] == "add":
+                    self._mirror[change["id"]] = change["file"]
+                else:
+                    self._mirror.pop(change["id"], None)
+            self._change_seq = data["next_since"]
+            if not data.get("has_more"):
+                return True
+
+    def _get_listing(self, params, cache=True):
+        """GET a /api/files page, revalidating a cached copy with If-None-Match."""
+        key = tuple(sorted(params.items()))
+        cached = self._listing_cache.get(key) if cache else None
+        headers = {"If-None-Match": cached[0]} if cached else {}
+        resp = requests.get(FILES_ENDPOINT, params=params, headers=headers, timeout=self.server_timeout)
+        if resp.status_code == 304 and cached:
+            self._listing_cache.move_to_end(key)
+            return cached[1]
+        resp.raise_for_status()
+        data = resp.json()
+        if cache and resp.headers.get("ETag"):
+            self._listing_cache[key] = (resp.headers["ETag"], data)
+            self._listing_cache.move_to_end(key)
+            while len(self._listing_cache) > LISTING_CACHE_ENTRIES:
+                self._listing_cache.popitem(last=False)
+        return data
 
     def delete_selected_file(self):
         file_id = self.file_widget.selected_file_id()
@@ -780,9 +842,12 @@ class MainWindow(QMainWindow):
         # Ask server for file name for default save name
         default_name = "downloaded_file"
         try:
-            resp_list = requests.get(FILES_ENDPOINT, timeout=self.server_timeout)
-            resp_list.raise_for_status()
-            files = {f["id"]: f for f in resp_list.json().get("files", [])}
+            # Newest row with id < file_id + 1 is the file itself; one-off
+            # lookups are not worth a cache entry per file
+            listing = self._get_listing(
+                {"after_id": file_id + 1, "limit": 1, "fields": "id,original_filename"}, cache=False
+            )
+            files = {f["id"]: f for f in listing.get("files", [])}
             info = files.get(file_id)
             if info and info.get("original_filename"):
                 default_name = info["original_filename"]
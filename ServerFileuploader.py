@@ -1,17 +1,70 @@
 #!/usr/bin/env python3
+import argparse
+import base64
+import bisect
+import collections
 import hashlib
+import io
+import itertools
+import json
+import lzma
+import math
+import mimetypes
+import multiprocessing
 import os
+import re
+import secrets
+import selectors
+import signal
+import socket
 import sqlite3
+import tempfile
+import threading
+import time
+import traceback
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
 from typing import Iterable
 
 from flask import (
-    Flask, request, redirect, url_for, render_template_string,
-    send_file, abort, flash, jsonify
+    Flask, Request, Response, request, redirect, url_for, stream_template,
+    abort, flash, get_flashed_messages, jsonify
 )
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
 from werkzeug.utils import secure_filename
-from io import BytesIO
+from werkzeug.wsgi import ClosingIterator, LimitedStream, wrap_file
+from urllib.parse import quote
+
+try:
+    import zstandard
+except ImportError:  # optional; the "zstd" codec is only offered when installed
+    zstandard = None
+
+try:
+    from fastcdc.fastcdc_cy import fastcdc_cy
+except ImportError:  # optional; cdc_split() finds the same boundaries in pure Python, only slower
+    fastcdc_cy = None
+
+try:
+    import waitress
+except ImportError:  # optional; "auto" mode prefers it when installed
+    waitress = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # optional; thumbnails fall back to Qt's QImage
+    Image = None
+
+QImage = None
+if Image is None:
+    try:
+        from PySide6.QtCore import QBuffer, QIODevice, Qt
+        from PySide6.QtGui import QImage
+    except ImportError:  # without either, /files/<id>/thumbnail answers 501
+        pass
 
 # --------------------------
 # Config
@@ -30,51 +83,2789 @@ ALLOWED_EXTENSIONS: Iterable[str] = {
     "zip", "rar", "7z", "tar", "gz", "bz2", "xz", "tar.gz", "tar.bz2", "tar.xz"
 }
 
+# Magic numbers per extension: a part must match one alternative, i.e. all of
+# its (offset, bytes) pairs; offset None means anywhere in the first
+# SNIFF_BYTES. Extensions without an entry (txt, md) are not checked.
+_ZIP = ((0, b"PK\x03\x04"),), ((0, b"PK\x05\x06"),), ((0, b"PK\x07\x08"),)
+_OLE = ((0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"),)
+_GZIP = (((0, b"\x1f\x8b"),),)
+_BZIP2 = (((0, b"BZh"),),)
+_XZ = (((0, b"\xfd7zXZ\x00"),),)
+UPLOAD_SIGNATURES = {
+    "jpg": (((0, b"\xff\xd8\xff"),),),
+    "jpeg": (((0, b"\xff\xd8\xff"),),),
+    "png": (((0, b"\x89PNG\r\n\x1a\n"),),),
+    "gif": (((0, b"GIF87a"),), ((0, b"GIF89a"),)),
+    "bmp": (((0, b"BM"),),),
+    "webp": (((0, b"RIFF"), (8, b"WEBP")),),
+    "tiff": (((0, b"II*\x00"),), ((0, b"MM\x00*"),)),
+    # Readers accept the header anywhere in the first KiB
+    "pdf": (((None, b"%PDF-"),),),
+    "rtf": (((0, b"{\\rtf"),),),
+    # Office opens either container whatever the extension says
+    "doc": (_OLE,) + _ZIP,
+    "xls": (_OLE,) + _ZIP,
+    "ppt": (_OLE,) + _ZIP,
+    "docx": _ZIP,
+    "xlsx": _ZIP,
+    "pptx": _ZIP,
+    "zip": _ZIP,
+    "rar": (((0, b"Rar!\x1a\x07"),),),
+    "7z": (((0, b"7z\xbc\xaf\x27\x1c"),),),
+    "tar": (((257, b"ustar"),),),
+    "gz": _GZIP,
+    "tar.gz": _GZIP,
+    "bz2": _BZIP2,
+    "tar.bz2": _BZIP2,
+    "xz": _XZ,
+    "tar.xz": _XZ,
+}
+
+# Uploads are hashed and written in pieces of this size while they arrive
+INGEST_CHUNK_SIZE = 64 * 1024
+# Leading bytes of each part held back and checked against UPLOAD_SIGNATURES
+# before anything is staged; a part that fails is dropped as it streams in
+SNIFF_BYTES = 4096
+UPLOAD_SIGNATURE_CHECK = os.environ.get("FILEUPLOADER_SIGNATURE_CHECK", "1") != "0"
+# Parts are streamed here by the multipart parser instead of into memory;
+# keep it on the same filesystem as BLOB_ROOT so finished parts can be renamed
+STAGING_DIR = Path("upload_staging")
+# ingest-*/encoded-* staging files untouched for this long belong to no
+# request any more (e.g. a worker killed mid-upload); maintenance deletes them
+STAGING_STALE_SECONDS = 60 * 60
+# Parts are hashed on this many pool threads while the body is still being
+# parsed (hashlib drops the GIL); the parser blocks once a part has this many
+# chunks waiting to be hashed
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+HASH_LANE_MAX_PENDING = 64
+
+# Content-addressed payload tree (see FilesystemBlobStore)
+BLOB_ROOT = Path("blobs")
+# Backend for payloads larger than INLINE_MAX_BYTES: "fs", "inline" or "cdc"
+STORAGE_BACKEND = os.environ.get("FILEUPLOADER_STORAGE", "fs")
+# Payloads up to this size stay inline in SQLite regardless of the backend
+INLINE_MAX_BYTES = 64 * 1024
+# Inline payloads are stored as rows of this many bytes in blob_chunks
+PAYLOAD_CHUNK_SIZE = 64 * 1024
+# The "cdc" backend splits payloads at content-defined (FastCDC) boundaries,
+# CDC_MIN_SIZE..CDC_MAX_SIZE apart and CDC_AVG_SIZE on average, and stores
+# each distinct chunk once, so successive versions of a large file share
+# what did not change. Such payloads are never compressed (a compressed
+# stream has no chunks in common with the next version). With the fastcdc
+# package installed the same boundaries are found many times faster; see
+# benchmarks/bench_chunker.py. Without it the server refuses to start with
+# "cdc": the pure-Python chunker manages a few MB/s per core under the GIL
+# and would make every ingest CPU-bound. FILEUPLOADER_CDC_PURE_PYTHON=1
+# accepts that (small deployments, tests) and only warns.
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVG_SIZE = 64 * 1024
+CDC_MAX_SIZE = 256 * 1024
+CDC_PURE_PYTHON = os.environ.get("FILEUPLOADER_CDC_PURE_PYTHON") == "1"
+# Compression at rest, chosen per content type at ingest. Types not listed
+# (zip/7z/jpg/png/docx/...) are already compressed and stored as received.
+# "gzip"/"deflate"/"zstd" payloads are sent as-is with Content-Encoding to
+# clients that accept them; "xz" trades CPU for size and is always decoded.
+COMPRESSION_POLICY = {
+    "text/*": "gzip",
+    "application/rtf": "gzip",
+    "application/msword": "gzip",
+    "application/vnd.ms-excel": "gzip",
+    "application/vnd.ms-powerpoint": "gzip",
+    "image/bmp": "gzip",
+    "image/tiff": "gzip",
+}
+# Replaces the codec of every compressible type: gzip, deflate, xz, zstd or none
+COMPRESSION_OVERRIDE = os.environ.get("FILEUPLOADER_COMPRESSION")
+# Smaller payloads, or ones that shrink by less than this fraction, stay raw
+COMPRESSION_MIN_BYTES = 512
+COMPRESSION_MIN_SAVINGS = 0.1
+# Storage migration commits after this many payloads or bytes, whichever comes first
+MIGRATION_BATCH_ROWS = 200
+MIGRATION_BATCH_BYTES = 32 * 1024 * 1024
+# Entries per /api/files/archive download
+ARCHIVE_MAX_FILES = 10000
+# Range requests with more ranges than this are answered with the full body
+MAX_BYTE_RANGES = 32
+
+# /api/files paging; id is always returned because it is the cursor
+FILE_LIST_FIELDS = ("id", "original_filename", "content_type", "size_bytes", "sha256", "uploaded_at")
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+# Rows per page of the HTML index
+INDEX_PAGE_SIZE = 100
+# Serialized /api/files pages kept per process for the current catalogue generation
+LIST_CACHE_ENTRIES = 256
+# /api/files/changes: entries per response, and how many the log keeps before
+# the maintenance thread drops the oldest (cursors behind them must resync)
+CHANGES_PAGE_SIZE = 1000
+CHANGE_LOG_RETENTION = 100_000
+# /api/events (Server-Sent Events): one poller per process reads the change log
+# every EVENTS_POLL_INTERVAL while anyone listens and fans the events out; the
+# newest EVENTS_BUFFER stay in memory for Last-Event-ID resumes. Subscribers
+# more than EVENTS_MAX_BACKLOG bytes behind are disconnected.
+EVENTS_POLL_INTERVAL = 0.5
+EVENTS_HEARTBEAT = 15
+EVENTS_BUFFER = 1024
+EVENTS_MAX_BACKLOG = 1024 * 1024
+EVENTS_RETRY_MS = 3000
+# Waitress and the dev server cannot hand a socket to the hub, so each of
+# their subscribers holds a thread. Waitress gives at most EVENTS_THREAD_SHARE
+# of its threads to streams, the dev server (a thread per connection) at most
+# EVENTS_DEV_STREAMS; past that /api/events answers 503. Hundreds of idle
+# subscribers need the prefork server or the ASGI front-end.
+EVENTS_THREAD_SHARE = 0.5
+EVENTS_DEV_STREAMS = 32
+SEARCH_SORTS = {"id", "original_filename", "size_bytes", "uploaded_at"}
+
+# SQLite connection pool and per-connection tuning
+DB_POOL_SIZE = 8
+DB_BUSY_TIMEOUT_MS = 5000
+DB_STATEMENT_CACHE = 256
+DB_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": -16000,           # KiB, i.e. ~16 MB page cache per connection
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# Space reclamation: the database runs with auto_vacuum=INCREMENTAL and a
+# maintenance thread hands free pages back in steps of VACUUM_STEP_PAGES once
+# no request has been seen for MAINTENANCE_IDLE_SECONDS
+VACUUM_STEP_PAGES = 256
+MAINTENANCE_INTERVAL = 30
+MAINTENANCE_IDLE_SECONDS = 5
+
+# Serving: "dev" is Flask's development server; "prefork" forks SERVER_WORKERS
+# processes that each answer on SERVER_THREADS threads; "waitress" runs the
+# waitress WSGI server; "auto" picks waitress if installed, else prefork
+SERVER_MODE = os.environ.get("FILEUPLOADER_SERVER_MODE", "dev")
+SERVER_WORKERS = int(os.environ.get("FILEUPLOADER_WORKERS", min(4, os.cpu_count() or 1)))
+SERVER_THREADS = int(os.environ.get("FILEUPLOADER_THREADS", 8))
+# Idle keep-alive connections are closed after this many seconds
+KEEPALIVE_TIMEOUT = 5
+# On SIGTERM in-flight requests get this long to finish before workers are killed
+SHUTDOWN_GRACE = 30
+
+# Resumable upload sessions: each chunk is its own request, so only the chunk
+# size is bound by MAX_CONTENT_LENGTH
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+MAX_SESSION_BYTES = 64 * 1024 * 1024 * 1024
+# Smallest chunk a session may use (unless the file is smaller) and the most
+# chunks it may have; the session state lists chunks as index ranges
+UPLOAD_MIN_CHUNK_SIZE = 64 * 1024
+MAX_SESSION_CHUNKS = 65536
+# Sessions without activity for this long are garbage-collected
+UPLOAD_SESSION_TTL = 24 * 60 * 60
+
+# Quotas on stored bytes as uploaded (before deduplication and compression),
+# checked before an upload is accepted; None means unlimited. Type quotas are
+# keyed by exact type or "major/*" like COMPRESSION_POLICY, e.g.
+# {"video/*": 20 * 1024**3}. Open upload sessions count with their full size.
+STORAGE_QUOTA_BYTES = int(os.environ["FILEUPLOADER_QUOTA_BYTES"]) if os.environ.get("FILEUPLOADER_QUOTA_BYTES") else None
+TYPE_QUOTA_BYTES = {}
+
+# Image thumbnails, cached per (sha256, size) in the thumbnails table. The
+# sizes in THUMBNAIL_SIZES are rendered in the background right after upload,
+# any other size in range on first request.
+THUMBNAIL_TYPES = {"image/jpeg", "image/png", "image/gif", "image/bmp", "image/webp", "image/tiff"}
+THUMBNAIL_SIZES = (128, 256)
+THUMBNAIL_MIN_SIZE = 16
+THUMBNAIL_MAX_SIZE = 1024
+THUMBNAIL_WORKERS = min(2, os.cpu_count() or 1)
+# Larger sources are not decoded; a request waits this long for a render
+THUMBNAIL_MAX_SOURCE_BYTES = 64 * 1024 * 1024
+THUMBNAIL_WAIT_SECONDS = 30
+THUMBNAIL_JPEG_QUALITY = 85
+# A file id never changes content, so thumbnails may be cached for a year
+THUMBNAIL_MAX_AGE = 365 * 24 * 60 * 60
+
+# --------------------------
+# Streaming ingest
+# --------------------------
+_hash_pool = None
+_hash_pool_pid = None
+_hash_pool_lock = threading.Lock()
+
+def hash_pool() -> ThreadPoolExecutor:
+    """Shared hashing pool, created lazily and again in every forked worker."""
+    global _hash_pool, _hash_pool_pid
+    with _hash_pool_lock:
+        if _hash_pool is None or _hash_pool_pid != os.getpid():
+            _hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="ingest-hash")
+            _hash_pool_pid = os.getpid()
+        return _hash_pool
+
+
+class _HashLane:
+    """
+    sha256 of one part, fed off the request thread. Chunks are queued in order
+    and drained by at most one pool task at a time, so different parts hash in
+    parallel while each digest still sees its bytes in sequence.
+    """
+
+    def __init__(self):
+        self._hash = hashlib.sha256()
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._draining = False
+        self._error = None
+
+    def update(self, chunk: bytes) -> None:
+        with self._cond:
+            while len(self._pending) >= HASH_LANE_MAX_PENDING and self._error is None:
+                self._cond.wait()
+            self._pending.append(chunk)
+            if self._draining:
+                return
+            self._draining = True
+        hash_pool().submit(self._drain)
+
+    def _drain(self) -> None:
+        while True:
+            with self._cond:
+                if not self._pending or self._error is not None:
+                    self._draining = False
+                    self._cond.notify_all()
+                    return
+                chunk = self._pending.popleft()
+                self._cond.notify_all()
+            try:
+                self._hash.update(chunk)
+            except BaseException as exc:
+                with self._cond:
+                    self._error = exc
+
+    def hexdigest(self) -> str:
+        with self._cond:
+            while self._draining:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+        return self._hash.hexdigest()
+
+
+class IngestSink:
+    """
+    Write-only container handed to Werkzeug's multipart parser for each file part.
+    Every chunk is written to a staging file as soon as it is parsed and hashed
+    on the hash pool, so a part is never held in memory as a whole and the next
+    part can be received while this one is still being hashed.
+    """
+
+    def __init__(self, filename: str = None, content_type: str = None):
+        self.filename = filename
+        self.content_type = content_type
+        self.size = 0
+        self.sha256 = None
+        # Why the part is refused, decided from its name here or from its
+        # first SNIFF_BYTES in write(); a refused part is never staged
+        self.rejection = name_rejection(filename) if filename is not None else None
+        self.path = None
+        self._fh = None
+        self._head = b""
+        self._hash = _HashLane()
+        self._reader = None
+        self.encoding = "identity"
+        self.stored_size = None
+        self._encoded_path = None
+        # (offset, length, sha256) per chunk, see split_payload()
+        self.manifest = None
+
+    @classmethod
+    def from_staged(cls, path: Path, filename: str = None, content_type: str = None) -> "IngestSink":
+        """Adopt a file that is already in the staging dir, hashing it in one pass."""
+        sink = cls.__new__(cls)
+        sink.filename = filename
+        sink.content_type = content_type
+        sink.size = 0
+        sink.rejection = None
+        sink.path = Path(path)
+        # Opened for writing only so the fsync below is allowed on Windows
+        sink._fh = open(sink.path, "r+b")
+        sink._head = None
+        sink._hash = hashlib.sha256()
+        sink._reader = None
+        sink.encoding = "identity"
+        sink.stored_size = None
+        sink._encoded_path = None
+        sink.manifest = None
+        with sink._fh:
+            while True:
+                chunk = sink._fh.read(INGEST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                sink._hash.update(chunk)
+                sink.size += len(chunk)
+            os.fsync(sink._fh.fileno())
+        sink.sha256 = sink._hash.hexdigest()
+        sink.stored_size = sink.size
+        return sink
+
+    def write(self, chunk: bytes) -> int:
+        self.size += len(chunk)
+        if self.rejection is not None:
+            return len(chunk)
+        if self._head is not None:
+            self._head += chunk
+            if len(self._head) >= SNIFF_BYTES:
+                self._validate()
+            return len(chunk)
+        self._stage(chunk)
+        return len(chunk)
+
+    def _validate(self) -> None:
+        head, self._head = self._head, None
+        self.rejection = content_rejection(self.filename, head)
+        if self.rejection is None and head:
+            self._stage(head)
+
+    def _stage(self, chunk: bytes) -> None:
+        if self._fh is None:
+            STAGING_DIR.mkdir(parents=True, exist_ok=True)
+            fd, path = tempfile.mkstemp(prefix="ingest-", dir=STAGING_DIR)
+            self.path = Path(path)
+            self._fh = os.fdopen(fd, "wb")
+        self._hash.update(chunk)
+        self._fh.write(chunk)
+
+    def finish(self) -> None:
+        if self._head is not None:
+            self._validate()  # the part was shorter than SNIFF_BYTES
+        if self._fh is not None and not self._fh.closed:
+            # Durable before any store renames or copies it into place
+            self._fh.flush()
+            os.fsync(self._fh.fileno())
+            self._fh.close()
+        if self.sha256 is None and self.rejection is None:
+            self.sha256 = self._hash.hexdigest()
+            if self.stored_size is None:
+                self.stored_size = self.size
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        # Werkzeug rewinds the container once the part is complete
+        self.finish()
+        if self._reader is not None:
+            return self._reader.seek(offset, whence)
+        return 0
+
+    def read(self, size: int = -1) -> bytes:
+        """Fallback for code that still wants the bytes; reads the staged file."""
+        self.finish()
+        if self.path is None:
+            return b""
+        if self._reader is None:
+            self._reader = open(self.path, "rb")
+        return self._reader.read(size)
+
+    def chunks(self):
+        self.finish()
+        if self.path is None:
+            return
+        with open(self.path, "rb") as fh:
+            yield from _read_chunks(fh)
+
+    @property
+    def payload_path(self) -> Path:
+        """Staged bytes to store: the encoded copy once compress_sink() kept one."""
+        return self._encoded_path or self.path
+
+    def payload_chunks(self):
+        self.finish()
+        with open(self.payload_path, "rb") as fh:
+            yield from _read_chunks(fh)
+
+    def drop_encoded(self) -> None:
+        """Delete only the encoded copy, e.g. when the staged file belongs to an upload session that goes on."""
+        if self._encoded_path is not None:
+            try:
+                self._encoded_path.unlink()
+            except FileNotFoundError:
+                pass
+            self._encoded_path = None
+            self.encoding = "identity"
+            self.stored_size = self.size
+
+    def close(self) -> None:
+        self.finish()
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        for path in (self.path, self._encoded_path):
+            try:
+                if path is not None:
+                    path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class VaultRequest(Request):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Every sink handed to the parser, including the parts of a body that
+        # was cut off and never reached request.files; close() removes them
+        self._sinks = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        sink = IngestSink(filename, content_type)
+        self._sinks.append(sink)
+        return sink
+
+    def close(self) -> None:
+        super().close()
+        sinks, self._sinks = self._sinks, []
+        for sink in sinks:
+            sink.close()
+
+
+# --------------------------
+# App
+# --------------------------
+app = Flask(__name__)
+app.request_class = VaultRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
+# For flash() messages; in localhost use a simple static key
+app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-not-secure-on-internet")
+
+# --------------------------
+# Metrics
+# --------------------------
+# Plain in-process collectors rendered in the Prometheus text format by
+# /metrics. Recording is a dict lookup and a few additions under a lock, so
+# it is cheap enough for every request and query. Each process (e.g. every
+# prefork worker) keeps its own values.
+METRICS = []
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+DB_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+SIZE_BUCKETS = tuple(1024 * 4 ** i for i in range(12))  # 1 KiB .. 4 GiB
+
+def _label_text(names, values) -> str:
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def inc(self, amount: float = 1, labels=()) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _label_text(self.labels, labels), value
+
+
+class Gauge(Counter):
+    """Settable gauge; with ``collect`` its value is computed at scrape time instead."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels=(), collect=None):
+        super().__init__(name, help, labels)
+        self._collect = collect
+
+    def samples(self):
+        if self._collect is None:
+            yield from super().samples()
+            return
+        try:
+            value = self._collect()
+        except Exception:
+            return
+        yield self.name, "", value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+        METRICS.append(self)
+
+    def observe(self, value: float, labels=()) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {labels: (list(counts), total) for labels, (counts, total) in self._values.items()}
+        names = self.labels + ("le",)
+        for labels, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield f"{self.name}_bucket", _label_text(names, labels + (le,)), cumulative
+            yield f"{self.name}_sum", _label_text(self.labels, labels), total
+            yield f"{self.name}_count", _label_text(self.labels, labels), cumulative
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+def _database_bytes() -> int:
+    wal = Path(f"{DATABASE_PATH}-wal")
+    return DATABASE_PATH.stat().st_size + (wal.stat().st_size if wal.exists() else 0)
+
+HTTP_REQUESTS = Counter("fileuploader_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+HTTP_LATENCY = Histogram(
+    "fileuploader_http_request_duration_seconds", "Time until the response was handed to the server.",
+    LATENCY_BUCKETS, ("route", "method"),
+)
+HTTP_RECEIVED = Counter("fileuploader_http_received_bytes_total", "Request body bytes received.")
+HTTP_SENT = Counter("fileuploader_http_sent_bytes_total", "Response body bytes sent.")
+INGEST_SIZES = Histogram("fileuploader_ingest_file_bytes", "Size of each stored file.", SIZE_BUCKETS)
+DB_QUERY_SECONDS = Histogram("fileuploader_db_query_duration_seconds", "SQLite execute()/executemany() time.", DB_LATENCY_BUCKETS)
+DB_COMMIT_SECONDS = Histogram("fileuploader_db_commit_duration_seconds", "SQLite commit time.", DB_LATENCY_BUCKETS)
+THUMBNAIL_REQUESTS = Counter("fileuploader_thumbnail_requests_total", "Thumbnail requests by cache result.", ("result",))
+UPLOADS_IN_FLIGHT = Gauge("fileuploader_uploads_in_flight", "Upload requests currently being received or stored.")
+Gauge("fileuploader_db_size_bytes", "Size of the database file including its WAL.", collect=_database_bytes)
+Gauge("fileuploader_db_connections_in_use", "Pooled SQLite connections checked out.", collect=lambda: pool_stats()["in_use"])
+
+UPLOAD_ENDPOINTS = {"upload", "api_upload", "api_upload_session_chunk"}
+
+@app.before_request
+def _metrics_start():
+    request.environ["vault.started"] = time.perf_counter()
+    if request.endpoint in UPLOAD_ENDPOINTS:
+        request.environ["vault.uploading"] = True
+        UPLOADS_IN_FLIGHT.inc()
+
+def _count_sent(body):
+    for chunk in body:
+        HTTP_SENT.inc(len(chunk))
+        yield chunk
+
+@app.after_request
+def _metrics_finish(response):
+    started = request.environ.get("vault.started")
+    if started is None:
+        return response
+    route = request.url_rule.rule if request.url_rule else "<unmatched>"
+    HTTP_LATENCY.observe(time.perf_counter() - started, (route, request.method))
+    HTTP_REQUESTS.inc(1, (route, request.method, str(response.status_code)))
+    if request.content_length:
+        HTTP_RECEIVED.inc(request.content_length)
+    if response.content_length is not None:
+        if request.method != "HEAD":
+            HTTP_SENT.inc(response.content_length)
+    elif response.is_streamed:
+        # Only unsized streams (e.g. ZIP archives) are wrapped; sized bodies keep wsgi.file_wrapper
+        body = response.response
+        response.response = ClosingIterator(_count_sent(body), getattr(body, "close", None))
+    return response
+
+@app.teardown_request
+def _metrics_teardown(exc):
+    if request.environ.pop("vault.uploading", False):
+        UPLOADS_IN_FLIGHT.inc(-1)
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+# --------------------------
+# DB helpers
+# --------------------------
+class PooledConnection(sqlite3.Connection):
+    """sqlite3 connection whose close() hands it back to the pool instead; also times queries and commits."""
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started)
+
+    def executemany(self, sql, parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            DB_QUERY_SECONDS.observe(time.perf_counter() - started)
+
+    pending_generation = None
+
+    def commit(self) -> None:
+        started = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            DB_COMMIT_SECONDS.observe(time.perf_counter() - started)
+        if self.pending_generation is not None:
+            publish_generation(self.pending_generation)
+            self.pending_generation = None
+
+    def rollback(self) -> None:
+        super().rollback()
+        self.pending_generation = None
+
+    def close(self) -> None:
+        _pool.release(self)
+
+    def detach(self) -> None:
+        """Keep the connection checked out after the request ends (streamed responses)."""
+        _pool.detach(self)
+
+
+class ConnectionPool:
+    """
+    Reuses tuned SQLite connections across requests. Within a thread, nested
+    get_db() calls share the same connection until the outermost close();
+    released connections go to a bounded LIFO idle list that any thread may
+    take from. The pool resets itself after fork(), so pre-fork workers never
+    touch a connection opened by their parent.
+    """
+
+    def __init__(self, max_idle: int = DB_POOL_SIZE):
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._idle = []
+        self._orphans = []
+        self._pid = os.getpid()
+        self._in_use = 0
+        self._stats = {"opened": 0, "closed": 0, "checkouts": 0, "reused": 0}
+
+    def _open(self, path) -> PooledConnection:
+        conn = sqlite3.connect(
+            path,
+            factory=PooledConnection,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.db_path = path
+        conn.execute(f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}")
+        # Must precede the switch to WAL to take effect on a new database;
+        # existing ones pick it up at their next VACUUM (see compact_database)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("PRAGMA journal_mode = WAL")
+        for name, value in DB_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        with self._lock:
+            self._stats["opened"] += 1
+        return conn
+
+    def _check_fork(self) -> None:
+        if os.getpid() != self._pid:
+            # Never close a connection inherited from the parent; just forget it
+            self._orphans.extend(self._idle)
+            self._idle = []
+            self._local = threading.local()
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+            self._in_use = 0
+
+    def acquire(self) -> PooledConnection:
+        self._check_fork()
+        local = self._local
+        path = DATABASE_PATH
+        conn = getattr(local, "conn", None)
+        if conn is not None and conn.db_path == path:
+            local.depth += 1
+            return conn
+        stale = []
+        with self._lock:
+            self._stats["checkouts"] += 1
+            conn = None
+            while self._idle and conn is None:
+                candidate = self._idle.pop()
+                if candidate.db_path == path:
+                    conn = candidate
+                else:
+                    stale.append(candidate)
+            if conn is not None:
+                self._stats["reused"] += 1
+            self._in_use += 1
+        for candidate in stale:
+            self._really_close(candidate)
+        if conn is None:
+            conn = self._open(path)
+        local.conn = conn
+        local.depth = 1
+        return conn
+
+    def release(self, conn: PooledConnection) -> None:
+        local = self._local
+        if getattr(local, "conn", None) is conn:
+            local.depth -= 1
+            if local.depth > 0:
+                return
+            local.conn = None
+        self._return(conn)
+
+    def detach(self, conn: PooledConnection) -> None:
+        local = self._local
+        if getattr(local, "conn", None) is conn:
+            local.conn = None
+            local.depth = 0
+
+    def release_thread(self) -> None:
+        """Return whatever the current thread still holds, e.g. after an exception."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            self._local.conn = None
+            self._local.depth = 0
+            self._return(conn)
+
+    def _return(self, conn: PooledConnection) -> None:
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+            if len(self._idle) < self.max_idle and conn.db_path == DATABASE_PATH:
+                self._idle.append(conn)
+                return
+        self._really_close(conn)
+
+    def _really_close(self, conn: PooledConnection) -> None:
+        sqlite3.Connection.close(conn)
+        with self._lock:
+            self._stats["closed"] += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._really_close(conn)
+
+    def stats(self) -> dict:
+        self._check_fork()
+        with self._lock:
+            return dict(self._stats, idle=len(self._idle), in_use=self._in_use, max_idle=self.max_idle, pid=self._pid)
+
+
+_pool = ConnectionPool()
+
+def get_db():
+    return _pool.acquire()
+
+def pool_stats() -> dict:
+    return _pool.stats()
+
+@app.teardown_request
+def _release_db(exc):
+    _pool.release_thread()
+
+FILES_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        original_filename TEXT NOT NULL,
+        stored_filename TEXT NOT NULL,
+        content_type TEXT,
+        size_bytes INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        uploaded_at TEXT NOT NULL
+    )
+"""
+FILES_COLUMNS = "id, original_filename, stored_filename, content_type, size_bytes, sha256, uploaded_at"
+# One row per distinct payload; files rows reference it by sha256
+BLOBS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        sha256 TEXT PRIMARY KEY,
+        size_bytes INTEGER NOT NULL,
+        storage TEXT NOT NULL,
+        refcount INTEGER NOT NULL,
+        encoding TEXT NOT NULL DEFAULT 'identity',
+        stored_bytes INTEGER NOT NULL DEFAULT 0
+    )
+"""
+BLOBS_COLUMNS = "sha256, size_bytes, storage, refcount, encoding, stored_bytes"
+
+def init_db():
+    conn = get_db()
+    conn.execute(FILES_SCHEMA.format(name="files"))
+    conn.execute(BLOBS_SCHEMA.format(name="blobs"))
+    blob_columns = {r["name"] for r in conn.execute("PRAGMA table_info(blobs)")}
+    if "encoding" not in blob_columns:
+        # size_bytes is the logical size, stored_bytes what the store holds
+        conn.execute("ALTER TABLE blobs ADD COLUMN encoding TEXT NOT NULL DEFAULT 'identity'")
+        conn.execute("ALTER TABLE blobs ADD COLUMN stored_bytes INTEGER NOT NULL DEFAULT 0")
+        conn.execute("UPDATE blobs SET stored_bytes = size_bytes")
+    # Inline payloads, split into PAYLOAD_CHUNK_SIZE pieces
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS blob_chunks (
+            sha256 TEXT NOT NULL,
+            seq INTEGER NOT NULL,
+            data BLOB NOT NULL,
+            PRIMARY KEY (sha256, seq)
+        )
+    """)
+    # "cdc" payloads: distinct chunks, and per payload its chunks by offset
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cdc_chunks (
+            hash TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL,
+            data BLOB NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cdc_manifests (
+            sha256 TEXT NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            chunk TEXT NOT NULL,
+            PRIMARY KEY (sha256, offset)
+        )
+    """)
+    _create_file_indexes(conn)
+    # Resumable uploads; the payload itself is a sparse file in STAGING_DIR/sessions
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            id TEXT PRIMARY KEY,
+            original_filename TEXT NOT NULL,
+            content_type TEXT,
+            size_bytes INTEGER NOT NULL,
+            chunk_size INTEGER NOT NULL,
+            expected_sha256 TEXT,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS upload_session_chunks (
+            session_id TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            PRIMARY KEY (session_id, idx)
+        )
+    """)
+    # Small counters kept in step with the files table by every write path
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS catalog_meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO catalog_meta (key, value) SELECT 'file_count', COUNT(*) FROM files")
+    conn.execute("INSERT OR IGNORE INTO catalog_meta (key, value) VALUES ('generation', 0)")
+    # Append-only log of adds and deletes, written with the change itself
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'file_changes'").fetchone():
+        conn.execute("""
+            CREATE TABLE file_changes (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                file_id INTEGER NOT NULL,
+                op TEXT NOT NULL,
+                changed_at REAL NOT NULL
+            )
+        """)
+        if conn.execute("SELECT 1 FROM files LIMIT 1").fetchone():
+            # Files from before the log existed: every cursor has to resync once
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('file_changes', 1)")
+            conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('changes_floor', 1)")
+    # Running totals per content type and per upload day (key "" under
+    # "total"), kept in step by insert_file_rows() and remove_file()
+    if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'storage_stats'").fetchone():
+        conn.execute("""
+            CREATE TABLE storage_stats (
+                dimension TEXT NOT NULL,
+                key TEXT NOT NULL,
+                files INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                PRIMARY KEY (dimension, key)
+            )
+        """)
+        update_stats(conn, conn.execute("SELECT content_type, size_bytes, uploaded_at FROM files"))
+    # Rendered thumbnails; rows go away with the payload they were made from
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS thumbnails (
+            sha256 TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            content_type TEXT NOT NULL,
+            data BLOB NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (sha256, size)
+        )
+    """)
+    # Filename search index, maintained by store_upload() and remove_file()
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS files_fts
+            USING fts5(original_filename, content='files', content_rowid='id', prefix='2 3')
+        """)
+    except sqlite3.OperationalError:
+        pass  # SQLite built without FTS5; search falls back to LIKE
+    else:
+        if not read_meta(conn, "fts_built"):
+            conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+            bump_meta(conn, "fts_built")
+    _backfill_blobs(conn)
+    conn.commit()
+    _load_generation(read_meta(conn, "generation"))
+    conn.close()
+
+def _create_file_indexes(conn) -> None:
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_sha256 ON files(sha256)")
+    # Covering index: listings and stats never visit the table rows
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_files_listing
+        ON files(id, original_filename, content_type, size_bytes, sha256, uploaded_at)
+    """)
+    # Filters and sort orders of /api/files/search; id breaks ties for the cursor
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_content_type ON files(content_type, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_size ON files(size_bytes, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_uploaded ON files(uploaded_at, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_files_name ON files(original_filename, id)")
+
+def _per_schema(conn, attr: str, compute):
+    """Cache compute() on the connection until the database schema changes."""
+    version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    cached = getattr(conn, attr, None)
+    if cached is None or cached[0] != version:
+        cached = (version, compute())
+        setattr(conn, attr, cached)
+    return cached[1]
+
+def legacy_tables(conn) -> frozenset:
+    """Names of tables that still carry a pre-chunking ``data`` payload column."""
+    return _per_schema(conn, "_legacy_tables", lambda: frozenset(
+        table for table in ("files", "blobs")
+        if any(r["name"] == "data" for r in conn.execute(f"PRAGMA table_info({table})"))
+    ))
+
+def fts_enabled(conn) -> bool:
+    """Whether the files_fts filename index exists (SQLite may lack FTS5)."""
+    return _per_schema(conn, "_fts_enabled", lambda: conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'files_fts'"
+    ).fetchone() is not None)
+
+def bump_meta(conn, key: str, delta: int = 1) -> None:
+    conn.execute(
+        "INSERT INTO catalog_meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+        (key, delta),
+    )
+
+def read_meta(conn, key: str, default: int = 0) -> int:
+    row = conn.execute("SELECT value FROM catalog_meta WHERE key = ?", (key,)).fetchone()
+    return row["value"] if row else default
+
+# Catalogue generation: persisted in catalog_meta and bumped in the same
+# transaction as every change to the files table, then published after the
+# commit to this shared counter. It lives in memory inherited across fork(),
+# so every prefork worker sees a write made by any other one. The epoch is
+# new for every init_db(), so tags handed out for another database (or
+# before a restore from backup) never match.
+_generation = multiprocessing.Value("q", 0)
+_generation_epoch = secrets.token_hex(4)
+
+def _load_generation(value: int) -> None:
+    global _generation_epoch
+    # Not publish_generation(): a different database may have a lower count
+    with _generation.get_lock():
+        _generation.value = value
+        _generation_epoch = secrets.token_hex(4)
+
+def bump_generation(conn) -> None:
+    """Mark the catalogue changed; takes effect when conn commits."""
+    bump_meta(conn, "generation")
+    conn.pending_generation = read_meta(conn, "generation")
+
+def publish_generation(value: int) -> None:
+    with _generation.get_lock():
+        # Commits of concurrent writers may publish out of order
+        if value > _generation.value:
+            _generation.value = value
+
+def catalogue_generation() -> int:
+    """Current generation, read without touching SQLite."""
+    return _generation.value
+
+def catalogue_etag() -> str:
+    return f"files-{_generation_epoch}-{catalogue_generation()}"
+
+def log_changes(conn, op: str, file_ids) -> None:
+    """Append an "add", "delete" or "compact" entry per file id; the caller commits."""
+    now = time.time()
+    conn.executemany(
+        "INSERT INTO file_changes (file_id, op, changed_at) VALUES (?, ?, ?)",
+        [(file_id, op, now) for file_id in file_ids],
+    )
+
+def last_change_seq(conn) -> int:
+    """Newest sequence number handed out, including entries already compacted away."""
+    row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'file_changes'").fetchone()
+    return max(row["seq"] if row else 0, read_meta(conn, "changes_floor"))
+
+def compact_change_log(conn, keep: int = None) -> int:
+    """Drop all but the newest ``keep`` entries; returns how many went. Commits."""
+    keep = CHANGE_LOG_RETENTION if keep is None else keep
+    cutoff = last_change_seq(conn) - keep
+    if cutoff <= read_meta(conn, "changes_floor"):
+        return 0
+    removed = conn.execute("DELETE FROM file_changes WHERE seq <= ?", (cutoff,)).rowcount
+    conn.execute("INSERT OR REPLACE INTO catalog_meta (key, value) VALUES ('changes_floor', ?)", (cutoff,))
+    conn.commit()
+    return removed
+
+# Storage statistics and quotas: storage_stats answers "how much is stored"
+# without scanning files, and is updated in the transaction of every change
+STATS_UNKNOWN_TYPE = "application/octet-stream"
+
+def update_stats(conn, rows, sign: int = 1) -> None:
+    """Add (content_type, size_bytes, uploaded_at) rows to storage_stats, or take them off with sign=-1."""
+    totals = {}
+    for content_type, size, uploaded_at in rows:
+        for key in (("total", ""), ("type", content_type or STATS_UNKNOWN_TYPE), ("day", uploaded_at[:10])):
+            files, nbytes = totals.get(key, (0, 0))
+            totals[key] = (files + sign, nbytes + sign * size)
+    conn.executemany(
+        """
+        INSERT INTO storage_stats (dimension, key, files, bytes) VALUES (?, ?, ?, ?)
+        ON CONFLICT(dimension, key) DO UPDATE SET files = files + excluded.files, bytes = bytes + excluded.bytes
+        """,
+        [(dimension, key, files, nbytes) for (dimension, key), (files, nbytes) in totals.items()],
+    )
+    if sign < 0:
+        conn.execute("DELETE FROM storage_stats WHERE files <= 0 AND dimension != 'total'")
+
+def type_quota(content_type: str):
+    """(pattern, limit) of the TYPE_QUOTA_BYTES entry covering a type, or None."""
+    kind = content_type or STATS_UNKNOWN_TYPE
+    for pattern in (kind, kind.split("/")[0] + "/*"):
+        if pattern in TYPE_QUOTA_BYTES:
+            return pattern, TYPE_QUOTA_BYTES[pattern]
+    return None
+
+def _type_matches(pattern: str, content_type: str) -> bool:
+    kind = content_type or STATS_UNKNOWN_TYPE
+    return kind == pattern or (pattern.endswith("/*") and kind.split("/")[0] == pattern[:-2])
+
+def stored_bytes(conn, pattern: str = None) -> int:
+    """Bytes stored in total, or of the types a TYPE_QUOTA_BYTES pattern covers."""
+    if pattern is None:
+        row = conn.execute("SELECT bytes FROM storage_stats WHERE dimension = 'total' AND key = ''").fetchone()
+        return row["bytes"] if row else 0
+    return sum(
+        r["bytes"] for r in conn.execute("SELECT key, bytes FROM storage_stats WHERE dimension = 'type'")
+        if _type_matches(pattern, r["key"])
+    )
+
+def reserved_bytes(conn, pattern: str = None, exclude_session: str = None) -> int:
+    """Full size of the open upload sessions (of the types ``pattern`` covers)."""
+    return sum(
+        r["size_bytes"] for r in conn.execute("SELECT id, content_type, size_bytes FROM upload_sessions")
+        if r["id"] != exclude_session and (pattern is None or _type_matches(pattern, r["content_type"]))
+    )
+
+def quotas_enabled() -> bool:
+    return STORAGE_QUOTA_BYTES is not None or bool(TYPE_QUOTA_BYTES)
+
+def quota_rejection(conn, content_type, size: int, pending=(), exclude_session: str = None):
+    """
+    Why storing ``size`` more bytes of ``content_type`` would exceed a quota,
+    or None. ``pending`` lists (content_type, size) accepted earlier in the
+    same transaction and not yet counted in storage_stats.
+    """
+    checks = []
+    if STORAGE_QUOTA_BYTES is not None:
+        checks.append((None, STORAGE_QUOTA_BYTES))
+    if type_quota(content_type):
+        checks.append(type_quota(content_type))
+    for pattern, limit in checks:
+        used = stored_bytes(conn, pattern) + reserved_bytes(conn, pattern, exclude_session)
+        used += sum(n for kind, n in pending if pattern is None or _type_matches(pattern, kind))
+        if used + size > limit:
+            scope = "storage" if pattern is None else f"{pattern} storage"
+            return f"{scope} quota of {limit} bytes exceeded"
+    return None
+
+def quota_headroom():
+    """Bytes the global quota still has room for, or None when it is unlimited."""
+    if STORAGE_QUOTA_BYTES is None:
+        return None
+    conn = get_db()
+    try:
+        return STORAGE_QUOTA_BYTES - stored_bytes(conn) - reserved_bytes(conn)
+    finally:
+        conn.close()
+
+def _quota_precheck():
+    """A 507 response when the request body alone cannot fit the global quota."""
+    headroom = quota_headroom() if request.content_length else None
+    if headroom is not None and request.content_length > headroom:
+        return jsonify(error="Storage quota exceeded.", quota_bytes=STORAGE_QUOTA_BYTES, free_bytes=max(0, headroom)), 507
+    return None
+
+def _backfill_blobs(conn) -> None:
+    """
+    Register payloads of rows written before the blobs table existed. This
+    only reads metadata; payloads still sitting in a data column are marked
+    'legacy' and moved out in batches by migrate_blobs().
+    """
+    legacy = legacy_tables(conn)
+    if "blobs" in legacy:
+        conn.execute("UPDATE blobs SET storage = 'legacy' WHERE storage = 'inline' AND length(data) > 0")
+    if "files" not in legacy:
+        return
+    extra_col, extra_val = (", data", ", zeroblob(0)") if "blobs" in legacy else ("", "")
+    conn.execute(f"""
+        INSERT INTO blobs ({BLOBS_COLUMNS}{extra_col})
+        SELECT sha256, MAX(size_bytes),
+               CASE WHEN MAX(size_bytes) = 0 THEN 'inline'
+                    WHEN MAX(length(data)) > 0 THEN 'legacy'
+                    ELSE 'fs' END,
+               COUNT(*), 'identity', MAX(size_bytes){extra_val}
+        FROM files
+        WHERE sha256 NOT IN (SELECT sha256 FROM blobs)
+        GROUP BY sha256
+    """)
+
+def _suffix_matcher(extensions):
+    # Longer alternatives first, and search() takes the leftmost dot, so
+    # "x.tar.gz" reports "tar.gz" rather than "gz"
+    alternatives = "|".join(re.escape(ext) for ext in sorted(extensions, key=len, reverse=True))
+    return re.compile(rf"\.({alternatives})\Z", re.IGNORECASE)
+
+ALLOWED_SUFFIX = _suffix_matcher(ALLOWED_EXTENSIONS)
+
+def allowed_extension(filename: str):
+    """The ALLOWED_EXTENSIONS entry a filename ends with, or None."""
+    match = ALLOWED_SUFFIX.search(filename)
+    return match.group(1).lower() if match else None
+
+def ext_ok(filename: str) -> bool:
+    return allowed_extension(filename) is not None
+
+def name_rejection(filename: str):
+    """Reason to refuse a part from its filename alone, or None."""
+    name = secure_filename(filename)
+    if not name:
+        return None  # unnamed parts are skipped, not reported
+    return None if ext_ok(name) else "type not allowed"
+
+def content_rejection(filename: str, head: bytes):
+    """Reason to refuse a part whose first bytes contradict its extension, or None."""
+    if not UPLOAD_SIGNATURE_CHECK or not head or not filename:
+        return None
+    ext = allowed_extension(secure_filename(filename))
+    alternatives = UPLOAD_SIGNATURES.get(ext)
+    if alternatives is None:
+        return None
+    for pairs in alternatives:
+        if all(
+            magic in head[:SNIFF_BYTES] if offset is None else head.startswith(magic, offset)
+            for offset, magic in pairs
+        ):
+            return None
+    return f"content is not .{ext}"
+
+def sha256_bytes(b: bytes) -> str:
+    return hashlib.sha256(b).hexdigest()
+
+# --------------------------
+# Blob storage
+# --------------------------
+def _rechunk(chunks, size: int):
+    """Regroup an iterable of byte strings into pieces of exactly ``size`` bytes (the last may be shorter)."""
+    buf = bytearray()
+    for chunk in chunks:
+        buf += chunk
+        while len(buf) >= size:
+            yield bytes(buf[:size])
+            del buf[:size]
+    if buf:
+        yield bytes(buf)
+
+def _read_chunks(fh, size: int = INGEST_CHUNK_SIZE):
+    while True:
+        chunk = fh.read(size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class ChunkReader:
+    """Seekable, read-only file object over a payload stored in blob_chunks."""
+
+    def __init__(self, conn, digest: str, size: int):
+        self._conn = conn
+        self._digest = digest
+        self._size = size
+        self._pos = 0
+        self._row = (0, b"")
+        self.closed = False
+
+    def _row_at(self, pos: int):
+        """(offset, data) of the stored row holding byte ``pos``, or None."""
+        seq = pos // PAYLOAD_CHUNK_SIZE
+        row = self._conn.execute(
+            "SELECT data FROM blob_chunks WHERE sha256 = ? AND seq = ?", (self._digest, seq)
+        ).fetchone()
+        return (seq * PAYLOAD_CHUNK_SIZE, row[0]) if row else None
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self._pos, os.SEEK_END: self._size}[whence]
+        self._pos = max(0, base + offset)
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = self._size - self._pos
+        size = remaining if size is None or size < 0 else min(size, remaining)
+        parts = []
+        while size > 0:
+            start, data = self._row
+            if not start <= self._pos < start + len(data):
+                row = self._row_at(self._pos)
+                if row is None:
+                    break
+                self._row = start, data = row
+            piece = data[self._pos - start:self._pos - start + size]
+            if not piece:
+                break
+            parts.append(piece)
+            self._pos += len(piece)
+            size -= len(piece)
+        return b"".join(parts)
+
+    def close(self) -> None:
+        self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class InlineBlobStore:
+    """Payload kept in SQLite as fixed-size rows of blob_chunks, apart from the metadata."""
+
+    name = "inline"
+
+    def put(self, conn, sink: IngestSink) -> None:
+        self.put_chunks(conn, sink.sha256, sink.payload_chunks())
+
+    def put_chunks(self, conn, digest: str, chunks) -> None:
+        conn.execute("DELETE FROM blob_chunks WHERE sha256 = ?", (digest,))
+        conn.executemany(
+            "INSERT INTO blob_chunks (sha256, seq, data) VALUES (?, ?, ?)",
+            ((digest, seq, chunk) for seq, chunk in enumerate(_rechunk(chunks, PAYLOAD_CHUNK_SIZE))),
+        )
+
+    def open(self, conn, blob):
+        return ChunkReader(conn, blob["sha256"], blob["stored_bytes"])
+
+    def release(self, conn, digest: str) -> None:
+        conn.execute("DELETE FROM blob_chunks WHERE sha256 = ?", (digest,))
+
+
+class ManifestReader(ChunkReader):
+    """Seekable, read-only file object over a "cdc" payload, walking its manifest."""
+
+    def _row_at(self, pos: int):
+        row = self._conn.execute(
+            """
+            SELECT m.offset, c.data FROM cdc_manifests m JOIN cdc_chunks c ON c.hash = m.chunk
+            WHERE m.sha256 = ? AND m.offset <= ? ORDER BY m.offset DESC LIMIT 1
+            """,
+            (self._digest, pos),
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+
+# FastCDC gear table as published with the algorithm (and used by the fastcdc
+# package), so both chunkers cut at the same offsets
+_GEAR = (
+    0x5C95C078, 0x22408989, 0x2D48A214, 0x12842087, 0x530F8AFB, 0x474536B9, 0x2963B4F1, 0x44CB738B,
+    0x4EA7403D, 0x4D606B6E, 0x074EC5D3, 0x3AF39D18, 0x726003CA, 0x37A62A74, 0x51A2F58E, 0x7506358E,
+    0x5D4AB128, 0x4D4AE17B, 0x41E85924, 0x470C36F7, 0x4741CBE1, 0x01BB7F30, 0x617C1DE3, 0x2B0C3A1F,
+    0x50C48F73, 0x21A82D37, 0x6095ACE0, 0x419167A0, 0x3CAF49B0, 0x40CEA62D, 0x66BC1C66, 0x545E1DAD,
+    0x2BFA77CD, 0x6E85DA24, 0x5FB0BDC5, 0x652CFC29, 0x3A0AE1AB, 0x2837E0F3, 0x6387B70E, 0x13176012,
+    0x4362C2BB, 0x66D8F4B1, 0x37FCE834, 0x2C9CD386, 0x21144296, 0x627268A8, 0x650DF537, 0x2805D579,
+    0x3B21EBBD, 0x7357ED34, 0x3F58B583, 0x7150DDCA, 0x7362225E, 0x620A6070, 0x2C5EF529, 0x7B522466,
+    0x768B78C0, 0x4B54E51E, 0x75FA07E5, 0x06A35FC6, 0x30B71024, 0x1C8626E1, 0x296AD578, 0x28D7BE2E,
+    0x1490A05A, 0x7CEE43BD, 0x698B56E3, 0x09DC0126, 0x4ED6DF6E, 0x02C1BFC7, 0x2A59AD53, 0x29C0E434,
+    0x7D6C5278, 0x507940A7, 0x5EF6BA93, 0x68B6AF1E, 0x46537276, 0x611BC766, 0x155C587D, 0x301BA847,
+    0x2CC9DDA7, 0x0A438E2C, 0x0A69D514, 0x744C72D3, 0x4F326B9B, 0x7EF34286, 0x4A0EF8A7, 0x6AE06EBE,
+    0x669C5372, 0x12402DCB, 0x5FEAE99D, 0x76C7F4A7, 0x6ABDB79C, 0x0DFAA038, 0x20E2282C, 0x730ED48B,
+    0x069DAC2F, 0x168ECF3E, 0x2610E61F, 0x2C512C8E, 0x15FB8C06, 0x5E62BC76, 0x69555135, 0x0ADB864C,
+    0x4268F914, 0x349AB3AA, 0x20EDFDB2, 0x51727981, 0x37B4B3D8, 0x5DD17522, 0x6B2CBFE4, 0x5C47CF9F,
+    0x30FA1CCD, 0x23DEDB56, 0x13D1F50A, 0x64EDDEE7, 0x0820B0F7, 0x46E07308, 0x1E2D1DFD, 0x17B06C32,
+    0x250036D8, 0x284DBF34, 0x68292EE0, 0x362EC87C, 0x087CB1EB, 0x76B46720, 0x104130DB, 0x71966387,
+    0x482DC43F, 0x2388EF25, 0x524144E1, 0x44BD834E, 0x448E7DA3, 0x3FA6EAF9, 0x3CDA215C, 0x3A500CF3,
+    0x395CB432, 0x5195129F, 0x43945F87, 0x51862CA4, 0x56EA8FF1, 0x201034DC, 0x4D328FF5, 0x7D73A909,
+    0x6234D379, 0x64CFBF9C, 0x36F6589A, 0x0A2CE98A, 0x5FE4D971, 0x03BC15C5, 0x44021D33, 0x16C1932B,
+    0x37503614, 0x1ACAF69D, 0x3F03B779, 0x49E61A03, 0x1F52D7EA, 0x1C6DDD5C, 0x062218CE, 0x07E7A11A,
+    0x1905757A, 0x7CE00A53, 0x49F44F29, 0x4BCC70B5, 0x39FEEA55, 0x5242CEE8, 0x3CE56B85, 0x00B81672,
+    0x46BEECCC, 0x3CA0AD56, 0x2396CEE8, 0x78547F40, 0x6B08089B, 0x66A56751, 0x781E7E46, 0x1E2CF856,
+    0x3BC13591, 0x494A4202, 0x520494D7, 0x2D87459A, 0x757555B6, 0x42284CC1, 0x1F478507, 0x75C95DFF,
+    0x35FF8DD7, 0x4E4757ED, 0x2E11F88C, 0x5E1B5048, 0x420E6699, 0x226B0695, 0x4D1679B4, 0x5A22646F,
+    0x161D1131, 0x125C68D9, 0x1313E32E, 0x4AA85724, 0x21DC7EC1, 0x4FFA29FE, 0x72968382, 0x1CA8EEF3,
+    0x3F3B1C28, 0x39C2FB6C, 0x6D76493F, 0x7A22A62E, 0x789B1C2A, 0x16E0CB53, 0x7DECEEEB, 0x0DC7E1C6,
+    0x5C75BF3D, 0x52218333, 0x106DE4D6, 0x7DC64422, 0x65590FF4, 0x2C02EC30, 0x64A9AC67, 0x59CAB2E9,
+    0x4A21D2F3, 0x0F616E57, 0x23B54EE8, 0x02730AAA, 0x2F3C634D, 0x7117FC6C, 0x01AC6F05, 0x5A9ED20C,
+    0x158C4E2A, 0x42B699F0, 0x0C7C14B3, 0x02BD9641, 0x15AD56FC, 0x1C722F60, 0x7DA1AF91, 0x23E0DBCB,
+    0x0E93E12B, 0x64B2791D, 0x440D2476, 0x588EA8DD, 0x4665A658, 0x7446C418, 0x1877A774, 0x5626407E,
+    0x7F63BD46, 0x32D2DBD8, 0x3C790F4A, 0x772B7239, 0x6F8B2826, 0x677FF609, 0x0DC82C11, 0x23FFE354,
+    0x2EAC53A6, 0x16139E09, 0x0AFD0DBC, 0x2A4D4237, 0x56A368C7, 0x234325E4, 0x2DCE9187, 0x32E8EA7E,
+)
+_CDC_MASK_S = (1 << (round(math.log2(CDC_AVG_SIZE)) + 1)) - 1
+_CDC_MASK_L = (1 << (round(math.log2(CDC_AVG_SIZE)) - 1)) - 1
+# Past this length the looser mask applies (FastCDC's normalized chunking)
+_CDC_CENTER = min(CDC_AVG_SIZE - min(CDC_AVG_SIZE, CDC_MIN_SIZE + -(-CDC_MIN_SIZE // 2)), CDC_MAX_SIZE)
+# Bytes buffered per cdc_split() round
+_CDC_WINDOW = 16 * CDC_MAX_SIZE
+
+def _cdc_cut(data: memoryview) -> int:
+    """Length of the chunk FastCDC cuts at the start of ``data``."""
+    size = len(data)
+    if size <= CDC_MIN_SIZE:
+        return size
+    gear, pattern, i = _GEAR, 0, CDC_MIN_SIZE
+    for mask, barrier in ((_CDC_MASK_S, min(_CDC_CENTER, size)), (_CDC_MASK_L, min(CDC_MAX_SIZE, size))):
+        for byte in data[i:barrier]:
+            pattern = (pattern >> 1) + gear[byte]
+            i += 1
+            if not pattern & mask:
+                return i
+        i = max(i, barrier)
+    return i
+
+def _cdc_lengths(data: memoryview):
+    if fastcdc_cy is not None:
+        for chunk in fastcdc_cy(data, min_size=CDC_MIN_SIZE, avg_size=CDC_AVG_SIZE, max_size=CDC_MAX_SIZE):
+            yield chunk.length
+        return
+    start = 0
+    while start < len(data):
+        length = _cdc_cut(data[start:start + CDC_MAX_SIZE])
+        yield length
+        start += length
+
+def cdc_split(chunks):
+    """Regroup a byte stream at content-defined boundaries; yields each chunk."""
+    pieces = iter(chunks)
+    buf = b""
+    final = False
+    while not final:
+        parts, size = [buf], len(buf)
+        while size < _CDC_WINDOW:
+            piece = next(pieces, None)
+            if piece is None:
+                final = True
+                break
+            parts.append(piece)
+            size += len(piece)
+        buf = b"".join(parts)
+        start = 0
+        for length in _cdc_lengths(memoryview(buf)):
+            # Only chunks that cannot grow with more input are final
+            if not final and start + CDC_MAX_SIZE > len(buf):
+                break
+            yield buf[start:start + length]
+            start += length
+        buf = buf[start:]
+
+def needs_split(conn, sink: IngestSink) -> bool:
+    """Whether a part goes to the "cdc" store as a new payload and has not been split yet."""
+    return (
+        pick_store(sink.stored_size).name == "cdc" and sink.manifest is None
+        and not conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sink.sha256,)).fetchone()
+    )
+
+def split_payload(sink: IngestSink) -> None:
+    """
+    Find the chunks of a part ahead of the write lock, so CdcBlobStore.put()
+    only has to look them up (the pure-Python chunker is CPU-bound).
+    """
+    manifest, offset = [], 0
+    for chunk in cdc_split(sink.payload_chunks()):
+        manifest.append((offset, len(chunk), hashlib.sha256(chunk).hexdigest()))
+        offset += len(chunk)
+    sink.manifest = manifest
+
+def check_storage_backend() -> None:
+    """Refuse the "cdc" store without the fastcdc extension, unless CDC_PURE_PYTHON allows it."""
+    if STORAGE_BACKEND != "cdc" or fastcdc_cy is not None:
+        return
+    if not CDC_PURE_PYTHON:
+        raise RuntimeError(
+            "The cdc store needs the fastcdc package to keep ingest I/O-bound; install it or set "
+            "FILEUPLOADER_CDC_PURE_PYTHON=1 to chunk in pure Python."
+        )
+    print(
+        " * WARNING: the cdc store is chunking in pure Python (a few MB/s per core); "
+        "uploads will be CPU-bound until fastcdc is installed",
+        flush=True,
+    )
+
+
+class LegacyBlobStore:
+    """
+    Read-only access to payloads that still sit in the data column of a
+    pre-chunking schema, until migrate_blobs() has moved them.
+    """
+
+    name = "legacy"
+
+    def open(self, conn, blob):
+        # Incremental blob I/O: reads and seeks touch only the pages they need
+        if "blobs" in legacy_tables(conn):
+            row = conn.execute(
+                "SELECT rowid FROM blobs WHERE sha256 = ? AND length(data) > 0", (blob["sha256"],)
+            ).fetchone()
+            if row:
+                return conn.blobopen("blobs", "data", row[0], readonly=True)
+        row = conn.execute(
+            "SELECT id FROM files WHERE sha256 = ? AND length(data) > 0 LIMIT 1", (blob["sha256"],)
+        ).fetchone()
+        return conn.blobopen("files", "data", row[0], readonly=True)
+
+    def release(self, conn, digest: str) -> None:
+        pass
+
+
+class FilesystemBlobStore:
+    """
+    Payloads as files named by their sha256 in a two-level sharded tree
+    (ab/cd/abcd...). Files are written to a temp name and renamed into place,
+    so a reader never observes a partially written blob.
+    """
+
+    name = "fs"
+
+    def __init__(self, root: Path = None):
+        self._root = root
+
+    @property
+    def root(self) -> Path:
+        return Path(self._root or BLOB_ROOT)
+
+    def path_for(self, digest: str) -> Path:
+        return self.root / digest[:2] / digest[2:4] / digest
+
+    def put(self, conn, sink: IngestSink) -> None:
+        target = self.path_for(sink.sha256)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        # finish() and compress_sink() fsynced the staged file already
+        try:
+            os.replace(sink.payload_path, target)
+        except OSError:
+            # Staging dir on another filesystem; copy next to the target first
+            self.put_chunks(conn, sink.sha256, sink.payload_chunks())
+
+    def put_chunks(self, conn, digest: str, chunks) -> None:
+        target = self.path_for(digest)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=target.parent)
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, target)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def open(self, conn, blob):
+        return open(self.path_for(blob["sha256"]), "rb")
+
+    def release(self, conn, digest: str) -> None:
+        try:
+            self.path_for(digest).unlink()
+        except FileNotFoundError:
+            pass
+
+
+class CdcBlobStore:
+    """
+    Payloads as manifests of content-defined chunks (see cdc_split()). Each
+    distinct chunk is a cdc_chunks row shared by refcount, so a new version
+    of a file only adds the chunks that changed.
+    """
+
+    name = "cdc"
+
+    def put(self, conn, sink: IngestSink) -> None:
+        if sink.manifest is None:
+            return self.put_chunks(conn, sink.sha256, sink.payload_chunks())
+        self.release(conn, sink.sha256)
+        with open(sink.payload_path, "rb") as fh:
+            for offset, length, chunk in sink.manifest:
+                if not self._reference(conn, chunk):
+                    fh.seek(offset)
+                    self._insert(conn, chunk, fh.read(length))
+        self._write_manifest(conn, sink.sha256, sink.manifest)
+
+    def put_chunks(self, conn, digest: str, chunks) -> None:
+        self.release(conn, digest)
+        manifest, offset = [], 0
+        for data in cdc_split(chunks):
+            chunk = hashlib.sha256(data).hexdigest()
+            if not self._reference(conn, chunk):
+                self._insert(conn, chunk, data)
+            manifest.append((offset, len(data), chunk))
+            offset += len(data)
+        self._write_manifest(conn, digest, manifest)
+
+    @staticmethod
+    def _reference(conn, chunk: str) -> bool:
+        return conn.execute("UPDATE cdc_chunks SET refcount = refcount + 1 WHERE hash = ?", (chunk,)).rowcount == 1
+
+    @staticmethod
+    def _insert(conn, chunk: str, data: bytes) -> None:
+        conn.execute("INSERT INTO cdc_chunks (hash, size, refcount, data) VALUES (?, ?, 1, ?)", (chunk, len(data), data))
+
+    @staticmethod
+    def _write_manifest(conn, digest: str, manifest) -> None:
+        conn.executemany(
+            "INSERT INTO cdc_manifests (sha256, offset, length, chunk) VALUES (?, ?, ?, ?)",
+            ((digest, offset, length, chunk) for offset, length, chunk in manifest),
+        )
+
+    def open(self, conn, blob):
+        return ManifestReader(conn, blob["sha256"], blob["stored_bytes"])
+
+    def release(self, conn, digest: str) -> None:
+        counts = conn.execute(
+            "SELECT chunk, COUNT(*) FROM cdc_manifests WHERE sha256 = ? GROUP BY chunk", (digest,)
+        ).fetchall()
+        conn.executemany("UPDATE cdc_chunks SET refcount = refcount - ? WHERE hash = ?", [(n, chunk) for chunk, n in counts])
+        conn.executemany("DELETE FROM cdc_chunks WHERE hash = ? AND refcount <= 0", [(chunk,) for chunk, _ in counts])
+        conn.execute("DELETE FROM cdc_manifests WHERE sha256 = ?", (digest,))
+
+
+BLOB_STORES = {
+    store.name: store for store in (InlineBlobStore(), FilesystemBlobStore(), CdcBlobStore(), LegacyBlobStore())
+}
+
+def pick_store(size: int):
+    if size <= INLINE_MAX_BYTES:
+        return BLOB_STORES["inline"]
+    return BLOB_STORES[STORAGE_BACKEND]
+
+class Codec:
+    """
+    Streaming compressor/decompressor pair for payloads at rest. http_token
+    is the Content-Encoding the stored bytes can be sent under, if any.
+    """
+
+    def __init__(self, name: str, compressor, decompressor, http_token: str = None):
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+        self.http_token = http_token
+
+    def decode(self, chunks):
+        decoder = self.decompressor()
+        for chunk in chunks:
+            data = decoder.decompress(chunk)
+            if data:
+                yield data
+        tail = decoder.flush() if hasattr(decoder, "flush") else b""
+        if tail:
+            yield tail
+
+
+COMPRESSION_CODECS = {
+    codec.name: codec for codec in (
+        Codec("gzip", lambda: zlib.compressobj(6, zlib.DEFLATED, 31), lambda: zlib.decompressobj(31), "gzip"),
+        Codec("deflate", lambda: zlib.compressobj(6), zlib.decompressobj, "deflate"),
+        Codec("xz", lambda: lzma.LZMACompressor(preset=6), lzma.LZMADecompressor),
+    )
+}
+if zstandard is not None:
+    COMPRESSION_CODECS["zstd"] = Codec(
+        "zstd",
+        lambda: zstandard.ZstdCompressor(level=6).compressobj(),
+        lambda: zstandard.ZstdDecompressor().decompressobj(),
+        "zstd",
+    )
+
+class DecodingReader:
+    """
+    Seekable, read-only view of the logical bytes of an encoded payload, for
+    clients that do not accept its encoding. Forward seeks decode and skip;
+    seeking backwards restarts from the start of the payload.
+    """
+
+    def __init__(self, raw, codec: Codec, size: int):
+        self._raw = raw
+        self._codec = codec
+        self._size = size
+        self._restart()
+
+    def _restart(self) -> None:
+        self._raw.seek(0)
+        self._decoded = self._codec.decode(_read_chunks(self._raw))
+        self._buf = b""
+        self._pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._size - self._pos
+        while len(self._buf) < size:
+            chunk = next(self._decoded, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        data, self._buf = self._buf[:size], self._buf[size:]
+        self._pos += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 1:
+            offset += self._pos
+        elif whence == 2:
+            offset += self._size
+        if offset < self._pos:
+            self._restart()
+        while self._pos < offset and self.read(min(INGEST_CHUNK_SIZE, offset - self._pos)):
+            pass
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    def close(self) -> None:
+        self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def compression_codec(filename: str, content_type: str = None):
+    """Codec COMPRESSION_POLICY assigns to a part, or None to store it raw."""
+    kind = mimetypes.guess_type(filename)[0] or content_type or ""
+    name = COMPRESSION_POLICY.get(kind) or COMPRESSION_POLICY.get(kind.split("/")[0] + "/*")
+    if name and COMPRESSION_OVERRIDE:
+        name = None if COMPRESSION_OVERRIDE == "none" else COMPRESSION_OVERRIDE
+    if name and name not in COMPRESSION_CODECS:
+        name = "gzip"  # e.g. zstd requested without zstandard installed
+    return COMPRESSION_CODECS[name] if name else None
+
+def compress_sink(sink: IngestSink, codec: Codec) -> None:
+    """
+    Write an encoded copy of a staged part next to it and keep it as the
+    payload if it saves at least COMPRESSION_MIN_SAVINGS. zlib and lzma drop
+    the GIL, so ingest_files() runs this on the hash pool.
+    """
+    if sink.size < COMPRESSION_MIN_BYTES:
+        return
+    limit = sink.size * (1 - COMPRESSION_MIN_SAVINGS)
+    compressor = codec.compressor()
+    fd, path = tempfile.mkstemp(prefix="encoded-", dir=STAGING_DIR)
+    stored = 0
+    with os.fdopen(fd, "wb") as out:
+        for chunk in sink.chunks():
+            data = compressor.compress(chunk)
+            out.write(data)
+            stored += len(data)
+            if stored > limit:
+                break
+        else:
+            data = compressor.flush()
+            out.write(data)
+            stored += len(data)
+            out.flush()
+            os.fsync(out.fileno())
+    if stored > limit:
+        os.unlink(path)
+        return
+    sink.encoding = codec.name
+    sink.stored_size = stored
+    sink._encoded_path = Path(path)
+
+def prepare_payload(conn, sink: IngestSink, filename: str, content_type: str):
+    """
+    Return the codec a part should be compressed with before it is stored, or
+    None if it is stored raw or its payload is already known (a deduplicated
+    part is never compressed twice).
+    """
+    codec = compression_codec(filename, content_type)
+    if codec is None or sink.size < COMPRESSION_MIN_BYTES or pick_store(sink.size).name == "cdc":
+        return None
+    if conn.execute("SELECT 1 FROM blobs WHERE sha256 = ?", (sink.sha256,)).fetchone():
+        return None
+    return codec
+
+def store_payload(conn, sink: IngestSink) -> bool:
+    """
+    Reference the payload of a fully received part. If the same sha256 is
+    already stored only its refcount is bumped; otherwise the payload is
+    handed to the chosen store. Returns whether it was deduplicated.
+    """
+    # Bumping first takes the write lock, so a concurrent delete cannot free
+    # the payload between the lookup and the files insert
+    if conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?", (sink.sha256,)).rowcount == 1:
+        return True
+    store = pick_store(sink.stored_size)
+    extra_col, extra_val = (", data", ", zeroblob(0)") if "blobs" in legacy_tables(conn) else ("", "")
+    conn.execute(
+        f"INSERT INTO blobs ({BLOBS_COLUMNS}{extra_col}) VALUES (?, ?, ?, 1, ?, ?{extra_val})",
+        (sink.sha256, sink.size, store.name, sink.encoding, sink.stored_size),
+    )
+    store.put(conn, sink)
+    return False
+
+def insert_file_rows(conn, rows) -> list:
+    """
+    Insert (filename, content_type, size_bytes, sha256) metadata rows with a
+    single executemany() and return their ids. The caller holds the write
+    lock until it commits, so AUTOINCREMENT hands out consecutive ids.
+    """
+    if not rows:
+        return []
+    uploaded_at = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    extra_col, extra_val = (", data", ", zeroblob(0)") if "files" in legacy_tables(conn) else ("", "")
+    conn.executemany(
+        f"""
+        INSERT INTO files (original_filename, stored_filename, content_type, size_bytes, sha256, uploaded_at{extra_col})
+        VALUES (?, ?, ?, ?, ?, ?{extra_val})
+        """,
+        [(name, f"{digest[:12]}_{name}", ctype, size, digest, uploaded_at) for name, ctype, size, digest in rows],
+    )
+    last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+    ids = list(range(last_id - len(rows) + 1, last_id + 1))
+    for _, _, size, _ in rows:
+        INGEST_SIZES.observe(size)
+    if fts_enabled(conn):
+        conn.execute(
+            "INSERT INTO files_fts (rowid, original_filename) SELECT id, original_filename FROM files WHERE id BETWEEN ? AND ?",
+            (ids[0], ids[-1]),
+        )
+    bump_meta(conn, "file_count", len(rows))
+    update_stats(conn, [(ctype, size, uploaded_at) for _, ctype, size, _ in rows])
+    bump_generation(conn)
+    log_changes(conn, "add", ids)
+    return ids
+
+def store_upload(conn, sink: IngestSink, filename: str, content_type: str):
+    """
+    Store one received part and its metadata row. Returns (file_id,
+    deduplicated). Compress or split the part first, before the write lock.
+    """
+    deduplicated = store_payload(conn, sink)
+    file_id, = insert_file_rows(conn, [(filename, content_type, sink.size, sink.sha256)])
+    return file_id, deduplicated
+
+def ingest_files(files) -> dict:
+    """
+    Shared ingest pipeline of /upload and /api/upload. By the time this runs
+    every part has been streamed to staging and hashed on the hash pool while
+    the rest of the body was still arriving. The batch is one transaction
+    holding the write lock; each payload is stored under its own savepoint,
+    so one failing part does not sink the batch, but if the metadata insert
+    or the commit fails, nothing of the batch is kept.
+    """
+    report = {"saved": [], "rejected": [], "failed": [], "deduplicated": []}
+    accepted = []
+    for f in files:
+        if f.filename == "":
+            continue
+        filename = secure_filename(f.filename)
+        if not filename or not ext_ok(filename):
+            report["rejected"].append(f.filename or "(unnamed)")
+            continue
+        sink = f.stream
+        sink.finish()
+        if sink.rejection is not None:
+            report["rejected"].append(f"{filename} ({sink.rejection})")
+            continue
+        if not sink.size:
+            report["rejected"].append(filename + " (empty)")
+            continue
+        accepted.append((filename, f.mimetype, sink))
+
+    conn = get_db()
+    # Compress (or chunk) new payloads in parallel before the write lock is taken
+    compressing = {}
+    for filename, content_type, sink in accepted:
+        codec = prepare_payload(conn, sink, filename, content_type)
+        if codec is not None and sink.sha256 not in compressing:
+            compressing[sink.sha256] = hash_pool().submit(compress_sink, sink, codec)
+        elif codec is None and sink.sha256 not in compressing and needs_split(conn, sink):
+            compressing[sink.sha256] = hash_pool().submit(split_payload, sink)
+    compress_errors = {}
+    for digest, future in compressing.items():
+        try:
+            future.result()
+        except OSError as exc:
+            compress_errors[digest] = exc
+
+    rows = []
+    new_payloads = []
+    # Quota checks, refcount bumps and inserts must see the same totals as concurrent uploads
+    conn.execute("BEGIN IMMEDIATE")
+    for filename, content_type, sink in accepted:
+        if sink.sha256 in compress_errors:
+            report["failed"].append({"filename": filename, "error": str(compress_errors[sink.sha256])})
+            continue
+        if quotas_enabled():
+            reason = quota_rejection(conn, content_type, sink.size, [(r[1], r[2]) for r in rows])
+            if reason is not None:
+                report["rejected"].append(f"{filename} ({reason})")
+                continue
+        conn.execute("SAVEPOINT ingest_part")
+        try:
+            deduplicated = store_payload(conn, sink)
+        except (OSError, sqlite3.Error) as exc:
+            conn.execute("ROLLBACK TO ingest_part")
+            conn.execute("RELEASE ingest_part")
+            report["failed"].append({"filename": filename, "error": str(exc)})
+            continue
+        conn.execute("RELEASE ingest_part")
+        rows.append((filename, content_type, sink.size, sink.sha256))
+        if deduplicated:
+            report["deduplicated"].append({"filename": filename, "sha256": sink.sha256, "bytes_saved": sink.size})
+        else:
+            new_payloads.append(sink)
+    try:
+        ids = insert_file_rows(conn, rows)
+        conn.commit()
+    except (OSError, sqlite3.Error) as exc:
+        conn.rollback()
+        # No other writer could have referenced them while the lock was held
+        for sink in new_payloads:
+            store = pick_store(sink.stored_size)
+            if store.name == "fs":
+                store.release(conn, sink.sha256)
+        report["failed"] += [{"filename": name, "error": str(exc)} for name, _, _, _ in rows]
+        report["deduplicated"] = []
+        rows, ids = [], []
+    finally:
+        conn.close()
+    queue_thumbnails((name, digest) for name, _, _, digest in rows)
+    report["saved"] = [
+        {"id": file_id, "filename": name, "size_bytes": size, "sha256": digest}
+        for file_id, (name, _, size, digest) in zip(ids, rows)
+    ]
+    return report
+
+def upload_summary(report: dict) -> dict:
+    """The /api/upload JSON body for an ingest_files() report."""
+    return {
+        "saved": len(report["saved"]),
+        "files": report["saved"],
+        "rejected": report["rejected"],
+        "failed": report["failed"],
+        "deduplicated": report["deduplicated"],
+        "bytes_saved": sum(d["bytes_saved"] for d in report["deduplicated"]),
+    }
+
+def remove_file(conn, file_id: int) -> bool:
+    """
+    Delete a files row and drop its payload reference; the payload itself is
+    freed only when the last reference is gone. The caller commits.
+    """
+    row = conn.execute(
+        "SELECT sha256, original_filename, content_type, size_bytes, uploaded_at FROM files WHERE id = ?", (file_id,)
+    ).fetchone()
+    if not row:
+        return False
+    blob = conn.execute("SELECT sha256, size_bytes, stored_bytes, storage, refcount FROM blobs WHERE sha256 = ?", (row["sha256"],)).fetchone()
+    if blob and blob["storage"] == "legacy" and blob["refcount"] > 1:
+        # The row being deleted may be the one holding the legacy bytes
+        _move_payload(conn, blob)
+    conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    if fts_enabled(conn):
+        conn.execute(
+            "INSERT INTO files_fts (files_fts, rowid, original_filename) VALUES ('delete', ?, ?)",
+            (file_id, row["original_filename"]),
+        )
+    bump_meta(conn, "file_count", -1)
+    update_stats(conn, [(row["content_type"], row["size_bytes"], row["uploaded_at"])], sign=-1)
+    bump_generation(conn)
+    log_changes(conn, "delete", [file_id])
+    conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (row["sha256"],))
+    blob = conn.execute("SELECT storage, refcount FROM blobs WHERE sha256 = ?", (row["sha256"],)).fetchone()
+    if blob and blob["refcount"] <= 0:
+        conn.execute("DELETE FROM blobs WHERE sha256 = ?", (row["sha256"],))
+        conn.execute("DELETE FROM thumbnails WHERE sha256 = ?", (row["sha256"],))
+        BLOB_STORES[blob["storage"]].release(conn, row["sha256"])
+    return True
+
+def open_payload(conn, digest: str, decode: bool = False):
+    """
+    Open a stored payload as a seekable binary file object, still encoded
+    unless ``decode`` is set. Handles without a fileno() read through conn,
+    which must stay open until they are closed.
+    """
+    blob = conn.execute(
+        "SELECT sha256, size_bytes, stored_bytes, storage, encoding FROM blobs WHERE sha256 = ?", (digest,)
+    ).fetchone()
+    payload = BLOB_STORES[blob["storage"]].open(conn, blob)
+    if decode and blob["encoding"] != "identity":
+        payload = DecodingReader(payload, COMPRESSION_CODECS[blob["encoding"]], blob["size_bytes"])
+    return payload
+
+# --------------------------
+# Storage migration
+# --------------------------
+def _move_payload(conn, blob) -> None:
+    """Copy one payload into the store pick_store() chooses for it and point the blobs row there."""
+    source = BLOB_STORES[blob["storage"]]
+    target = pick_store(blob["stored_bytes"])
+    with source.open(conn, blob) as fh:
+        target.put_chunks(conn, blob["sha256"], _read_chunks(fh))
+    conn.execute("UPDATE blobs SET storage = ? WHERE sha256 = ?", (target.name, blob["sha256"]))
+    legacy = legacy_tables(conn)
+    if "blobs" in legacy:
+        conn.execute("UPDATE blobs SET data = zeroblob(0) WHERE sha256 = ?", (blob["sha256"],))
+    if "files" in legacy:
+        conn.execute("UPDATE files SET data = zeroblob(0) WHERE sha256 = ? AND length(data) > 0", (blob["sha256"],))
+    source.release(conn, blob["sha256"])
+
+def _pending_payloads(conn, limit: int):
+    misplaced = "" if STORAGE_BACKEND == "inline" else f" OR (storage = 'inline' AND stored_bytes > {int(INLINE_MAX_BYTES)})"
+    return conn.execute(
+        f"SELECT sha256, stored_bytes, storage FROM blobs WHERE storage = 'legacy'{misplaced} LIMIT ?", (limit,)
+    ).fetchall()
+
+def storage_migration_pending() -> bool:
+    conn = get_db()
+    try:
+        return bool(legacy_tables(conn)) or bool(_pending_payloads(conn, 1))
+    finally:
+        conn.close()
+
+def _rebuild_files_table(conn, batch_rows: int) -> None:
+    """
+    Copy files metadata into a table without the data column in batches,
+    then catch up with concurrent writes and swap it in one short transaction.
+    files rows are only ever inserted or deleted, so id order is enough.
+    """
+    conn.execute(FILES_SCHEMA.format(name="files_rebuild"))
+    conn.commit()
+    copy = f"INSERT INTO files_rebuild ({FILES_COLUMNS}) SELECT {FILES_COLUMNS} FROM files WHERE id > ? ORDER BY id"
+    while True:
+        last = conn.execute("SELECT COALESCE(MAX(id), 0) FROM files_rebuild").fetchone()[0]
+        copied = conn.execute(copy + " LIMIT ?", (last, batch_rows)).rowcount
+        conn.commit()
+        if copied < batch_rows:
+            break
+    conn.execute("BEGIN IMMEDIATE")
+    last = conn.execute("SELECT COALESCE(MAX(id), 0) FROM files_rebuild").fetchone()[0]
+    conn.execute(copy, (last,))
+    conn.execute("DELETE FROM files_rebuild WHERE id NOT IN (SELECT id FROM files)")
+    seq = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'files'").fetchone()
+    conn.execute("DROP TABLE files")
+    conn.execute("ALTER TABLE files_rebuild RENAME TO files")
+    if seq:
+        # Keep AUTOINCREMENT from reusing ids of rows deleted before the swap
+        if not conn.execute("UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'files'", (seq[0],)).rowcount:
+            conn.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('files', ?)", (seq[0],))
+    _create_file_indexes(conn)
+    conn.commit()
+
+def _rebuild_blobs_table(conn) -> None:
+    # blobs rows are updated in place (refcount), so copy them under one lock
+    conn.execute("BEGIN IMMEDIATE")
+    conn.execute(BLOBS_SCHEMA.format(name="blobs_rebuild"))
+    conn.execute(f"INSERT INTO blobs_rebuild ({BLOBS_COLUMNS}) SELECT {BLOBS_COLUMNS} FROM blobs")
+    conn.execute("DROP TABLE blobs")
+    conn.execute("ALTER TABLE blobs_rebuild RENAME TO blobs")
+    conn.commit()
+
+def migrate_blobs(batch_rows: int = MIGRATION_BATCH_ROWS, vacuum: bool = False, pause: float = 0.0) -> int:
+    """
+    Online, batched storage migration. Moves payloads out of legacy data
+    columns (and inline payloads larger than INLINE_MAX_BYTES when the
+    backend is "fs") into their store, committing every ``batch_rows``
+    payloads or MIGRATION_BATCH_BYTES, then drops the emptied data columns.
+    Safe to interrupt and rerun while the server keeps serving.
+    """
+    conn = get_db()
+    moved = 0
+    try:
+        while True:
+            batch = _pending_payloads(conn, batch_rows)
+            if not batch:
+                break
+            pending_bytes = 0
+            for blob in batch:
+                _move_payload(conn, blob)
+                moved += 1
+                pending_bytes += blob["stored_bytes"]
+                if pending_bytes >= MIGRATION_BATCH_BYTES:
+                    conn.commit()
+                    pending_bytes = 0
+            conn.commit()
+            if pause:
+                time.sleep(pause)
+        legacy = legacy_tables(conn)
+        if "files" in legacy:
+            _rebuild_files_table(conn, batch_rows)
+        if "blobs" in legacy:
+            _rebuild_blobs_table(conn)
+    finally:
+        conn.close()
+    if vacuum and moved:
+        conn = get_db()
+        conn.execute("VACUUM")
+        conn.close()
+    return moved
+
 # --------------------------
-# App
+# Space reclamation
 # --------------------------
-app = Flask(__name__)
-app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
-# For flash() messages; in localhost use a simple static key
-app.secret_key = os.environ.get("FLASK_SECRET_KEY", "dev-not-secure-on-internet")
+_activity = {"in_flight": 0, "last": time.monotonic()}
+_activity_lock = threading.Lock()
+_compaction = {"state": "idle"}
+_compaction_lock = threading.Lock()
+
+@app.before_request
+def _request_started():
+    with _activity_lock:
+        _activity["in_flight"] += 1
+        _activity["last"] = time.monotonic()
+
+@app.teardown_request
+def _request_finished(exc):
+    with _activity_lock:
+        _activity["in_flight"] -= 1
+        _activity["last"] = time.monotonic()
+
+def server_idle() -> bool:
+    with _activity_lock:
+        return not _activity["in_flight"] and time.monotonic() - _activity["last"] >= MAINTENANCE_IDLE_SECONDS
+
+def space_stats(conn, detail: bool = False) -> dict:
+    """
+    Page accounting of the database file. With ``detail`` the fragmentation,
+    i.e. the share of b-tree pages not directly following their predecessor,
+    is measured through dbstat; that reads every page, so it is opt-in.
+    """
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    stats = {
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(mode, mode),
+        "page_size": page_size,
+        "page_count": page_count,
+        "freelist_count": free,
+        "free_bytes": free * page_size,
+        "free_ratio": round(free / page_count, 4) if page_count else 0.0,
+    }
+    if detail:
+        try:
+            row = conn.execute("""
+                SELECT COUNT(gap), SUM(gap) FROM (
+                    SELECT pageno != LAG(pageno) OVER (PARTITION BY name ORDER BY path) + 1 AS gap FROM dbstat
+                )
+            """).fetchone()
+            stats["fragmentation"] = round(row[1] / row[0], 4) if row[0] else 0.0
+        except sqlite3.OperationalError:
+            stats["fragmentation"] = None  # SQLite built without dbstat
+    return stats
+
+def reclaim_free_pages(conn, max_pages: int = None, should_continue=None, progress=None) -> int:
+    """
+    Run ``PRAGMA incremental_vacuum`` in steps of VACUUM_STEP_PAGES so the
+    write lock is only held briefly, until the freelist is empty, max_pages
+    have been freed or should_continue() says stop. Returns the pages freed.
+    """
+    freed = 0
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    while free and (max_pages is None or freed < max_pages):
+        step = VACUUM_STEP_PAGES if max_pages is None else min(VACUUM_STEP_PAGES, max_pages - freed)
+        # execute() steps a row-less statement once, i.e. frees a single page;
+        # executescript() runs it to completion
+        conn.executescript(f"PRAGMA incremental_vacuum({step});")
+        left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if left >= free:
+            break  # not in incremental mode yet
+        freed += free - left
+        free = left
+        if progress:
+            progress(freed)
+        if should_continue and not should_continue():
+            break
+    return freed
+
+def compact_database(progress=None) -> dict:
+    """
+    Full compaction: hand back free pages incrementally, then VACUUM to
+    defragment the file (and switch it to auto_vacuum=INCREMENTAL if it
+    predates that). ``progress(phase, done, total)`` is called along the way.
+    Writers wait on busy_timeout only during the final VACUUM.
+    """
+    report = progress or (lambda phase, done, total: None)
+    conn = get_db()
+    try:
+        before = space_stats(conn)
+        total = before["freelist_count"]
+        report("reclaiming", 0, total)
+        reclaim_free_pages(conn, progress=lambda freed: report("reclaiming", freed, total))
+        report("vacuuming", 0, conn.execute("PRAGMA page_count").fetchone()[0])
+        conn.commit()
+        conn.execute("VACUUM")
+        after = space_stats(conn)
+        log_changes(conn, "compact", [0])
+        conn.commit()
+        report("done", after["page_count"], after["page_count"])
+    finally:
+        conn.close()
+    return {"before": before, "after": after}
+
+def _run_compaction() -> None:
+    def report(phase, done, total):
+        with _compaction_lock:
+            _compaction.update(phase=phase, done=done, total=total)
+
+    try:
+        result = compact_database(report)
+    except sqlite3.Error as exc:
+        with _compaction_lock:
+            _compaction.update(state="failed", error=str(exc), finished_at=time.time())
+        return
+    with _compaction_lock:
+        _compaction.update(result, state="done", finished_at=time.time())
+
+def sweep_staging(now: float = None) -> int:
+    """Delete ingest-*/encoded-* files older than STAGING_STALE_SECONDS; returns how many."""
+    cutoff = (now or time.time()) - STAGING_STALE_SECONDS
+    removed = 0
+    for pattern in ("ingest-*", "encoded-*"):
+        for path in STAGING_DIR.glob(pattern):
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed += 1
+            except FileNotFoundError:
+                pass  # finished meanwhile
+    return removed
+
+def _maintenance_loop(stop: threading.Event) -> None:
+    while not stop.wait(MAINTENANCE_INTERVAL):
+        conn = get_db()
+        try:
+            # Abandoned upload sessions hold part files of their full size;
+            # sweep them even while busy, the table only holds open sessions
+            gc_upload_sessions(conn)
+        except sqlite3.OperationalError:
+            pass
+        finally:
+            conn.close()
+        sweep_staging()
+        with _compaction_lock:
+            busy = _compaction["state"] == "running"
+        if busy or not server_idle():
+            continue
+        conn = get_db()
+        try:
+            compact_change_log(conn)
+            reclaim_free_pages(conn, should_continue=server_idle)
+        except sqlite3.OperationalError:
+            pass  # lost the write lock to a new request; retry next round
+        finally:
+            conn.close()
+
+def start_maintenance() -> threading.Event:
+    """Start the background reclamation thread; set the returned event to stop it."""
+    stop = threading.Event()
+    threading.Thread(target=_maintenance_loop, args=(stop,), name="db-maintenance", daemon=True).start()
+    return stop
+
+@app.route("/api/db/space", methods=["GET"])
+def api_db_space():
+    conn = get_db()
+    stats = space_stats(conn, detail=request.args.get("detail", type=int) == 1)
+    conn.close()
+    return jsonify(stats)
+
+@app.route("/api/stats", methods=["GET"])
+def api_stats():
+    """Stored files and bytes in total, per content type and per upload day, with the quotas."""
+    conn = get_db()
+    rows = conn.execute("SELECT dimension, key, files, bytes FROM storage_stats ORDER BY dimension, key").fetchall()
+    quotas = {}
+    if STORAGE_QUOTA_BYTES is not None:
+        quotas["*"] = {"limit_bytes": STORAGE_QUOTA_BYTES, "used_bytes": stored_bytes(conn), "reserved_bytes": reserved_bytes(conn)}
+    for pattern, limit in TYPE_QUOTA_BYTES.items():
+        quotas[pattern] = {
+            "limit_bytes": limit, "used_bytes": stored_bytes(conn, pattern), "reserved_bytes": reserved_bytes(conn, pattern),
+        }
+    conn.close()
+    stats = {"files": 0, "bytes": 0, "by_type": {}, "by_day": {}, "quotas": quotas}
+    for r in rows:
+        if r["dimension"] == "total":
+            stats.update(files=r["files"], bytes=r["bytes"])
+        else:
+            stats["by_" + r["dimension"]][r["key"]] = {"files": r["files"], "bytes": r["bytes"]}
+    return jsonify(stats)
+
+def dedup_report(conn) -> dict:
+    """
+    How far deduplication shrinks the catalogue: bytes as uploaded, distinct
+    payloads (whole-file dedup), and bytes actually held once compression and
+    the shared chunks of the "cdc" store are accounted for.
+    """
+    logical = stored_bytes(conn)
+    payloads = conn.execute(
+        """
+        SELECT COUNT(*), COALESCE(SUM(size_bytes), 0),
+               COALESCE(SUM(CASE WHEN storage = 'cdc' THEN 0 ELSE stored_bytes END), 0),
+               COALESCE(SUM(CASE WHEN storage = 'cdc' THEN stored_bytes ELSE 0 END), 0)
+        FROM blobs
+        """
+    ).fetchone()
+    chunks = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0), COALESCE(SUM(size * refcount), 0) FROM cdc_chunks"
+    ).fetchone()
+    held = payloads[2] + chunks[1]
+    return {
+        "logical_bytes": logical,
+        "payloads": payloads[0],
+        "payload_bytes": payloads[1],
+        "stored_bytes": held,
+        "file_dedup_ratio": round(logical / payloads[1], 3) if payloads[1] else 1.0,
+        "dedup_ratio": round(logical / held, 3) if held else 1.0,
+        "cdc": {
+            "payload_bytes": payloads[3],
+            "chunks": chunks[0],
+            "chunk_bytes": chunks[1],
+            "referenced_bytes": chunks[2],
+            "dedup_ratio": round(chunks[2] / chunks[1], 3) if chunks[1] else 1.0,
+        },
+    }
+
+@app.route("/api/stats/dedup", methods=["GET"])
+def api_dedup_report():
+    conn = get_db()
+    report = dedup_report(conn)
+    conn.close()
+    return jsonify(report)
+
+@app.route("/api/admin/compact", methods=["POST"])
+def api_start_compaction():
+    with _compaction_lock:
+        if _compaction["state"] == "running":
+            return jsonify(error="A compaction is already running.", **_compaction), 409
+        _compaction.clear()
+        _compaction.update(state="running", phase="starting", done=0, total=0, started_at=time.time())
+        status = dict(_compaction)
+    threading.Thread(target=_run_compaction, name="db-compaction", daemon=True).start()
+    return jsonify(status), 202
+
+@app.route("/api/admin/compact", methods=["GET"])
+def api_compaction_status():
+    with _compaction_lock:
+        return jsonify(_compaction)
 
 # --------------------------
-# DB helpers
+# Thumbnails
 # --------------------------
-def get_db():
-    conn = sqlite3.connect(DATABASE_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+_thumbnail_pool = None
+_thumbnail_jobs = {}
+_thumbnail_pid = None
+_thumbnail_lock = threading.Lock()
 
-def init_db():
+class ThumbnailError(Exception):
+    """A payload that cannot be turned into a thumbnail."""
+
+def thumbnail_backend():
+    """"pillow", "qt" or None if neither library is installed."""
+    if Image is not None:
+        return "pillow"
+    return "qt" if QImage is not None else None
+
+def thumbnail_type(filename: str, content_type: str = None):
+    """The image type of a file if thumbnails can be made of it, else None."""
+    kind = mimetypes.guess_type(filename)[0] or content_type
+    return kind if kind in THUMBNAIL_TYPES else None
+
+def _render_pillow(payload, size: int):
+    try:
+        image = Image.open(payload)
+        # Lets the JPEG decoder downscale by up to 8x while decoding
+        image.draft("RGB", (size, size))
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((size, size))
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError) as exc:
+        raise ThumbnailError(str(exc)) from exc
+    out = io.BytesIO()
+    if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+        image.save(out, "PNG", optimize=True)
+        return out.getvalue(), "image/png"
+    image.convert("RGB").save(out, "JPEG", quality=THUMBNAIL_JPEG_QUALITY)
+    return out.getvalue(), "image/jpeg"
+
+def _render_qt(payload, size: int):
+    image = QImage.fromData(payload.read())
+    if image.isNull():
+        raise ThumbnailError("Unsupported or corrupt image.")
+    if image.width() > size or image.height() > size:
+        image = image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+    buffer = QBuffer()
+    buffer.open(QIODevice.WriteOnly)
+    if image.hasAlphaChannel():
+        image.save(buffer, "PNG")
+        return bytes(buffer.data()), "image/png"
+    image.save(buffer, "JPEG", THUMBNAIL_JPEG_QUALITY)
+    return bytes(buffer.data()), "image/jpeg"
+
+THUMBNAIL_RENDERERS = {"pillow": _render_pillow, "qt": _render_qt}
+
+def cached_thumbnail(conn, digest: str, size: int):
+    return conn.execute(
+        "SELECT content_type, data FROM thumbnails WHERE sha256 = ? AND size = ?", (digest, size)
+    ).fetchone()
+
+def render_thumbnail(digest: str, size: int):
+    """
+    Render, cache and return (data, content_type) for a payload, or None if
+    the payload is gone. Runs on the thumbnail pool; a render that finishes
+    after its payload was deleted is not cached.
+    """
     conn = get_db()
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS files (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            original_filename TEXT NOT NULL,
-            stored_filename TEXT NOT NULL,
-            content_type TEXT,
-            size_bytes INTEGER NOT NULL,
-            sha256 TEXT NOT NULL,
-            uploaded_at TEXT NOT NULL,
-            data BLOB NOT NULL
+    try:
+        row = cached_thumbnail(conn, digest, size)
+        if row:
+            return row["data"], row["content_type"]
+        blob = conn.execute("SELECT size_bytes FROM blobs WHERE sha256 = ?", (digest,)).fetchone()
+        if not blob:
+            return None
+        if blob["size_bytes"] > THUMBNAIL_MAX_SOURCE_BYTES:
+            raise ThumbnailError("Image too large for a thumbnail.")
+        with open_payload(conn, digest, decode=True) as payload:
+            data, content_type = THUMBNAIL_RENDERERS[thumbnail_backend()](payload, size)
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO thumbnails (sha256, size, content_type, data, created_at)
+            SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM blobs WHERE sha256 = ?)
+            """,
+            (digest, size, content_type, data, time.time(), digest),
         )
-    """)
-    conn.commit()
+        conn.commit()
+        return data, content_type
+    finally:
+        conn.close()
+        _pool.release_thread()
+
+def submit_thumbnail(digest: str, size: int):
+    """Future for a render; concurrent requests for the same thumbnail share one."""
+    global _thumbnail_pool, _thumbnail_pid
+    key = (digest, size)
+    with _thumbnail_lock:
+        if _thumbnail_pool is None or _thumbnail_pid != os.getpid():
+            _thumbnail_pool = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnail")
+            _thumbnail_jobs.clear()
+            _thumbnail_pid = os.getpid()
+        future = _thumbnail_jobs.get(key)
+        if future is None:
+            future = _thumbnail_jobs[key] = _thumbnail_pool.submit(render_thumbnail, digest, size)
+            future.add_done_callback(lambda _: _forget_thumbnail_job(key))
+        return future
+
+def _forget_thumbnail_job(key) -> None:
+    with _thumbnail_lock:
+        _thumbnail_jobs.pop(key, None)
+
+def queue_thumbnails(files) -> None:
+    """Render THUMBNAIL_SIZES in the background for the images among (filename, sha256) pairs."""
+    if thumbnail_backend() is None:
+        return
+    for filename, digest in files:
+        if thumbnail_type(filename):
+            for size in THUMBNAIL_SIZES:
+                submit_thumbnail(digest, size)
+
+@app.route("/files/<int:file_id>/thumbnail", methods=["GET"])
+def file_thumbnail(file_id: int):
+    size = request.args.get("size", THUMBNAIL_SIZES[-1], type=int)
+    if not THUMBNAIL_MIN_SIZE <= size <= THUMBNAIL_MAX_SIZE:
+        return jsonify(error=f"size must be between {THUMBNAIL_MIN_SIZE} and {THUMBNAIL_MAX_SIZE}."), 400
+    conn = get_db()
+    row = conn.execute("SELECT original_filename, content_type, sha256 FROM files WHERE id = ?", (file_id,)).fetchone()
+    if not row:
+        conn.close()
+        abort(404)
+    if not thumbnail_type(row["original_filename"], row["content_type"]):
+        conn.close()
+        return jsonify(error="Thumbnails are only available for images."), 415
+
+    headers = {"Cache-Control": f"public, max-age={THUMBNAIL_MAX_AGE}, immutable"}
+    etag = f"{row['sha256']}-{size}"
+    if request.if_none_match.contains_weak(etag):
+        conn.close()
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    cached = cached_thumbnail(conn, row["sha256"], size)
     conn.close()
+    if cached:
+        THUMBNAIL_REQUESTS.inc(labels=("hit",))
+        data, content_type = cached["data"], cached["content_type"]
+    else:
+        THUMBNAIL_REQUESTS.inc(labels=("miss",))
+        if thumbnail_backend() is None:
+            return jsonify(error="Thumbnails need Pillow or PySide6 on the server."), 501
+        try:
+            rendered = submit_thumbnail(row["sha256"], size).result(timeout=THUMBNAIL_WAIT_SECONDS)
+        except TimeoutError:
+            return jsonify(error="Thumbnail is still being rendered."), 503, {"Retry-After": "1"}
+        except ThumbnailError as exc:
+            return jsonify(error=f"Could not create a thumbnail: {exc}"), 422
+        if rendered is None:
+            abort(404)
+        data, content_type = rendered
+    response = Response(data, content_type=content_type, headers=headers)
+    response.set_etag(etag)
+    return response
 
-def ext_ok(filename: str) -> bool:
-    name = filename.lower()
-    if "." not in name:
-        return False
-    # Allow compound extensions like .tar.gz
-    for ext in ALLOWED_EXTENSIONS:
-        if name.endswith("." + ext):
-            return True
-    return False
+# --------------------------
+# Event stream
+# --------------------------
+_EVENT_NAMES = {"add": "upload", "delete": "delete", "compact": "compaction"}
 
-def sha256_bytes(b: bytes) -> str:
-    return hashlib.sha256(b).hexdigest()
+def _event_frame(row) -> bytes:
+    """One SSE message for a file_changes row joined with its files row."""
+    data = {"seq": row["seq"]}
+    if row["op"] != "compact":
+        data["id"] = row["file_id"]
+    if row["op"] == "add":
+        data["file"] = {"id": row["file_id"], **{name: row[name] for name in FILE_LIST_FIELDS[1:]}}
+    payload = json.dumps(data, separators=(",", ":"))
+    return f"id: {row['seq']}\nevent: {_EVENT_NAMES[row['op']]}\ndata: {payload}\n\n".encode()
+
+def _read_events(conn, since: int, limit: int):
+    """Frames of the log entries after ``since`` as (seq, frame) pairs, oldest first."""
+    rows = conn.execute(
+        f"""
+        SELECT c.seq, c.op, c.file_id, {", ".join("f." + name for name in FILE_LIST_FIELDS[1:])}
+        FROM file_changes c LEFT JOIN files f ON c.op = 'add' AND f.id = c.file_id
+        WHERE c.seq > ? ORDER BY c.seq LIMIT ?
+        """,
+        (since, limit),
+    ).fetchall()
+    # Adds of files that are gone again are left out, as in /api/files/changes
+    return [(r["seq"], _event_frame(r) if r["op"] != "add" or r["original_filename"] is not None else b"") for r in rows]
+
+
+class EventHub:
+    """
+    Per-process fan-out for /api/events. A single thread polls the change log
+    while there are subscribers and hands each new event to all of them:
+    sockets handed over by the prefork server are written from this thread
+    without blocking, so an idle subscriber costs a buffer, not a worker
+    thread; other servers stream from wait_events() on their own threads.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._recent = collections.deque(maxlen=EVENTS_BUFFER)
+        self._listeners = []
+        self._sockets = {}
+        self._closing = []
+        self._waiting = 0
+        self._poll_lock = threading.Lock()
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        conn = get_db()
+        try:
+            self.last_seq = last_change_seq(conn)
+        finally:
+            conn.close()
+        threading.Thread(target=self._run, name="event-hub", daemon=True).start()
+
+    # --- reading ---
+    def frames_since(self, since):
+        """
+        (frames, cursor) for a subscriber that has seen everything up to
+        ``since`` (None: nothing old, only what comes next). Falls back to the
+        log when the buffer does not reach back far enough, and answers with
+        a resync event when the log does not either.
+        """
+        with self._cond:
+            polling = self._sockets or self._waiting
+        if since is None or not polling:
+            # Nobody kept last_seq current, or a new subscriber needs "now"
+            self._poll()
+        with self._cond:
+            if since is None or since >= self.last_seq:
+                return [], self.last_seq if since is None else since
+            if self._recent and since >= self._recent[0][0] - 1:
+                return [frame for seq, frame in self._recent if seq > since], self.last_seq
+        conn = get_db()
+        try:
+            latest = last_change_seq(conn)
+            if since < read_meta(conn, "changes_floor") or since > latest:
+                data = json.dumps({"seq": latest})
+                return [f"id: {latest}\nevent: resync\ndata: {data}\n\n".encode()], latest
+            events = _read_events(conn, since, EVENTS_BUFFER)
+        finally:
+            conn.close()
+        return [frame for _, frame in events], events[-1][0] if events else since
+
+    def wait_events(self, since, timeout: float):
+        """frames_since(), but blocks up to ``timeout`` for something new."""
+        frames, cursor = self.frames_since(since)
+        if frames:
+            return frames, cursor
+        with self._cond:
+            self._waiting += 1
+            try:
+                self._cond.wait_for(lambda: self.last_seq > cursor, timeout)
+            finally:
+                self._waiting -= 1
+        return self.frames_since(cursor)
+
+    def add_listener(self, callback) -> None:
+        """Call ``callback()`` from the hub thread whenever events arrive."""
+        with self._cond:
+            self._listeners.append(callback)
+
+    def hold(self) -> None:
+        """Keep polling for a subscriber that waits through a listener instead of wait_events()."""
+        with self._cond:
+            self._waiting += 1
+
+    def release(self) -> None:
+        with self._cond:
+            self._waiting -= 1
+
+    # --- socket subscribers ---
+    def attach(self, sock: socket.socket, since) -> None:
+        """Take over a connection whose response headers have been sent."""
+        frames, cursor = self.frames_since(since)
+        while cursor < self.last_seq:
+            more, cursor = self.frames_since(cursor)
+            frames += more
+        buffer = bytearray(f"retry: {EVENTS_RETRY_MS}\n\n".encode())
+        for frame in frames:
+            buffer += frame
+        sock.setblocking(False)
+        with self._cond:
+            # Whatever the poller added meanwhile
+            for seq, frame in self._recent:
+                if seq > cursor:
+                    buffer += frame
+            self._sockets[sock] = buffer
+        self._wake()
+
+    def close_subscribers(self) -> None:
+        """Disconnect every socket subscriber, e.g. before a worker exits; clients reconnect elsewhere."""
+        with self._cond:
+            self._closing.extend(self._sockets)
+            self._sockets = {}
+        self._wake()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"sockets": len(self._sockets), "waiting": self._waiting, "last_seq": self.last_seq}
+
+    # --- hub thread ---
+    def _wake(self) -> None:
+        try:
+            self._wake_w.send(b"x")
+        except OSError:
+            pass  # the wake-up pipe is full, so the hub wakes anyway
+
+    def _run(self) -> None:
+        registered = {}
+        next_poll = next_heartbeat = time.monotonic()
+        while True:
+            timeout = max(0.0, min(next_poll, next_heartbeat) - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                if key.fileobj is self._wake_r:
+                    try:
+                        while self._wake_r.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif mask & selectors.EVENT_READ:
+                    try:
+                        gone = key.fileobj.recv(4096) == b""
+                    except BlockingIOError:
+                        gone = False
+                    except OSError:
+                        gone = True
+                    if gone:
+                        self._drop(key.fileobj)
+            with self._cond:
+                closing, self._closing = self._closing, []
+            for sock in closing:
+                self._drop(sock)
+
+            now = time.monotonic()
+            if now >= next_poll:
+                next_poll = now + EVENTS_POLL_INTERVAL
+                with self._cond:
+                    listening = self._sockets or self._waiting
+                if listening:
+                    self._poll()
+                    _pool.release_thread()
+            if now >= next_heartbeat:
+                next_heartbeat = now + EVENTS_HEARTBEAT
+                with self._cond:
+                    for buffer in self._sockets.values():
+                        buffer += b": heartbeat\n\n"
+            self._flush(registered)
+
+    def _poll(self) -> None:
+        with self._poll_lock:
+            conn = get_db()
+            try:
+                events = _read_events(conn, self.last_seq, EVENTS_BUFFER)
+            except sqlite3.Error:
+                return  # busy or mid-migration; try again next round
+            finally:
+                conn.close()
+            if events:
+                self._publish(events)
+
+    def _publish(self, events) -> None:
+        with self._cond:
+            for seq, frame in events:
+                if frame:
+                    self._recent.append((seq, frame))
+                    for buffer in self._sockets.values():
+                        buffer += frame
+            self.last_seq = events[-1][0]
+            self._cond.notify_all()
+            listeners = list(self._listeners)
+            if self._sockets:
+                self._wake()  # polled on a request thread; the hub thread flushes
+        for callback in listeners:
+            callback()
+
+    def _flush(self, registered: dict) -> None:
+        with self._cond:
+            pending = list(self._sockets.items())
+        for sock, buffer in pending:
+            try:
+                with self._cond:
+                    sent = sock.send(buffer) if buffer else 0
+                    del buffer[:sent]
+                    backlog = len(buffer)
+            except BlockingIOError:
+                backlog = len(buffer)
+            except OSError:
+                self._drop(sock)
+                continue
+            if backlog > EVENTS_MAX_BACKLOG:
+                self._drop(sock)
+                continue
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if backlog else 0)
+            if registered.get(sock) != events:
+                if sock in registered:
+                    self._selector.modify(sock, events)
+                else:
+                    self._selector.register(sock, events)
+                registered[sock] = events
+        for sock in [s for s in registered if s not in self._sockets]:
+            registered.pop(sock)
+
+    def _drop(self, sock) -> None:
+        with self._cond:
+            self._sockets.pop(sock, None)
+        try:
+            self._selector.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+_event_hub = None
+_event_hub_pid = None
+_event_hub_lock = threading.Lock()
+
+def event_hub() -> EventHub:
+    """This process's hub, started on first use and again in every forked worker."""
+    global _event_hub, _event_hub_pid
+    with _event_hub_lock:
+        if _event_hub is None or _event_hub_pid != os.getpid():
+            _event_hub = EventHub()
+            _event_hub_pid = os.getpid()
+        return _event_hub
+
+# Thread-held streams: (open, limit); limit None means the server hands sockets off or is a test client
+_thread_streams = {"open": 0, "limit": None}
+_thread_streams_lock = threading.Lock()
+
+def _claim_stream_thread() -> bool:
+    with _thread_streams_lock:
+        if _thread_streams["limit"] is not None and _thread_streams["open"] >= _thread_streams["limit"]:
+            return False
+        _thread_streams["open"] += 1
+        return True
+
+def _release_stream_thread() -> None:
+    with _thread_streams_lock:
+        _thread_streams["open"] -= 1
+
+EVENT_STREAM_HEADERS = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def _last_event_id():
+    value = request.headers.get("Last-Event-ID") or request.args.get("since")
+    return int(value) if value and value.isdigit() else None
+
+@app.route("/api/events", methods=["GET"])
+def api_events():
+    """
+    Server-Sent Events: "upload" (with the file), "delete" and "compaction",
+    each with the change-log sequence number as its id, plus comment
+    heartbeats. Reconnecting with Last-Event-ID (or ?since=) replays what was
+    missed; "resync" means the log no longer reaches back that far. Answers
+    503 when a thread-per-stream server has no thread to spare for it.
+    """
+    since = _last_event_id()
+    hub = event_hub()
+    hand_off = request.environ.get("fileuploader.hand_off")
+    if hand_off is not None:
+        # Prefork server: the socket joins the hub once the headers are out
+        hand_off.append(lambda sock: hub.attach(sock, since))
+        return Response(b"", headers=EVENT_STREAM_HEADERS)
+
+    def stream(cursor):
+        while True:
+            frames, cursor = hub.wait_events(cursor, EVENTS_HEARTBEAT)
+            yield b"".join(frames) if frames else b": heartbeat\n\n"
+
+    # Other servers: this thread streams, mostly asleep in wait_events()
+    if not _claim_stream_thread():
+        retry_after = {"Retry-After": str(max(1, EVENTS_RETRY_MS // 1000))}
+        return jsonify(error="Too many event streams for this server mode."), 503, retry_after
+    try:
+        frames, cursor = hub.frames_since(since)
+    except BaseException:
+        _release_stream_thread()
+        raise
+    retry = f"retry: {EVENTS_RETRY_MS}\n\n".encode()
+    body = ClosingIterator(itertools.chain([retry], frames, stream(cursor)), _release_stream_thread)
+    return Response(body, headers=EVENT_STREAM_HEADERS, direct_passthrough=True)
 
 # --------------------------
 # Routes
@@ -198,7 +2989,7 @@ INDEX_TEMPLATE = """
     </div>
 
     <div class="card" style="margin-top:16px;">
-    <h2>Stored files ({{ files|length }})</h2>
+    <h2>Stored files ({{ total }})</h2>
     {% if files %}
     <div class="table-wrap">
         <table>
@@ -233,6 +3024,10 @@ INDEX_TEMPLATE = """
         </tbody>
         </table>
     </div>
+    <p>
+        {% if after_id %}<a href="{{ url_for('index') }}">Newest files</a>{% endif %}
+        {% if next_after_id %}<a href="{{ url_for('index', after_id=next_after_id) }}">Older files</a>{% endif %}
+    </p>
     {% else %}
         <div class="muted">Nothing here yet. Upload something.</div>
     {% endif %}
@@ -242,20 +3037,43 @@ INDEX_TEMPLATE = """
 </html>
 """
 
+# Compiled once; every request only renders
+INDEX_PAGE = app.jinja_env.from_string(INDEX_TEMPLATE)
+
 @app.route("/", methods=["GET"])
 def index():
+    """One keyset page of INDEX_PAGE_SIZE rows, newest first, streamed while it renders."""
+    after_id = request.args.get("after_id", type=int)
     conn = get_db()
-    rows = conn.execute("SELECT id, original_filename, content_type, size_bytes, sha256, uploaded_at FROM files ORDER BY id DESC").fetchall()
+    if after_id is None:
+        rows = conn.execute(
+            "SELECT id, original_filename, content_type, size_bytes, sha256, uploaded_at FROM files ORDER BY id DESC LIMIT ?",
+            (INDEX_PAGE_SIZE + 1,),
+        ).fetchall()
+    else:
+        rows = conn.execute(
+            "SELECT id, original_filename, content_type, size_bytes, sha256, uploaded_at FROM files WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (after_id, INDEX_PAGE_SIZE + 1),
+        ).fetchall()
+    total = read_meta(conn, "file_count")
     conn.close()
-    return render_template_string(
-        INDEX_TEMPLATE,
+    # Pop flashes now: the session cookie is sent before the body is rendered
+    get_flashed_messages()
+    return Response(stream_template(
+        INDEX_PAGE,
         app_name=APP_NAME,
-        files=rows,
+        files=rows[:INDEX_PAGE_SIZE],
+        total=total,
+        after_id=after_id,
+        next_after_id=rows[INDEX_PAGE_SIZE - 1]["id"] if len(rows) > INDEX_PAGE_SIZE else None,
         max_size_mb=app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024),
-    )
+    ), content_type="text/html; charset=utf-8")
 
 @app.route("/upload", methods=["POST"])
 def upload():
+    if _quota_precheck() is not None:
+        flash("Storage quota exceeded; nothing was uploaded.")
+        return redirect(url_for("index"))
     if "files" not in request.files:
         flash("No file part in the request.")
         return redirect(url_for("index"))
@@ -264,79 +3082,159 @@ def upload():
         flash("No files selected.")
         return redirect(url_for("index"))
 
-    saved_count = 0
-    rejected = []
-    conn = get_db()
-
-    for f in files:
-        if f.filename == "":
-            continue
-        filename = secure_filename(f.filename)
-        if not filename or not ext_ok(filename):
-            rejected.append(f.filename or "(unnamed)")
-            continue
+    report = ingest_files(files)
 
-        data = f.read()
-        if not data:
-            rejected.append(filename + " (empty)")
-            continue
+    if report["saved"]:
+        flash(f"Uploaded {len(report['saved'])} file(s) successfully.")
+    if report["deduplicated"]:
+        bytes_saved = sum(d["bytes_saved"] for d in report["deduplicated"])
+        flash(f"{len(report['deduplicated'])} file(s) were already stored; saved {bytes_saved:,} bytes.")
+    if report["rejected"]:
+        flash("Rejected (type/empty/quota): " + ", ".join(report["rejected"]))
+    if report["failed"]:
+        flash("Failed: " + ", ".join(f"{f['filename']} ({f['error']})" for f in report["failed"]))
+    return redirect(url_for("index"))
 
-        digest = sha256_bytes(data)
-        stored_name = f"{digest[:12]}_{filename}"
-        uploaded_at = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+def _attachment_disposition(filename: str) -> str:
+    try:
+        filename.encode("ascii")
+        return f'attachment; filename="{filename}"'
+    except UnicodeEncodeError:
+        return f"attachment; filename*=UTF-8''{quote(filename)}"
 
-        conn.execute(
-            """
-            INSERT INTO files (original_filename, stored_filename, content_type, size_bytes, sha256, uploaded_at, data)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                filename,
-                stored_name,
-                f.mimetype,
-                len(data),
-                digest,
-                uploaded_at,
-                sqlite3.Binary(data),
-            ),
-        )
-        saved_count += 1
+def _requested_ranges(length: int, etag: str):
+    """
+    Return the satisfiable (start, stop) byte ranges of the request, None to
+    send the whole payload, or [] if no requested range can be satisfied.
+    """
+    rng = request.range
+    if rng is None or rng.units != "bytes" or len(rng.ranges) > MAX_BYTE_RANGES:
+        return None
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None:
+        return None
+    ranges = []
+    for start, stop in rng.ranges:
+        if start < 0:
+            start, stop = max(length + start, 0), length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            ranges.append((start, stop))
+    return ranges
 
-    conn.commit()
-    conn.close()
+def _iter_range(payload, start: int, stop: int):
+    payload.seek(start)
+    remaining = stop - start
+    while remaining > 0:
+        chunk = payload.read(min(INGEST_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
 
-    if saved_count:
-        flash(f"Uploaded {saved_count} file(s) successfully.")
-    if rejected:
-        flash("Rejected (type/empty): " + ", ".join(rejected))
-    return redirect(url_for("index"))
+def _iter_multipart_ranges(payload, parts, boundary: str):
+    for head, start, stop in parts:
+        yield head
+        yield from _iter_range(payload, start, stop)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
 
 @app.route("/files/<int:file_id>/download", methods=["GET"])
 def download_file(file_id: int):
     conn = get_db()
-    row = conn.execute("SELECT original_filename, content_type, data FROM files WHERE id = ?", (file_id,)).fetchone()
-    conn.close()
+    row = conn.execute(
+        """
+        SELECT f.original_filename, f.content_type, f.size_bytes, f.sha256, b.encoding, b.stored_bytes
+        FROM files f LEFT JOIN blobs b ON b.sha256 = f.sha256
+        WHERE f.id = ?
+        """,
+        (file_id,),
+    ).fetchone()
     if not row:
+        conn.close()
         abort(404)
-    # Stream from memory; for very large files, consider StreamingResponse patterns
-    return send_file(
-        BytesIO(row["data"]),
-        as_attachment=True,
-        download_name=row["original_filename"],
-        mimetype=row["content_type"] or "application/octet-stream",
-        max_age=0,
-        etag=False,
-        conditional=False,
-        last_modified=None
-    )
+
+    etag = row["sha256"]
+    length = row["size_bytes"]
+    mimetype = row["content_type"] or "application/octet-stream"
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "no-cache",
+        "Content-Disposition": _attachment_disposition(row["original_filename"]),
+    }
+    codec = COMPRESSION_CODECS.get(row["encoding"] or "identity")
+    content_encoding = None
+    if codec is not None:
+        headers["Vary"] = "Accept-Encoding"
+        if codec.http_token and request.accept_encodings[codec.http_token]:
+            # Send the stored bytes as they are; ranges then apply to the encoded representation
+            content_encoding = codec.http_token
+            headers["Content-Encoding"] = content_encoding
+            etag = f"{row['sha256']}-{content_encoding}"
+            length = row["stored_bytes"]
+    if request.if_none_match.contains_weak(etag):
+        conn.close()
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    ranges = _requested_ranges(length, etag)
+    if ranges == []:
+        conn.close()
+        headers["Content-Range"] = f"bytes */{length}"
+        return Response(status=416, headers=headers)
+
+    payload = open_payload(conn, row["sha256"], decode=content_encoding is None)
+    status = 206
+    if ranges is None:
+        status = 200
+        body = wrap_file(request.environ, payload, INGEST_CHUNK_SIZE)
+        content_length = length
+    elif len(ranges) == 1:
+        start, stop = ranges[0]
+        headers["Content-Range"] = f"bytes {start}-{stop - 1}/{length}"
+        body = _iter_range(payload, start, stop)
+        content_length = stop - start
+    else:
+        boundary = os.urandom(12).hex()
+        parts = [
+            (
+                f"--{boundary}\r\nContent-Type: {mimetype}\r\n"
+                f"Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n".encode(),
+                start,
+                stop,
+            )
+            for start, stop in ranges
+        ]
+        body = _iter_multipart_ranges(payload, parts, boundary)
+        content_length = sum(len(head) + (stop - start) + 2 for head, start, stop in parts) + len(boundary) + 6
+        mimetype = f"multipart/byteranges; boundary={boundary}"
+
+    # Passthrough bodies skip Response.close(), so cleanup rides on the iterator
+    closers = [payload.close]
+    if not hasattr(payload, "fileno"):
+        # Payloads read through SQLite are streamed after the request context is gone
+        conn.detach()
+        closers.append(conn.close)
+    else:
+        conn.close()
+    if status == 206 or len(closers) > 1:
+        body = ClosingIterator(body, closers)
+    response = Response(body, status=status, content_type=mimetype, headers=headers, direct_passthrough=True)
+    response.content_length = content_length
+    response.set_etag(etag)
+    return response
 
 @app.route("/files/<int:file_id>/delete", methods=["POST"])
 def delete_file(file_id: int):
     conn = get_db()
-    cur = conn.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    deleted = remove_file(conn, file_id)
     conn.commit()
     conn.close()
-    if cur.rowcount:
+    if deleted:
         flash(f"Deleted file #{file_id}.")
     else:
         flash(f"File #{file_id} not found.")
@@ -347,84 +3245,912 @@ def delete_file(file_id: int):
 # --------------------------
 @app.route("/api/upload", methods=["POST"])
 def api_upload():
+    over_quota = _quota_precheck()
+    if over_quota is not None:
+        return over_quota
     if "files" not in request.files:
         return jsonify(error="No file part in the request."), 400
     files = request.files.getlist("files")
     if not files:
         return jsonify(error="No files selected."), 400
 
-    saved_count = 0
-    rejected = []
+    return jsonify(upload_summary(ingest_files(files)))
+
+def _requested_fields():
+    """Parse ?fields= into a column list (id first); returns (fields, error_response)."""
+    if not request.args.get("fields"):
+        return list(FILE_LIST_FIELDS), None
+    requested = [f.strip() for f in request.args["fields"].split(",") if f.strip()]
+    unknown = sorted(set(requested) - set(FILE_LIST_FIELDS))
+    if unknown:
+        return None, (jsonify(error="Unknown fields: " + ", ".join(unknown)), 400)
+    return ["id"] + [f for f in requested if f != "id"], None
+
+@app.route("/api/files", methods=["GET"])
+def api_files():
+    """
+    Newest-first listing with keyset pagination: pass next_after_id back as
+    after_id for older rows, prev_before_id as before_id for newer ones. The
+    ETag is the catalogue generation, so If-None-Match is answered, and
+    repeated pages are served, without a query.
+    """
+    etag = catalogue_etag()
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    key = tuple(sorted(request.args.items(multi=True)))
+    body = _list_cache_get(etag, key)
+    if body is None:
+        body = _list_page()
+        if not isinstance(body, bytes):
+            return body
+        _list_cache_put(etag, key, body)
+    response = Response(body, content_type="application/json", headers={"Cache-Control": "no-cache"})
+    response.set_etag(etag)
+    return response
+
+def _list_page():
+    """The serialized /api/files page for the current request, or an error response."""
+    limit = max(1, min(request.args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
+    after_id = request.args.get("after_id", type=int)
+    before_id = request.args.get("before_id", type=int)
+    if after_id is not None and before_id is not None:
+        return jsonify(error="Use either after_id or before_id, not both."), 400
+    fields, error = _requested_fields()
+    if error:
+        return error
+    columns = ", ".join(fields)
+
     conn = get_db()
+    # Read first: replaying changes from here may repeat some, never miss one
+    change_seq = last_change_seq(conn)
+    if before_id is not None:
+        rows = conn.execute(
+            f"SELECT {columns} FROM files WHERE id > ? ORDER BY id ASC LIMIT ?", (before_id, limit + 1)
+        ).fetchall()
+        has_newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        has_older = bool(rows) and conn.execute(
+            "SELECT 1 FROM files WHERE id < ? LIMIT 1", (rows[-1]["id"],)
+        ).fetchone() is not None
+    else:
+        if after_id is None:
+            rows = conn.execute(f"SELECT {columns} FROM files ORDER BY id DESC LIMIT ?", (limit + 1,)).fetchall()
+        else:
+            rows = conn.execute(
+                f"SELECT {columns} FROM files WHERE id < ? ORDER BY id DESC LIMIT ?", (after_id, limit + 1)
+            ).fetchall()
+        has_older = len(rows) > limit
+        rows = rows[:limit]
+        has_newer = after_id is not None and bool(rows) and conn.execute(
+            "SELECT 1 FROM files WHERE id > ? LIMIT 1", (rows[0]["id"],)
+        ).fetchone() is not None
+    total = read_meta(conn, "file_count")
+    conn.close()
 
-    for f in files:
-        if f.filename == "":
-            continue
-        filename = secure_filename(f.filename)
-        if not filename or not ext_ok(filename):
-            rejected.append(f.filename or "(unnamed)")
-            continue
+    files = [{name: r[name] for name in fields} for r in rows]
+    return jsonify(
+        files=files,
+        total=total,
+        limit=limit,
+        next_after_id=rows[-1]["id"] if has_older else None,
+        prev_before_id=rows[0]["id"] if has_newer else None,
+        change_seq=change_seq,
+    ).get_data()
 
-        data = f.read()
-        if not data:
-            rejected.append((filename or "(unnamed)") + " (empty)")
-            continue
+_list_cache = collections.OrderedDict()
+_list_cache_etag = None
+_list_cache_lock = threading.Lock()
 
-        digest = sha256_bytes(data)
-        stored_name = f"{digest[:12]}_{filename}"
-        uploaded_at = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+def _list_cache_get(etag: str, key):
+    with _list_cache_lock:
+        if etag != _list_cache_etag:
+            return None
+        body = _list_cache.get(key)
+        if body is not None:
+            _list_cache.move_to_end(key)
+        return body
 
-        conn.execute(
-            """
-            INSERT INTO files (original_filename, stored_filename, content_type, size_bytes, sha256, uploaded_at, data)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                filename,
-                stored_name,
-                f.mimetype,
-                len(data),
-                digest,
-                uploaded_at,
-                sqlite3.Binary(data),
-            ),
-        )
-        saved_count += 1
+def _list_cache_put(etag: str, key, body: bytes) -> None:
+    global _list_cache_etag
+    with _list_cache_lock:
+        if etag != _list_cache_etag:
+            # A new generation invalidates every page at once
+            _list_cache.clear()
+            _list_cache_etag = etag
+        _list_cache[key] = body
+        while len(_list_cache) > LIST_CACHE_ENTRIES:
+            _list_cache.popitem(last=False)
 
-    conn.commit()
+def _encode_cursor(value, file_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, file_id]).encode()).decode()
+
+def _decode_cursor(token: str):
+    try:
+        value, file_id = json.loads(base64.urlsafe_b64decode(token.encode()))
+        return value, int(file_id)
+    except (ValueError, TypeError):
+        return None
+
+def _search_filters(conn, args):
+    """Translate the /api/files/search filter arguments into (join, where clauses, params)."""
+    join, where, params = "", [], []
+    tokens = re.findall(r"\w+", args.get("q", ""))
+    if tokens and fts_enabled(conn):
+        join = "JOIN files_fts ON files_fts.rowid = files.id"
+        where.append("files_fts MATCH ?")
+        params.append(" ".join(f'"{token}"*' for token in tokens))
+    elif tokens:
+        for token in tokens:
+            where.append("files.original_filename LIKE ?")
+            params.append(f"%{token}%")
+    content_type = args.get("content_type")
+    if content_type and content_type.endswith("/"):
+        # "image/" matches every image type through the index range
+        where.append("files.content_type >= ? AND files.content_type < ?")
+        params += [content_type, content_type[:-1] + chr(ord("/") + 1)]
+    elif content_type:
+        where.append("files.content_type = ?")
+        params.append(content_type)
+    for arg, clause, kind in (
+        ("size_min", "files.size_bytes >= ?", int),
+        ("size_max", "files.size_bytes <= ?", int),
+        ("uploaded_from", "files.uploaded_at >= ?", str),
+        ("uploaded_to", "files.uploaded_at <= ?", str),
+    ):
+        value = args.get(arg, type=kind)
+        if value is not None:
+            where.append(clause)
+            params.append(value)
+    return join, where, params
+
+@app.route("/api/files/changes", methods=["GET"])
+def api_file_changes():
+    """
+    Adds and deletes after ?since=<seq>, oldest first. Apply them in order
+    (an add is an upsert, a delete a removal) and pass next_since back. When
+    the log no longer reaches back to the cursor the answer is resync=true:
+    reload /api/files and continue from its change_seq.
+    """
+    since = request.args.get("since", 0, type=int)
+    limit = max(1, min(request.args.get("limit", CHANGES_PAGE_SIZE, type=int), CHANGES_PAGE_SIZE))
+    conn = get_db()
+    latest = last_change_seq(conn)
+    if since < read_meta(conn, "changes_floor") or since > latest:
+        conn.close()
+        return jsonify(resync=True, changes=[], next_since=latest, has_more=False)
+    rows = conn.execute(
+        f"""
+        SELECT c.seq, c.op, c.file_id, {", ".join("f." + name for name in FILE_LIST_FIELDS[1:])}
+        FROM file_changes c LEFT JOIN files f ON c.op = 'add' AND f.id = c.file_id
+        WHERE c.seq > ? ORDER BY c.seq LIMIT ?
+        """,
+        (since, limit + 1),
+    ).fetchall()
     conn.close()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    changes = []
+    for r in rows:
+        if r["op"] == "delete":
+            changes.append({"seq": r["seq"], "op": "delete", "id": r["file_id"]})
+        elif r["original_filename"] is not None:
+            # An add whose file is gone again is skipped; its delete follows
+            changes.append({
+                "seq": r["seq"], "op": "add", "id": r["file_id"],
+                "file": {"id": r["file_id"], **{name: r[name] for name in FILE_LIST_FIELDS[1:]}},
+            })
+    return jsonify(
+        resync=False,
+        changes=changes,
+        next_since=rows[-1]["seq"] if rows else since,
+        has_more=has_more,
+    )
 
-    return jsonify(saved=saved_count, rejected=rejected)
+@app.route("/api/files/search", methods=["GET"])
+def api_search_files():
+    """
+    Filename search with structured filters. ``q`` matches filename tokens by
+    prefix through FTS5; ``content_type`` is an exact type or a "major/"
+    prefix; ``size_min``/``size_max`` and ``uploaded_from``/``uploaded_to``
+    bound ranges. Sorted by ``sort``/``order`` and paged with ``cursor``.
+    """
+    args = request.args
+    fields, error = _requested_fields()
+    if error:
+        return error
+    sort = args.get("sort", "id")
+    order = args.get("order", "desc").lower()
+    if sort not in SEARCH_SORTS or order not in ("asc", "desc"):
+        return jsonify(error=f"sort must be one of {', '.join(sorted(SEARCH_SORTS))}; order asc or desc."), 400
+    limit = max(1, min(args.get("limit", DEFAULT_PAGE_SIZE, type=int), MAX_PAGE_SIZE))
 
-@app.route("/api/files", methods=["GET"])
-def api_files():
     conn = get_db()
+    join, where, params = _search_filters(conn, args)
+    if args.get("cursor"):
+        cursor = _decode_cursor(args["cursor"])
+        if cursor is None:
+            conn.close()
+            return jsonify(error="Invalid cursor."), 400
+        op = "<" if order == "desc" else ">"
+        if sort == "id":
+            where.append(f"files.id {op} ?")
+            params.append(cursor[1])
+        else:
+            where.append(f"(files.{sort}, files.id) {op} (?, ?)")
+            params += list(cursor)
+
+    selected = fields if sort in fields else fields + [sort]
+    sql = (
+        f"SELECT {', '.join('files.' + f for f in selected)} FROM files {join}"
+        + (" WHERE " + " AND ".join(where) if where else "")
+        + f" ORDER BY files.{sort} {order}, files.id {order} LIMIT ?"
+    )
+    rows = conn.execute(sql, params + [limit + 1]).fetchall()
+    conn.close()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    return jsonify(
+        files=[{name: r[name] for name in fields} for r in rows],
+        limit=limit,
+        next_cursor=_encode_cursor(rows[-1][sort], rows[-1]["id"]) if has_more else None,
+    )
+
+class _ZipSpool:
+    """Write-only, unseekable target for ZipFile; the archive generator drains it after every write."""
+
+    def __init__(self):
+        self._parts = []
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts.clear()
+        return data
+
+
+def _archive_name(filename: str, taken: set) -> str:
+    name, n = filename, 1
+    stem, dot, ext = filename.rpartition(".")
+    while name in taken:
+        n += 1
+        name = f"{stem} ({n}).{ext}" if dot and stem else f"{filename} ({n})"
+    taken.add(name)
+    return name
+
+def _iter_archive(conn, rows):
+    """
+    Stream a ZIP of ``rows`` straight from storage. Entries are written with
+    data descriptors since the target cannot seek; ZIP64 records are added
+    for entries and archives that need them.
+    """
+    spool = _ZipSpool()
+    taken = set()
+    with zipfile.ZipFile(spool, "w", allowZip64=True) as zf:
+        for row in rows:
+            try:
+                date_time = datetime.fromisoformat(row["uploaded_at"].rstrip("Z")).timetuple()[:6]
+            except ValueError:
+                date_time = (1980, 1, 1, 0, 0, 0)
+            info = zipfile.ZipInfo(_archive_name(row["original_filename"], taken), date_time=date_time)
+            info.file_size = row["size_bytes"]
+            # Types COMPRESSION_POLICY skips are already compressed; don't deflate them again
+            compressible = compression_codec(row["original_filename"], row["content_type"]) is not None
+            info.compress_type = zipfile.ZIP_DEFLATED if compressible else zipfile.ZIP_STORED
+            with open_payload(conn, row["sha256"], decode=True) as payload, zf.open(info, "w") as entry:
+                for chunk in _read_chunks(payload):
+                    entry.write(chunk)
+                    data = spool.drain()
+                    if data:
+                        yield data
+            yield spool.drain()
+    yield spool.drain()
+
+@app.route("/api/files/archive", methods=["GET"])
+def api_files_archive():
+    """
+    Download several files as one ZIP built while it is sent. Select them
+    with ``ids=1,2,3`` or with the filters of /api/files/search.
+    """
+    args = request.args
+    conn = get_db()
+    if "ids" in args:
+        try:
+            ids = [int(part) for part in args["ids"].split(",") if part.strip()]
+        except ValueError:
+            conn.close()
+            return jsonify(error="ids must be a comma-separated list of integers."), 400
+        if len(ids) > ARCHIVE_MAX_FILES:
+            conn.close()
+            return jsonify(error=f"At most {ARCHIVE_MAX_FILES} files per archive."), 400
+        join, where, params = "", [f"files.id IN ({', '.join('?' * len(ids))})"], ids
+    else:
+        join, where, params = _search_filters(conn, args)
+    if not where or not params:
+        conn.close()
+        return jsonify(error="Select files with ids= or a search filter."), 400
     rows = conn.execute(
-        "SELECT id, original_filename, content_type, size_bytes, sha256, uploaded_at FROM files ORDER BY id DESC"
+        f"""
+        SELECT files.id, files.original_filename, files.content_type, files.size_bytes, files.sha256, files.uploaded_at
+        FROM files {join} WHERE {' AND '.join(where)} ORDER BY files.id LIMIT ?
+        """,
+        params + [ARCHIVE_MAX_FILES + 1],
     ).fetchall()
+    if not rows:
+        conn.close()
+        return jsonify(error="No matching files."), 404
+    if len(rows) > ARCHIVE_MAX_FILES:
+        conn.close()
+        return jsonify(error=f"At most {ARCHIVE_MAX_FILES} files per archive."), 400
+
+    # The body is generated after the request context is gone; the connection
+    # goes back when the response is closed, even if the body is never started
+    conn.detach()
+    return Response(
+        ClosingIterator(_iter_archive(conn, rows), conn.close),
+        mimetype="application/zip",
+        headers={"Content-Disposition": _attachment_disposition((secure_filename(args.get("name", "")) or "files") + ".zip")},
+    )
+
+@app.route("/api/db/pool", methods=["GET"])
+def api_db_pool():
+    return jsonify(pool_stats())
+
+# --------------------------
+# Resumable upload sessions
+# --------------------------
+_last_session_gc = 0.0
+
+def _session_path(session_id: str) -> Path:
+    return STAGING_DIR / "sessions" / f"{session_id}.part"
+
+def _session_state(conn, session):
+    """Session as JSON; "received" and "missing" are [first, last] chunk index ranges."""
+    total = -(-session["size_bytes"] // session["chunk_size"])
+    received, missing, expected = [], [], 0
+    for r in conn.execute("SELECT idx FROM upload_session_chunks WHERE session_id = ? ORDER BY idx", (session["id"],)):
+        idx = r["idx"]
+        if received and received[-1][1] == idx - 1:
+            received[-1][1] = idx
+        else:
+            received.append([idx, idx])
+        if idx > expected:
+            missing.append([expected, idx - 1])
+        expected = idx + 1
+    if expected < total:
+        missing.append([expected, total - 1])
+    return {
+        "session_id": session["id"],
+        "filename": session["original_filename"],
+        "size_bytes": session["size_bytes"],
+        "chunk_size": session["chunk_size"],
+        "chunk_count": total,
+        "received": received,
+        "missing": missing,
+        "expires_at": datetime.utcfromtimestamp(session["updated_at"] + UPLOAD_SESSION_TTL).isoformat(timespec="seconds") + "Z",
+    }
+
+def gc_upload_sessions(conn, now: float = None) -> int:
+    """Drop sessions idle for longer than UPLOAD_SESSION_TTL and their part files."""
+    cutoff = (now or time.time()) - UPLOAD_SESSION_TTL
+    expired = [r["id"] for r in conn.execute("SELECT id FROM upload_sessions WHERE updated_at < ?", (cutoff,))]
+    for session_id in expired:
+        conn.execute("DELETE FROM upload_session_chunks WHERE session_id = ?", (session_id,))
+        conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+        try:
+            _session_path(session_id).unlink()
+        except FileNotFoundError:
+            pass
+    conn.commit()
+    return len(expired)
+
+def _maybe_gc_upload_sessions(conn) -> None:
+    global _last_session_gc
+    now = time.time()
+    if now - _last_session_gc > 60:
+        _last_session_gc = now
+        gc_upload_sessions(conn, now)
+
+@app.route("/api/uploads", methods=["POST"])
+def api_create_upload_session():
+    body = request.get_json(silent=True) or {}
+    filename = secure_filename(body.get("filename") or "")
+    size = body.get("size")
+    if not filename or not ext_ok(filename):
+        return jsonify(error="File type not allowed."), 400
+    if not isinstance(size, int) or size <= 0 or size > MAX_SESSION_BYTES:
+        return jsonify(error=f"size must be a positive integer of at most {MAX_SESSION_BYTES} bytes."), 400
+    chunk_size = body.get("chunk_size") or UPLOAD_CHUNK_SIZE
+    if not isinstance(chunk_size, int) or not 0 < chunk_size <= app.config["MAX_CONTENT_LENGTH"]:
+        return jsonify(error="chunk_size must fit in a single request."), 400
+    min_chunk = min(size, max(UPLOAD_MIN_CHUNK_SIZE, -(-size // MAX_SESSION_CHUNKS)))
+    if chunk_size < min_chunk:
+        return jsonify(error=f"chunk_size must be at least {min_chunk} bytes for this size."), 400
+    expected = (body.get("sha256") or "").lower() or None
+
+    conn = get_db()
+    _maybe_gc_upload_sessions(conn)
+    reason = quota_rejection(conn, body.get("content_type"), size) if quotas_enabled() else None
+    if reason is not None:
+        conn.close()
+        return jsonify(error=f"Upload refused: {reason}."), 507
+    session_id = secrets.token_hex(16)
+    path = _session_path(session_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "wb") as fh:
+        fh.truncate(size)
+    now = time.time()
+    conn.execute(
+        """
+        INSERT INTO upload_sessions (id, original_filename, content_type, size_bytes, chunk_size, expected_sha256, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (session_id, filename, body.get("content_type"), size, chunk_size, expected, now, now),
+    )
+    conn.commit()
+    session = conn.execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+    state = _session_state(conn, session)
     conn.close()
-    files = [
-        {
-            "id": r["id"],
-            "original_filename": r["original_filename"],
-            "content_type": r["content_type"],
-            "size_bytes": r["size_bytes"],
-            "sha256": r["sha256"],
-            "uploaded_at": r["uploaded_at"],
-        }
-        for r in rows
-    ]
-    return jsonify(files=files)
+    return jsonify(state), 201
+
+
+@app.route("/api/uploads/<session_id>", methods=["GET"])
+def api_upload_session_status(session_id: str):
+    conn = get_db()
+    session = conn.execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+    if not session:
+        conn.close()
+        return jsonify(error="Unknown or expired upload session."), 404
+    state = _session_state(conn, session)
+    conn.close()
+    return jsonify(state)
+
+@app.route("/api/uploads/<session_id>", methods=["PUT"])
+def api_upload_session_chunk(session_id: str):
+    """Store one chunk; ?offset= must lie on the session's chunk grid."""
+    conn = get_db()
+    session = conn.execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+    if not session:
+        conn.close()
+        return jsonify(error="Unknown or expired upload session."), 404
+    offset = request.args.get("offset", type=int)
+    chunk_size = session["chunk_size"]
+    if offset is None or offset < 0 or offset % chunk_size or offset >= session["size_bytes"]:
+        conn.close()
+        return jsonify(error="offset must be a multiple of chunk_size inside the file."), 400
+    expected_len = min(chunk_size, session["size_bytes"] - offset)
+    if request.content_length is not None and request.content_length != expected_len:
+        conn.close()
+        return jsonify(error=f"Chunk at offset {offset} must be {expected_len} bytes."), 400
+
+    written = 0
+    # Parallel chunks write disjoint ranges of the part file; a plain
+    # seek+write keeps this portable (os.pwrite does not exist on Windows)
+    with open(_session_path(session_id), "r+b") as fh:
+        fh.seek(offset)
+        while written < expected_len:
+            chunk = request.stream.read(min(INGEST_CHUNK_SIZE, expected_len - written))
+            if not chunk:
+                break
+            if offset == 0 and written == 0:
+                rejection = content_rejection(session["original_filename"], chunk)
+                if rejection is not None:
+                    conn.close()
+                    return jsonify(error=f"Chunk rejected: {rejection}."), 415
+            fh.write(chunk)
+            written += len(chunk)
+    if written != expected_len or request.stream.read(1):
+        conn.close()
+        return jsonify(error=f"Chunk at offset {offset} must be {expected_len} bytes."), 400
+
+    conn.execute(
+        "INSERT OR IGNORE INTO upload_session_chunks (session_id, idx) VALUES (?, ?)",
+        (session_id, offset // chunk_size),
+    )
+    conn.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (time.time(), session_id))
+    conn.commit()
+    state = _session_state(conn, session)
+    conn.close()
+    return jsonify(state)
+
+@app.route("/api/uploads/<session_id>/complete", methods=["POST"])
+def api_complete_upload_session(session_id: str):
+    conn = get_db()
+    session = conn.execute("SELECT * FROM upload_sessions WHERE id = ?", (session_id,)).fetchone()
+    if not session:
+        conn.close()
+        return jsonify(error="Unknown or expired upload session."), 404
+    state = _session_state(conn, session)
+    if state["missing"]:
+        conn.close()
+        return jsonify(error="Upload is incomplete.", missing=state["missing"]), 409
+
+    # Server-side verification: hash the assembled file in one streaming pass
+    try:
+        sink = IngestSink.from_staged(_session_path(session_id), session["original_filename"], session["content_type"])
+    except FileNotFoundError:
+        conn.close()  # a concurrent complete call stored it meanwhile
+        return jsonify(error="Unknown or expired upload session."), 404
+    expected = session["expected_sha256"]
+    if expected and expected != sink.sha256:
+        conn.close()
+        return jsonify(error="sha256 mismatch.", expected=expected, actual=sink.sha256), 422
+    # As in ingest_files(): the CPU-heavy part runs before the write lock is taken
+    codec = prepare_payload(conn, sink, session["original_filename"], session["content_type"])
+    if codec is not None:
+        compress_sink(sink, codec)
+    elif needs_split(conn, sink):
+        split_payload(sink)
+
+    # Claim the session under the write lock: of concurrent or retried calls
+    # only one gets to store the file, the others find the row gone
+    conn.execute("BEGIN IMMEDIATE")
+    if not conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,)).rowcount:
+        conn.rollback()
+        conn.close()
+        sink.drop_encoded()
+        return jsonify(error="Unknown or expired upload session."), 404
+    conn.execute("DELETE FROM upload_session_chunks WHERE session_id = ?", (session_id,))
+    if quotas_enabled():
+        reason = quota_rejection(conn, session["content_type"], sink.size)
+        if reason is not None:
+            # Gives the session back with its part file; it can be completed once there is room
+            conn.rollback()
+            conn.close()
+            sink.drop_encoded()
+            return jsonify(error=f"Upload refused: {reason}."), 507
+    file_id, deduplicated = store_upload(conn, sink, session["original_filename"], session["content_type"])
+    conn.commit()
+    conn.close()
+    sink.close()
+    queue_thumbnails([(session["original_filename"], sink.sha256)])
+    return jsonify(id=file_id, sha256=sink.sha256, size_bytes=sink.size, deduplicated=deduplicated)
+
+@app.route("/api/uploads/<session_id>", methods=["DELETE"])
+def api_abort_upload_session(session_id: str):
+    conn = get_db()
+    cur = conn.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+    conn.execute("DELETE FROM upload_session_chunks WHERE session_id = ?", (session_id,))
+    conn.commit()
+    conn.close()
+    try:
+        _session_path(session_id).unlink()
+    except FileNotFoundError:
+        pass
+    if not cur.rowcount:
+        return jsonify(error="Unknown or expired upload session."), 404
+    return jsonify(deleted=session_id)
+
+# --------------------------
+# Production serving
+# --------------------------
+class _KeepAliveHandler(WSGIRequestHandler):
+    """
+    HTTP/1.1 handler that keeps connections alive. Werkzeug's run_wsgi()
+    closes every connection because it cannot tell where an unread request
+    body ends; here the body is read through a LimitedStream, so whatever the
+    application left unread is skipped and the next request line is found.
+    Idle connections time out after KEEPALIVE_TIMEOUT and a draining server
+    closes them after the current response.
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE_TIMEOUT
+
+    def run_wsgi(self):
+        if self.headers.get("Expect", "").lower().strip() == "100-continue":
+            self.wfile.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        environ = self.make_environ()
+        # A view may append a callable here to take over the socket (see api_events)
+        hand_off = environ["fileuploader.hand_off"] = []
+        body = None
+        if not environ.get("wsgi.input_terminated"):
+            body = environ["wsgi.input"] = LimitedStream(self.rfile, int(environ.get("CONTENT_LENGTH") or 0))
+        response = {}
+
+        def write(data: bytes) -> None:
+            if "chunked" not in response:
+                code, _, reason = response["status"].partition(" ")
+                code = int(code)
+                self.send_response(code, reason)
+                keys = set()
+                for key, value in response["headers"]:
+                    if hand_off and key.lower() == "content-length":
+                        continue  # the body goes on after the handler returns
+                    self.send_header(key, value)
+                    keys.add(key.lower())
+                unsized = not (
+                    "content-length" in keys or environ["REQUEST_METHOD"] == "HEAD" or code < 200 or code in (204, 304)
+                    or hand_off
+                )
+                # HTTP/1.0 clients don't know chunked framing: the body ends where the connection does
+                response["chunked"] = unsized and self.request_version == "HTTP/1.1"
+                if response["chunked"]:
+                    self.send_header("Transfer-Encoding", "chunked")
+                elif unsized:
+                    self.close_connection = True
+                if body is None or self.server.draining or hand_off or self.close_connection:
+                    # Chunked request bodies are not drained; don't reuse those connections
+                    self.send_header("Connection", "close")
+                self.end_headers()
+            if data:
+                if response["chunked"]:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                else:
+                    self.wfile.write(data)
+            self.wfile.flush()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and "chunked" in response:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"], response["headers"] = status, headers
+            return write
+
+        try:
+            app_iter = self.server.app(environ, start_response)
+            try:
+                for data in app_iter:
+                    write(data)
+                if "chunked" not in response:
+                    write(b"")
+                if response["chunked"]:
+                    self.wfile.write(b"0\r\n\r\n")
+            finally:
+                if hasattr(app_iter, "close"):
+                    app_iter.close()
+            if hand_off and response["status"].startswith("200"):
+                # The stream goes on without this thread; the server must not close the socket
+                self.close_connection = True
+                self.server.handed_off.add(self.request)
+                hand_off[0](self.request)
+                return
+        except (ConnectionError, socket.timeout) as exc:
+            self.connection_dropped(exc, environ)
+            self.close_connection = True
+            return
+        except Exception:
+            self.close_connection = True
+            self.log_error("Error on request:\n%s", traceback.format_exc())
+            if "chunked" not in response:
+                response["status"], response["headers"] = "500 INTERNAL SERVER ERROR", [("Content-Length", "0")]
+                write(b"")
+            return
+        if body is not None and not self.close_connection:
+            body.exhaust()
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server that answers connections on a fixed-size thread pool
+    instead of a thread per connection, and can drain: stop accepting, then
+    wait for the requests already being served.
+    """
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads: int = SERVER_THREADS, **kwargs):
+        super().__init__(host, port, app, handler=_KeepAliveHandler, **kwargs)
+        self.draining = False
+        self.handed_off = set()
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="http")
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def shutdown_request(self, request) -> None:
+        if request in self.handed_off:
+            self.handed_off.discard(request)  # owned by the event hub now
+            return
+        super().shutdown_request(request)
+
+    def drain(self) -> None:
+        """Call from another thread than serve_forever(); returns once in-flight requests are done."""
+        self.draining = True
+        self.shutdown()
+        self._executor.shutdown(wait=True)
+        if _event_hub is not None and _event_hub_pid == os.getpid():
+            _event_hub.close_subscribers()
+
+
+def _on_sigterm(callback) -> None:
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, lambda signum, frame: callback())
+
+def _serve_worker(sock: socket.socket, threads: int) -> None:
+    host, port = sock.getsockname()[:2]
+    server = PooledWSGIServer(host, port, app, threads=threads, fd=sock.fileno())
+    draining = []
+
+    def drain():
+        if not draining:
+            draining.append(threading.Thread(target=server.drain, name="http-drain"))
+            draining[0].start()
+
+    _on_sigterm(drain)
+    server.serve_forever()
+    if draining:
+        draining[0].join()
+
+def serve_prefork(host: str, port: int, workers: int, threads: int) -> None:
+    """
+    Bind once, fork ``workers`` processes that accept on the shared socket and
+    respawn any that die. SIGTERM (or Ctrl-C) is passed on to the workers,
+    which drain; stragglers are killed after SHUTDOWN_GRACE seconds. Every
+    worker opens its own SQLite connections (see ConnectionPool).
+    """
+    # Nothing the workers could share by accident
+    _pool.clear()
+    children = {}
+    stopping = []
+
+    def spawn(index: int) -> None:
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                signal.signal(signal.SIGINT, signal.SIG_IGN)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                if index == 0:
+                    _start_background_tasks()
+                _serve_worker(sock, threads)
+            except BaseException:
+                status = 1
+                raise
+            finally:
+                os._exit(status)
+        children[pid] = index
+
+    def stop(*_):
+        if not stopping:
+            stopping.append(time.monotonic() + SHUTDOWN_GRACE)
+            for pid in children:
+                os.kill(pid, signal.SIGTERM)
+
+    sock = socket.create_server((host, port), backlog=128)
+    try:
+        print(f" * Serving on http://{host}:{sock.getsockname()[1]} with {workers} worker(s) x {threads} thread(s)", flush=True)
+        _on_sigterm(stop)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, lambda signum, frame: stop())
+        for index in range(workers):
+            spawn(index)
+        while children:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                index = children.pop(pid, None)
+                if index is not None and not stopping:
+                    time.sleep(0.1)
+                    spawn(index)
+                continue
+            if stopping and time.monotonic() > stopping[0]:
+                for pid in children:
+                    os.kill(pid, signal.SIGKILL)
+            time.sleep(0.1)
+    finally:
+        sock.close()
+
+def serve_waitress(host: str, port: int, threads: int) -> None:
+    _thread_streams["limit"] = max(1, int(threads * EVENTS_THREAD_SHARE))
+    server = waitress.create_server(app, host=host, port=port, threads=threads, channel_timeout=KEEPALIVE_TIMEOUT)
+
+    def drain():
+        # Interrupts server.run() below
+        raise KeyboardInterrupt
+
+    _on_sigterm(drain)
+    print(f" * Serving on http://{host}:{port} with waitress x {threads} thread(s)", flush=True)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        server.task_dispatcher.shutdown(cancel_pending=False, timeout=SHUTDOWN_GRACE)
 
 # --------------------------
 # Main
 # --------------------------
 
-def start_server(host: str = "0.0.0.0", port: int = 5000, debug: bool = False):
-    """Start the Flask server; suitable for being called from another process/thread."""
+def _start_background_tasks() -> None:
+    if storage_migration_pending():
+        # Older databases are migrated in the background while serving
+        threading.Thread(target=migrate_blobs, kwargs={"pause": 0.05}, name="storage-migration", daemon=True).start()
+    start_maintenance()
+
+def start_server(
+    host: str = "0.0.0.0",
+    port: int = 5000,
+    debug: bool = False,
+    mode: str = None,
+    workers: int = None,
+    threads: int = None,
+):
+    """
+    Start the server; suitable for being called from another process/thread.
+    ``mode`` is one of "dev", "prefork", "waitress" or "auto" (see SERVER_MODE);
+    signal handling for graceful shutdown is only installed on the main thread.
+    """
+    mode = mode or SERVER_MODE
+    workers = workers or SERVER_WORKERS
+    threads = threads or SERVER_THREADS
+    if mode == "auto":
+        mode = "waitress" if waitress is not None else "prefork"
+    if mode not in ("dev", "prefork", "waitress"):
+        raise ValueError(f"Unknown server mode: {mode}")
+    if mode == "waitress" and waitress is None:
+        raise RuntimeError("Server mode 'waitress' needs the waitress package.")
+    check_storage_backend()
+
     init_db()
-    # Avoid reloader when starting from a background thread
-    app.run(host=host, port=port, debug=debug, use_reloader=False)
+    conn = get_db()
+    gc_upload_sessions(conn)
+    conn.close()
+    if mode == "prefork" and hasattr(os, "fork") and threading.current_thread() is threading.main_thread():
+        # Background tasks start in worker 0; the parent only supervises
+        serve_prefork(host, port, workers, threads)
+        return
+    _start_background_tasks()
+    if mode == "waitress":
+        serve_waitress(host, port, threads)
+    elif mode == "prefork":
+        # No fork() on this platform, or started from a thread (e.g. by the
+        # GUI) where forking and signal handlers are off limits: one process
+        # with the same thread pool
+        sock = socket.create_server((host, port), backlog=128)
+        try:
+            _serve_worker(sock, threads)
+        finally:
+            sock.close()
+    else:
+        _thread_streams["limit"] = EVENTS_DEV_STREAMS
+        # Avoid reloader when starting from a background thread
+        app.run(host=host, port=port, debug=debug, use_reloader=False)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=APP_NAME)
+    parser.add_argument("command", nargs="?", default="serve", choices=["serve", "migrate-blobs", "compact"])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--mode", choices=["dev", "prefork", "waitress", "auto"], default=SERVER_MODE)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="prefork: worker processes")
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS, help="prefork/waitress: threads per worker")
+    parser.add_argument("--no-vacuum", action="store_true", help="migrate-blobs: skip the final VACUUM")
+    parser.add_argument("--batch-rows", type=int, default=MIGRATION_BATCH_ROWS, help="migrate-blobs: payloads per batch")
+    args = parser.parse_args(argv)
+
+    if args.command == "migrate-blobs":
+        init_db()
+        moved = migrate_blobs(batch_rows=args.batch_rows, vacuum=not args.no_vacuum)
+        print(f"Moved {moved} payload(s) from {DATABASE_PATH} to the '{STORAGE_BACKEND}' store.")
+        return
+    if args.command == "compact":
+        init_db()
+        result = compact_database()
+        before, after = result["before"], result["after"]
+        print(f"Compacted {DATABASE_PATH}: {before['page_count']} -> {after['page_count']} pages of {after['page_size']} bytes.")
+        return
+    if args.mode == "waitress" and waitress is None:
+        parser.error("--mode waitress needs the waitress package")
+    start_server(
+        host=args.host, port=args.port, debug=args.mode == "dev",
+        mode=args.mode, workers=args.workers, threads=args.threads,
+    )
 
 if __name__ == "__main__":
-    start_server(host="0.0.0.0", port=5000, debug=True)
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Chunker benchmark for the "cdc" storage backend.
+
+Measures how fast cdc_split() cuts a payload, with the pure-Python chunker
+and with the fastcdc package when it is installed, next to what the rest of
+ingest costs per byte: SHA-256 hashing and writing a staging file with
+fsync. Ingest stays I/O-bound as long as the chunker keeps ahead of the
+disk. It also reports how much of an edited second version of a file the
+chunks deduplicate.
+
+    python benchmarks/bench_chunker.py --size 64 --output chunker.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import ServerFileuploader as srv  # noqa: E402
+
+MB = 1024 * 1024
+
+
+def _pieces(data: bytes, size: int = srv.INGEST_CHUNK_SIZE):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+def _rate(nbytes: int, fn) -> float:
+    started = time.perf_counter()
+    fn()
+    return round(nbytes / MB / (time.perf_counter() - started), 2)
+
+def chunker_rates(data: bytes) -> dict:
+    """MB/s of cdc_split() per available implementation."""
+    native = srv.fastcdc_cy
+    rates = {}
+    try:
+        srv.fastcdc_cy = None
+        rates["python"] = _rate(len(data), lambda: sum(1 for _ in srv.cdc_split(_pieces(data))))
+        if native is not None:
+            srv.fastcdc_cy = native
+            rates["fastcdc"] = _rate(len(data), lambda: sum(1 for _ in srv.cdc_split(_pieces(data))))
+    finally:
+        srv.fastcdc_cy = native
+    return rates
+
+def disk_rate(data: bytes, directory: Path) -> float:
+    """MB/s of writing ``data`` the way a staging file is written, fsync included."""
+    directory.mkdir(parents=True, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix=".bench-", dir=directory)
+
+    def write():
+        with os.fdopen(fd, "wb") as fh:
+            for piece in _pieces(data):
+                fh.write(piece)
+            fh.flush()
+            os.fsync(fh.fileno())
+
+    try:
+        return _rate(len(data), write)
+    finally:
+        os.unlink(path)
+
+def version_dedup(data: bytes, edits: int = 10) -> dict:
+    """Share of a second version's bytes that are chunks of the first one."""
+    rng = random.Random(42)
+    edited = bytearray(data)
+    for _ in range(edits):
+        at = rng.randrange(len(edited))
+        edited[at:at] = rng.randbytes(rng.randrange(1, 200))
+    first = {hashlib.sha256(c).digest() for c in srv.cdc_split(_pieces(data))}
+    second = list(srv.cdc_split(_pieces(bytes(edited))))
+    shared = sum(len(c) for c in second if hashlib.sha256(c).digest() in first)
+    return {"edits": edits, "chunks": len(second), "shared_fraction": round(shared / len(edited), 4)}
+
+def run(size: int, directory: Path) -> dict:
+    data = random.Random(1234).randbytes(size)
+    chunkers = chunker_rates(data)
+    disk = disk_rate(data, directory)
+    best = max(chunkers.values())
+    return {
+        "bytes": size,
+        "chunker_mb_per_sec": chunkers,
+        "sha256_mb_per_sec": _rate(size, lambda: hashlib.sha256(data).digest()),
+        "disk_mb_per_sec": disk,
+        "io_bound": best >= disk,
+        "version_dedup": version_dedup(data),
+    }
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the content-defined chunker.")
+    parser.add_argument("--size", type=int, default=32, help="payload size in MB")
+    parser.add_argument("--dir", type=Path, default=srv.STAGING_DIR, help="where the disk write is measured")
+    parser.add_argument("--output", type=Path, help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    result = run(args.size * MB, args.dir)
+    result["meta"] = {"python": platform.python_version(), "platform": platform.platform()}
+    for name, rate in result["chunker_mb_per_sec"].items():
+        print(f"chunker {name:8} {rate:>10.2f} MB/s")
+    print(f"sha256           {result['sha256_mb_per_sec']:>10.2f} MB/s")
+    print(f"disk (fsync)     {result['disk_mb_per_sec']:>10.2f} MB/s")
+    print(f"edited version shares {result['version_dedup']['shared_fraction']:.1%} of its bytes with the original")
+    if not result["io_bound"]:
+        hint = "" if "fastcdc" in result["chunker_mb_per_sec"] else "; install fastcdc for the cdc backend"
+        print(f"The chunker is slower than the disk{hint}.")
+    if args.output:
+        args.output.write_text(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
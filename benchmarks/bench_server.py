@@ -0,0 +1,523 @@
+#!/usr/bin/env python3
+"""
+Server benchmark suite: upload, list and download throughput and latency.
+
+Runs a matrix of file sizes, batch sizes, catalogue sizes and concurrent
+clients either in-process against the Flask test client (``--target
+testclient``, the default) or over HTTP against a server it starts in a
+scratch directory (``--target http``, see ``--mode``). Every run uses a fresh
+database and deterministic payloads, so two runs on the same machine are
+comparable.
+
+    python benchmarks/bench_server.py --profile quick --save main
+    python benchmarks/bench_server.py --profile quick --compare main
+
+Results are JSON ({"meta": ..., "results": {case: {...}}}); ``--save`` writes
+benchmarks/baselines/<name>.json and ``--compare`` flags every case whose
+throughput dropped, or whose p99 latency grew, by more than ``--threshold``,
+exiting with status 1 if any did.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+import ServerFileuploader as srv  # noqa: E402
+
+BASELINE_DIR = Path(__file__).resolve().parent / "baselines"
+KB, MB = 1024, 1024 * 1024
+
+PROFILES = {
+    # Finishes in well under a minute; meant for every change
+    "quick": {
+        "sizes": [1 * KB, 1 * MB, 16 * MB],
+        "batches": [1, 20],
+        "catalogues": [1_000, 10_000],
+        "clients": [1, 4],
+        "ops": 20,
+    },
+    # The full matrix; large sizes go through resumable sessions
+    "full": {
+        "sizes": [1 * KB, 64 * KB, 1 * MB, 16 * MB, 128 * MB, 500 * MB],
+        "batches": [1, 20, 200],
+        "catalogues": [10_000, 100_000, 1_000_000],
+        "clients": [1, 8, 32],
+        "ops": 50,
+    },
+}
+# Keeps the total bytes of one case bounded for large payloads
+MAX_CASE_BYTES = 2 * 1024 * MB
+
+
+# --------------------------
+# Payloads
+# --------------------------
+_BLOCK = random.Random(1234).randbytes(1 * MB)
+_counter = iter(range(1, 1 << 62))
+_counter_lock = threading.Lock()
+
+def _payload_chunks(size: int, chunk: int = 1 * MB):
+    """Deterministic, incompressible bytes; the unique prefix defeats deduplication."""
+    with _counter_lock:
+        n = next(_counter)
+    offset = 0
+    while offset < size:
+        length = min(chunk, size - offset)
+        piece = bytearray()
+        while len(piece) < length:
+            start = (offset + len(piece)) % len(_BLOCK)
+            piece += _BLOCK[start:start + length - len(piece)]
+        if offset == 0:
+            # A ZIP signature, so the upload passes the server's content check
+            piece[:16] = (b"PK\x03\x04" + n.to_bytes(12, "big"))[:length]
+        offset += length
+        yield bytes(piece)
+
+def _multipart(sizes):
+    boundary = "benchboundary7MA4YWxkTrZu0gW"
+    heads = [
+        f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"bench{i}.zip\"\r\n"
+        "Content-Type: application/zip\r\n\r\n".encode()
+        for i in range(len(sizes))
+    ]
+    tail = f"--{boundary}--\r\n".encode()
+    length = sum(len(h) + s + 2 for h, s in zip(heads, sizes)) + len(tail)
+
+    def chunks():
+        for head, size in zip(heads, sizes):
+            yield head
+            yield from _payload_chunks(size)
+            yield b"\r\n"
+        yield tail
+
+    return {"Content-Type": f"multipart/form-data; boundary={boundary}"}, chunks(), length
+
+
+# --------------------------
+# Targets
+# --------------------------
+class TestClientTarget:
+    """In-process: the Flask test client over a scratch database."""
+
+    name = "testclient"
+
+    def __init__(self, workdir: Path):
+        srv.DATABASE_PATH = workdir / "uploads.db"
+        srv.STAGING_DIR = workdir / "staging"
+        srv.BLOB_ROOT = workdir / "blobs"
+        srv._pool.clear()
+        srv.init_db()
+        self.db_path = srv.DATABASE_PATH
+        self._local = threading.local()
+
+    def request(self, method, path, body=b"", headers=None, length=None, keep=False):
+        """Returns (status, response bytes, body if ``keep`` else None)."""
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = srv.app.test_client()
+        if not isinstance(body, bytes):
+            body = b"".join(body)
+        resp = client.open(path, method=method, data=body, headers=headers or {}, buffered=False)
+        kept, size = [], 0
+        for chunk in resp.response:
+            size += len(chunk)
+            if keep:
+                kept.append(chunk)
+        resp.close()
+        return resp.status_code, size, b"".join(kept) if keep else None
+
+    def pids(self):
+        return [os.getpid()]
+
+    def reload(self):
+        """Pick up rows written behind the server's back."""
+        srv._pool.clear()
+        srv.init_db()
+
+    def close(self):
+        srv._pool.clear()
+
+
+class HttpTarget:
+    """A real server process started in the scratch directory."""
+
+    name = "http"
+
+    def __init__(self, workdir: Path, mode: str, workers: int, threads: int):
+        self.db_path = workdir / "uploads.db"
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            self.port = probe.getsockname()[1]
+        self._workdir = workdir
+        self._args = ["--mode", mode, "--workers", str(workers), "--threads", str(threads)]
+        self._local = threading.local()
+        self._start()
+
+    def _start(self):
+        env = dict(os.environ, PYTHONPATH=str(ROOT))
+        self.proc = subprocess.Popen(
+            [sys.executable, str(ROOT / "ServerFileuploader.py"), "--host", "127.0.0.1", "--port", str(self.port),
+             *self._args],
+            cwd=self._workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        for _ in range(200):
+            try:
+                socket.create_connection(("127.0.0.1", self.port), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        else:
+            raise RuntimeError("server did not start")
+
+    def request(self, method, path, body=b"", headers=None, length=None, keep=False):
+        conn = getattr(self._local, "conn", None)
+        # Reconnect rather than race the server's keep-alive timeout: a
+        # streamed body cannot be replayed on a retry
+        if conn is None or time.monotonic() - self._local.used > srv.KEEPALIVE_TIMEOUT / 2:
+            if conn is not None:
+                conn.close()
+            conn = self._local.conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=600)
+        headers = dict(headers or {})
+        if not isinstance(body, bytes) and length is not None:
+            headers["Content-Length"] = str(length)
+        conn.request(method, path, body=body, headers=headers)
+        resp = conn.getresponse()
+        kept, size = [], 0
+        while True:
+            chunk = resp.read(1 * MB)
+            if not chunk:
+                break
+            size += len(chunk)
+            if keep:
+                kept.append(chunk)
+        self._local.used = time.monotonic()
+        if resp.getheader("Connection", "").lower() == "close":
+            self._local.conn = None
+        return resp.status, size, b"".join(kept) if keep else None
+
+    def pids(self):
+        pids = [self.proc.pid]
+        try:
+            children = Path(f"/proc/{self.proc.pid}/task/{self.proc.pid}/children").read_text().split()
+            pids += [int(pid) for pid in children]
+        except OSError:
+            pass
+        return pids
+
+    def reload(self):
+        """Restart the server: the catalogue generation is only loaded at start-up."""
+        self.close()
+        self._local = threading.local()
+        self._start()
+
+    def close(self):
+        self.proc.terminate()
+        try:
+            self.proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+
+
+def _reset_peak_rss(pids) -> None:
+    for pid in pids:
+        try:
+            Path(f"/proc/{pid}/clear_refs").write_text("5")
+        except OSError:
+            pass
+
+def _peak_rss(pids):
+    """Summed VmHWM of the serving processes in bytes, or None where /proc is unavailable."""
+    total = 0
+    for pid in pids:
+        try:
+            for line in Path(f"/proc/{pid}/status").read_text().splitlines():
+                if line.startswith("VmHWM:"):
+                    total += int(line.split()[1]) * 1024
+        except OSError:
+            return None
+    if not total and pids == [os.getpid()]:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return total or None
+
+
+# --------------------------
+# Operations
+# --------------------------
+def upload(target, size: int, batch: int):
+    """Upload ``batch`` files of ``size`` bytes; sessions beyond MAX_CONTENT_LENGTH. Returns bytes sent."""
+    if size * batch + 64 * KB * batch > srv.MAX_CONTENT_LENGTH:
+        for _ in range(batch):
+            _session_upload(target, size)
+        return size * batch
+    headers, chunks, length = _multipart([size] * batch)
+    status, _, _ = target.request("POST", "/api/upload", chunks, headers, length=length)
+    assert status == 200, status
+    return size * batch
+
+def _session_upload(target, size: int):
+    body = json.dumps({"filename": "bench.zip", "size": size, "chunk_size": srv.UPLOAD_CHUNK_SIZE}).encode()
+    status, _, data = target.request("POST", "/api/uploads", body, {"Content-Type": "application/json"}, keep=True)
+    assert status == 201, status
+    session_id = json.loads(data)["session_id"]
+    offset = 0
+    for piece in _payload_chunks(size, srv.UPLOAD_CHUNK_SIZE):
+        status, _, _ = target.request("PUT", f"/api/uploads/{session_id}?offset={offset}", piece,
+                                      {"Content-Type": "application/octet-stream"})
+        assert status == 200, status
+        offset += len(piece)
+    status, _, _ = target.request("POST", f"/api/uploads/{session_id}/complete")
+    assert status == 200, status
+
+def seed_catalogue(db_path: Path, rows: int) -> None:
+    """Insert metadata rows directly; listing and search never touch payloads.
+
+    Keeps what the write path maintains alongside the files table in step:
+    file_count, storage_stats, the change log and the catalogue generation.
+    A running server only loads the generation at start-up, so call the
+    target's reload() afterwards.
+    """
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    now = datetime.utcnow().isoformat(timespec="seconds") + "Z"
+    batch = []
+    for i in range(rows):
+        digest = f"{i:064x}"
+        batch.append((f"seed_{i}_report.pdf", f"{digest[:12]}_seed_{i}_report.pdf", "application/pdf", 1000 + i, digest, now))
+        if len(batch) == 50_000:
+            _insert_seed(conn, batch)
+            batch = []
+    if batch:
+        _insert_seed(conn, batch)
+    conn.execute("UPDATE catalog_meta SET value = (SELECT COUNT(*) FROM files) WHERE key = 'file_count'")
+    srv.bump_meta(conn, "generation")
+    try:
+        conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+    except sqlite3.OperationalError:
+        pass  # no FTS5; search uses LIKE
+    conn.commit()
+    conn.close()
+
+def _insert_seed(conn, batch):
+    last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM files").fetchone()[0]
+    conn.executemany(
+        "INSERT INTO files (original_filename, stored_filename, content_type, size_bytes, sha256, uploaded_at) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        batch,
+    )
+    srv.update_stats(conn, [(content_type, size, uploaded_at) for _, _, content_type, size, _, uploaded_at in batch])
+    srv.log_changes(conn, "add", range(last_id + 1, last_id + 1 + len(batch)))
+
+
+# --------------------------
+# Runner
+# --------------------------
+def _percentile(values, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def measure(target, op, ops: int, clients: int, warmup: int = 1) -> dict:
+    """Run ``op()`` ``ops`` times spread over ``clients`` threads; op returns bytes moved."""
+    for _ in range(warmup):
+        op()
+    pids = target.pids()
+    _reset_peak_rss(pids)
+    latencies, moved = [], []
+    lock = threading.Lock()
+    remaining = [ops]
+
+    def worker():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            started = time.perf_counter()
+            nbytes = op()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                moved.append(nbytes)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+    return {
+        "ops": len(latencies),
+        "seconds": round(wall, 4),
+        "ops_per_sec": round(len(latencies) / wall, 2),
+        "mb_per_sec": round(sum(moved) / MB / wall, 2),
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+        "peak_rss_bytes": _peak_rss(pids),
+    }
+
+def _ops_for(size: int, batch: int, ops: int) -> int:
+    return max(2, min(ops, MAX_CASE_BYTES // max(1, size * batch)))
+
+def run_suite(target, profile: dict, log=print) -> dict:
+    results = {}
+
+    def record(case, result):
+        results[case] = result
+        log(f"{case:48} {result['ops_per_sec']:>10.2f} op/s {result['mb_per_sec']:>9.2f} MB/s "
+            f"p50 {result['p50_ms']:>9.2f} ms  p99 {result['p99_ms']:>9.2f} ms")
+
+    for size in profile["sizes"]:
+        for batch in profile["batches"]:
+            if size * batch > MAX_CASE_BYTES:
+                continue
+            for clients in profile["clients"]:
+                ops = _ops_for(size, batch, profile["ops"])
+                record(f"upload size={size} batch={batch} clients={clients}",
+                       measure(target, lambda: upload(target, size, batch), ops, clients))
+
+    file_ids = {}
+    for size in profile["sizes"]:
+        upload(target, size, 1)
+        _, _, data = target.request("GET", "/api/files?limit=1&fields=id", keep=True)
+        file_ids[size] = json.loads(data)["files"][0]["id"]
+    for size, file_id in file_ids.items():
+        for clients in profile["clients"]:
+            ops = _ops_for(size, 1, profile["ops"])
+
+            def download(file_id=file_id):
+                status, nbytes, _ = target.request("GET", f"/files/{file_id}/download")
+                assert status == 200, status
+                return nbytes
+
+            def ranged(file_id=file_id):
+                status, nbytes, _ = target.request("GET", f"/files/{file_id}/download", headers={"Range": "bytes=0-65535"})
+                assert status in (200, 206), status
+                return nbytes
+
+            record(f"download size={size} clients={clients}", measure(target, download, ops, clients))
+            record(f"download-range size={size} clients={clients}", measure(target, ranged, ops, clients))
+
+    seeded = 0
+    for rows in sorted(profile["catalogues"]):
+        seed_catalogue(target.db_path, rows - seeded)
+        seeded = rows
+        target.reload()
+        for clients in profile["clients"]:
+            def first_page():
+                status, nbytes, _ = target.request("GET", "/api/files?limit=500")
+                assert status == 200, status
+                return nbytes
+
+            def deep_page():
+                status, nbytes, _ = target.request("GET", f"/api/files?limit=500&after_id={rows // 2}")
+                assert status == 200, status
+                return nbytes
+
+            def search():
+                status, nbytes, _ = target.request("GET", "/api/files/search?q=report&limit=100")
+                assert status == 200, status
+                return nbytes
+
+            record(f"list-first rows={rows} clients={clients}", measure(target, first_page, profile["ops"], clients))
+            record(f"list-deep rows={rows} clients={clients}", measure(target, deep_page, profile["ops"], clients))
+            record(f"search rows={rows} clients={clients}", measure(target, search, profile["ops"], clients))
+    return results
+
+
+# --------------------------
+# Baselines
+# --------------------------
+def compare(current: dict, baseline: dict, threshold: float):
+    """Return (case, metric, baseline value, current value) for every regression past ``threshold``."""
+    regressions = []
+    for case, result in current["results"].items():
+        base = baseline["results"].get(case)
+        if not base:
+            continue
+        if result["ops_per_sec"] < base["ops_per_sec"] * (1 - threshold):
+            regressions.append((case, "ops_per_sec", base["ops_per_sec"], result["ops_per_sec"]))
+        if result["p99_ms"] > base["p99_ms"] * (1 + threshold):
+            regressions.append((case, "p99_ms", base["p99_ms"], result["p99_ms"]))
+    return regressions
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark upload, list and download.")
+    parser.add_argument("--target", choices=["testclient", "http"], default="testclient")
+    parser.add_argument("--mode", default="prefork", help="http target: server mode (dev, prefork, waitress)")
+    parser.add_argument("--workers", type=int, default=srv.SERVER_WORKERS)
+    parser.add_argument("--threads", type=int, default=srv.SERVER_THREADS)
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quick")
+    parser.add_argument("--ops", type=int, help="override operations per case")
+    parser.add_argument("--save", metavar="NAME", help="write benchmarks/baselines/NAME.json")
+    parser.add_argument("--compare", metavar="NAME", help="compare with benchmarks/baselines/NAME.json")
+    parser.add_argument("--threshold", type=float, default=0.10, help="regression threshold (0.10 = 10%%)")
+    parser.add_argument("--output", type=Path, help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    profile = dict(PROFILES[args.profile])
+    if args.ops:
+        profile["ops"] = args.ops
+    with tempfile.TemporaryDirectory(prefix="vault-bench-") as workdir:
+        workdir = Path(workdir)
+        if args.target == "http":
+            TestClientTarget(workdir).close()  # create the schema the seeding writes into
+            target = HttpTarget(workdir, args.mode, args.workers, args.threads)
+        else:
+            target = TestClientTarget(workdir)
+        try:
+            results = run_suite(target, profile)
+        finally:
+            target.close()
+
+    report = {
+        "meta": {
+            "target": args.target,
+            "mode": args.mode if args.target == "http" else None,
+            "profile": args.profile,
+            "ops": profile["ops"],
+            "revision": _git_revision(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "timestamp": datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        },
+        "results": results,
+    }
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    if args.save:
+        BASELINE_DIR.mkdir(parents=True, exist_ok=True)
+        (BASELINE_DIR / f"{args.save}.json").write_text(json.dumps(report, indent=2))
+    if args.compare:
+        baseline = json.loads((BASELINE_DIR / f"{args.compare}.json").read_text())
+        regressions = compare(report, baseline, args.threshold)
+        for case, metric, before, after in regressions:
+            print(f"REGRESSION {case}: {metric} {before} -> {after}")
+        if regressions:
+            return 1
+        print(f"No regressions beyond {args.threshold:.0%} against '{args.compare}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
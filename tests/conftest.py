@@ -1,9 +1,14 @@
 import os
+from concurrent.futures import wait
+
 import pytest
 
 # Prevent side effects when importing the app module in tests
 os.environ.setdefault("FILEUPLOADER_SKIP_BOOTSTRAP", "1")
 os.environ.setdefault("FILEUPLOADER_NO_SERVER", "1")
+# Most tests upload placeholder bytes under real extensions; the signature
+# tests switch the check back on with monkeypatch
+os.environ.setdefault("FILEUPLOADER_SIGNATURE_CHECK", "0")
 
 
 @pytest.fixture(scope="session")
@@ -35,3 +40,22 @@ def no_message_boxes(monkeypatch):
     monkeypatch.setattr(QtWidgets.QMessageBox, "information", staticmethod(_ok), raising=False)
     monkeypatch.setattr(QtWidgets.QMessageBox, "warning", staticmethod(_ok), raising=False)
     monkeypatch.setattr(QtWidgets.QMessageBox, "question", staticmethod(_yes), raising=False)
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    """Provide a Flask test client backed by a throwaway database and storage dirs."""
+    try:
+        import ServerFileuploader as srv
+    except Exception as e:
+        pytest.skip(f"Flask is required for server tests: {e}")
+    monkeypatch.setattr(srv, "DATABASE_PATH", tmp_path / "uploads.db")
+    monkeypatch.setattr(srv, "STAGING_DIR", tmp_path / "staging")
+    monkeypatch.setattr(srv, "BLOB_ROOT", tmp_path / "blobs")
+    # The event hub remembers where the change log of the previous database ended
+    monkeypatch.setattr(srv, "_event_hub", None)
+    srv.app.config["TESTING"] = True
+    srv.init_db()
+    yield srv.app.test_client()
+    # Background thumbnail renders must not outlive the throwaway database
+    wait(list(srv._thumbnail_jobs.values()))
@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import io
+import json
+
+import pytest
+
+import ServerFileuploader as srv
+
+asgi = pytest.importorskip("AsgiFileuploader")
+
+
+def _multipart(*files, boundary="vaultboundary"):
+    body = b""
+    for name, content in files:
+        body += (
+            f"--{boundary}\r\nContent-Disposition: form-data; name=\"files\"; filename=\"{name}\"\r\n"
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode() + content + b"\r\n"
+    return body + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+async def _call(app, method, path, body=b"", headers=(), piece=1000):
+    raw_path, _, query = path.partition("?")
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": method,
+        "path": raw_path,
+        "query_string": query.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in headers],
+        "server": ("testserver", 80),
+        "client": ("127.0.0.1", 50000),
+    }
+    pieces = [body[i:i + piece] for i in range(0, len(body), piece)] or [b""]
+    messages = [{"type": "http.request", "body": p, "more_body": i < len(pieces) - 1} for i, p in enumerate(pieces)]
+    sent = []
+
+    async def receive():
+        await asyncio.sleep(0)  # a slow client
+        return messages.pop(0) if messages else {"type": "http.disconnect"}
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    start = sent[0]
+    return start["status"], dict(start["headers"]), b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def test_asgi_upload_matches_flask_contract(server):
+    app = asgi.AsgiVault()
+    payload = b"slow link " * 20000
+    body, ctype = _multipart(("a.txt", payload), ("b.pdf", b"%PDF tiny"), ("evil.exe", b"MZ"))
+    status, headers, data = asyncio.run(_call(app, "POST", "/api/upload", body, [("Content-Type", ctype)]))
+    assert status == 200
+    result = json.loads(data)
+
+    expected = server.post(
+        "/api/upload",
+        data=body,
+        content_type=ctype,
+    ).get_json()
+    assert set(result) == set(expected)
+    assert result["saved"] == 2 and result["rejected"] == ["evil.exe"]
+    assert [f["sha256"] for f in result["files"]] == [f["sha256"] for f in expected["files"]]
+    assert result["files"][0]["sha256"] == hashlib.sha256(payload).hexdigest()
+    assert [d["filename"] for d in expected["deduplicated"]] == ["a.txt", "b.pdf"]
+    assert not any(srv.STAGING_DIR.iterdir())
+
+
+def test_asgi_serves_listing_and_downloads_through_flask(server):
+    app = asgi.AsgiVault()
+    payload = bytes(range(256)) * 1000
+    body, ctype = _multipart(("blob.zip", payload))
+    asyncio.run(_call(app, "POST", "/api/upload", body, [("Content-Type", ctype)]))
+
+    status, _, data = asyncio.run(_call(app, "GET", "/api/files?fields=id,original_filename"))
+    assert status == 200
+    listing = json.loads(data)
+    assert listing == server.get("/api/files?fields=id,original_filename").get_json()
+
+    file_id = listing["files"][0]["id"]
+    in_use = srv.pool_stats()["in_use"]
+    status, headers, data = asyncio.run(_call(app, "GET", f"/files/{file_id}/download"))
+    assert status == 200 and data == payload
+    assert headers[b"content-length"] == str(len(payload)).encode()
+    status, _, data = asyncio.run(_call(app, "GET", f"/files/{file_id}/download", headers=[("Range", "bytes=10-19")]))
+    assert status == 206 and data == payload[10:20]
+    assert srv.pool_stats()["in_use"] == in_use
+
+
+def test_asgi_upload_errors(server):
+    app = asgi.AsgiVault()
+    status, _, data = asyncio.run(_call(app, "POST", "/api/upload", b"{}", [("Content-Type", "application/json")]))
+    assert (status, json.loads(data)) == (400, {"error": "No file part in the request."})
+
+    too_big = str(srv.app.config["MAX_CONTENT_LENGTH"] + 1)
+    body, ctype = _multipart(("a.txt", b"x"))
+    status, _, _ = asyncio.run(_call(app, "POST", "/api/upload", body, [("Content-Type", ctype), ("Content-Length", too_big)]))
+    assert status == 413
+
+
+def test_asgi_concurrent_uploads_share_the_byte_budget(server, monkeypatch):
+    monkeypatch.setattr(asgi, "ASYNC_MAX_BUFFERED_BYTES", 4096)
+    app = asgi.AsgiVault()
+    peak = []
+    acquire = app.budget.acquire
+
+    async def tracking_acquire(size):
+        granted = await acquire(size)
+        peak.append(app.budget.used)
+        return granted
+
+    app.budget.acquire = tracking_acquire
+
+    async def many():
+        calls = []
+        for i in range(12):
+            body, ctype = _multipart((f"f{i}.txt", bytes([65 + i]) * 50000))
+            calls.append(_call(app, "POST", "/api/upload", body, [("Content-Type", ctype)], piece=3000))
+        return await asyncio.gather(*calls)
+
+    results = asyncio.run(many())
+    assert all(status == 200 and json.loads(data)["saved"] == 1 for status, _, data in results)
+    assert max(peak) <= 4096
+    assert server.get("/api/files").get_json()["total"] == 12
+
+
+def test_asgi_event_stream_replays_from_last_event_id(server):
+    start = server.get("/api/files").get_json()["change_seq"]
+    server.post("/api/upload", data={"files": [(io.BytesIO(b"e"), "e.txt")]}, content_type="multipart/form-data")
+
+    # The test client disconnects right after its request, which ends the stream
+    status, headers, body = asyncio.run(_call(asgi.app, "GET", "/api/events", headers=[("Last-Event-ID", str(start))]))
+    assert status == 200 and headers[b"content-type"] == b"text/event-stream"
+    assert body.startswith(b"retry: ")
+    assert b"event: upload\n" in body and b'"original_filename":"e.txt"' in body
+    assert f"id: {start + 1}\n".encode() in body
+
+
+def test_asgi_startup_fails_for_cdc_without_fastcdc(server, monkeypatch):
+    monkeypatch.setattr(srv, "STORAGE_BACKEND", "cdc")
+    monkeypatch.setattr(srv, "fastcdc_cy", None)
+    monkeypatch.setattr(srv, "CDC_PURE_PYTHON", False)
+    messages, sent = [{"type": "lifespan.startup"}], []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    asyncio.run(asgi.AsgiVault()({"type": "lifespan"}, receive, send))
+    assert sent[0]["type"] == "lifespan.startup.failed" and "fastcdc" in sent[0]["message"]
+
+
+def test_asgi_streams_request_bodies_into_flask_routes(server, monkeypatch):
+    monkeypatch.setattr(asgi, "ASYNC_BODY_QUEUE", 2)
+    app = asgi.AsgiVault()
+    payload = bytes(range(256)) * 400
+    created = server.post("/api/uploads", json={"filename": "big.zip", "size": len(payload), "chunk_size": len(payload)})
+    sid = created.get_json()["session_id"]
+    status, _, data = asyncio.run(_call(app, "PUT", f"/api/uploads/{sid}?offset=0", payload, piece=1000))
+    assert status == 200 and json.loads(data)["missing"] == []
+    assert server.post(f"/api/uploads/{sid}/complete").status_code == 200
+    file_id = server.get("/api/files").get_json()["files"][0]["id"]
+    assert server.get(f"/files/{file_id}/download").data == payload
+
+
+def test_asgi_refuses_oversized_bodies_for_flask_routes(server, monkeypatch):
+    created = server.post("/api/uploads", json={"filename": "big.zip", "size": 6000, "chunk_size": 6000})
+    sid = created.get_json()["session_id"]
+    monkeypatch.setitem(srv.app.config, "MAX_CONTENT_LENGTH", 5000)
+    app = asgi.AsgiVault()
+    path = f"/api/uploads/{sid}?offset=0"
+    status, _, data = asyncio.run(_call(app, "PUT", path, b"x" * 6000, [("Content-Length", "6000")]))
+    assert (status, json.loads(data)) == (413, {"error": "Request too large."})
+    # Without a length the stream itself is cut off at the limit
+    status, _, _ = asyncio.run(_call(app, "PUT", path, b"x" * 6000))
+    assert status == 413
+    assert server.get(f"/api/uploads/{sid}").get_json()["received"] == []
@@ -0,0 +1,67 @@
+import json
+import sys
+from pathlib import Path
+
+import ServerFileuploader as srv
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "benchmarks"))
+import bench_server  # noqa: E402
+
+
+def test_suite_runs_against_test_client(tmp_path, monkeypatch):
+    for name in ("DATABASE_PATH", "STAGING_DIR", "BLOB_ROOT"):
+        monkeypatch.setattr(srv, name, getattr(srv, name))
+    target = bench_server.TestClientTarget(tmp_path)
+    profile = {"sizes": [1024], "batches": [2], "catalogues": [50], "clients": [2], "ops": 3}
+    try:
+        results = bench_server.run_suite(target, profile, log=lambda line: None)
+    finally:
+        target.close()
+    assert set(results) == {
+        "upload size=1024 batch=2 clients=2",
+        "download size=1024 clients=2",
+        "download-range size=1024 clients=2",
+        "list-first rows=50 clients=2",
+        "list-deep rows=50 clients=2",
+        "search rows=50 clients=2",
+    }
+    for result in results.values():
+        assert result["ops"] == 3
+        assert result["p99_ms"] >= result["p50_ms"] > 0
+
+
+def test_seeded_rows_show_up_in_cached_listing(tmp_path, monkeypatch):
+    for name in ("DATABASE_PATH", "STAGING_DIR", "BLOB_ROOT"):
+        monkeypatch.setattr(srv, name, getattr(srv, name))
+    target = bench_server.TestClientTarget(tmp_path)
+    try:
+        status, _, body = target.request("GET", "/api/files?limit=500", keep=True)
+        assert status == 200 and json.loads(body)["total"] == 0
+        bench_server.seed_catalogue(target.db_path, 30)
+        target.reload()
+        status, _, body = target.request("GET", "/api/files?limit=500", keep=True)
+        assert json.loads(body)["total"] == 30
+        _, _, body = target.request("GET", "/api/stats", keep=True)
+        assert json.loads(body)["files"] == 30
+        _, _, body = target.request("GET", "/api/files/changes?since=0", keep=True)
+        assert len(json.loads(body)["changes"]) == 30
+    finally:
+        target.close()
+
+
+def test_compare_flags_regressions_past_threshold():
+    base = {"results": {"a": {"ops_per_sec": 100.0, "p99_ms": 10.0}, "b": {"ops_per_sec": 100.0, "p99_ms": 10.0}}}
+    current = {"results": {"a": {"ops_per_sec": 95.0, "p99_ms": 10.5}, "b": {"ops_per_sec": 80.0, "p99_ms": 13.0}}}
+    assert bench_server.compare(current, base, 0.10) == [
+        ("b", "ops_per_sec", 100.0, 80.0),
+        ("b", "p99_ms", 10.0, 13.0),
+    ]
+
+
+def test_chunker_benchmark_reports_rates_and_dedup(tmp_path):
+    import bench_chunker
+
+    result = bench_chunker.run(1024 * 1024, tmp_path)
+    assert "python" in result["chunker_mb_per_sec"]
+    assert result["disk_mb_per_sec"] > 0 and not list(tmp_path.iterdir())
+    assert 0 < result["version_dedup"]["shared_fraction"] < 1
@@ -16,6 +16,7 @@ class DummyResp:
         self._content = content
         self._iter = [content] if content else []
         self._stream = stream
+        self.headers = {}
 
     def raise_for_status(self):
         if not (200 <= self.status_code < 300):
@@ -0,0 +1,69 @@
+import io
+
+import ServerFileuploader as srv
+
+
+def _upload(client, name, payload, mimetype):
+    data = {"files": [(io.BytesIO(payload), name, mimetype)]}
+    client.post("/api/upload", data=data, content_type="multipart/form-data")
+
+
+def _names(resp):
+    return [f["original_filename"] for f in resp.get_json()["files"]]
+
+
+def _seed(client):
+    _upload(client, "quarterly_report_2024.pdf", b"a" * 300, "application/pdf")
+    _upload(client, "holiday.jpg", b"b" * 5000, "image/jpeg")
+    _upload(client, "report_draft.docx", b"c" * 100, "application/msword")
+    _upload(client, "logo.png", b"d" * 800, "image/png")
+
+
+def test_search_by_token_and_prefix(server):
+    _seed(server)
+    assert _names(server.get("/api/files/search?q=report")) == ["report_draft.docx", "quarterly_report_2024.pdf"]
+    assert _names(server.get("/api/files/search?q=quart")) == ["quarterly_report_2024.pdf"]
+    assert _names(server.get("/api/files/search?q=rep dra")) == ["report_draft.docx"]
+    assert _names(server.get("/api/files/search?q=nothing")) == []
+
+
+def test_search_filters_and_sorting(server):
+    _seed(server)
+    assert _names(server.get("/api/files/search?content_type=image/&sort=size_bytes&order=asc")) == [
+        "logo.png", "holiday.jpg"
+    ]
+    assert _names(server.get("/api/files/search?content_type=application/pdf")) == ["quarterly_report_2024.pdf"]
+    assert _names(server.get("/api/files/search?size_min=200&size_max=1000&sort=original_filename&order=asc")) == [
+        "logo.png", "quarterly_report_2024.pdf"
+    ]
+    assert _names(server.get("/api/files/search?uploaded_to=2000-01-01")) == []
+    assert server.get("/api/files/search?sort=sha256").status_code == 400
+
+
+def test_search_cursor_pagination(server):
+    _seed(server)
+    seen = []
+    url = "/api/files/search?sort=size_bytes&limit=1&fields=original_filename"
+    page = server.get(url).get_json()
+    while True:
+        seen += [f["original_filename"] for f in page["files"]]
+        if not page["next_cursor"]:
+            break
+        page = server.get(url + "&cursor=" + page["next_cursor"]).get_json()
+    assert seen == ["holiday.jpg", "logo.png", "quarterly_report_2024.pdf", "report_draft.docx"]
+    assert server.get("/api/files/search?cursor=garbage").status_code == 400
+
+
+def test_search_index_follows_deletes(server):
+    _seed(server)
+    file_id = server.get("/api/files/search?q=logo").get_json()["files"][0]["id"]
+    server.post(f"/files/{file_id}/delete")
+    assert _names(server.get("/api/files/search?q=logo")) == []
+
+
+def test_search_falls_back_without_fts(server, monkeypatch):
+    _seed(server)
+    monkeypatch.setattr(srv, "fts_enabled", lambda conn: False)
+    assert _names(server.get("/api/files/search?q=report&sort=original_filename&order=asc")) == [
+        "quarterly_report_2024.pdf", "report_draft.docx"
+    ]
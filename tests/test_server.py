@@ -0,0 +1,1355 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+import zipfile
+
+import pytest
+
+import ServerFileuploader as srv
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+@pytest.fixture(autouse=True)
+def small_session_chunks(monkeypatch):
+    # Upload session tests move a few KB in 1000-byte chunks
+    monkeypatch.setattr(srv, "UPLOAD_MIN_CHUNK_SIZE", 500)
+
+
+def _upload(client, *files, url="/api/upload"):
+    data = {"files": [(io.BytesIO(content), name) for name, content in files]}
+    return client.post(url, data=data, content_type="multipart/form-data")
+
+
+def test_api_upload_streams_and_hashes(server):
+    payload = b"x" * (3 * srv.INGEST_CHUNK_SIZE + 17)
+    resp = _upload(server, ("big.txt", payload))
+    assert resp.status_code == 200
+    assert resp.get_json()["saved"] == 1
+
+    listing = server.get("/api/files").get_json()["files"]
+    assert listing[0]["size_bytes"] == len(payload)
+    assert listing[0]["sha256"] == hashlib.sha256(payload).hexdigest()
+
+    body = server.get(f"/files/{listing[0]['id']}/download").data
+    assert body == payload
+
+
+def test_api_upload_rejects_empty_and_disallowed(server):
+    resp = _upload(server, ("empty.txt", b""), ("evil.exe", b"MZ"))
+    data = resp.get_json()
+    assert data["saved"] == 0
+    assert "empty.txt (empty)" in data["rejected"]
+    assert "evil.exe" in data["rejected"]
+
+
+def test_parts_are_checked_against_their_signature(server, monkeypatch):
+    monkeypatch.setattr(srv, "UPLOAD_SIGNATURE_CHECK", True)
+    disguised = b"MZ\x90\x00" + b"\x00" * 200_000
+    resp = _upload(
+        server,
+        ("holiday.PNG", disguised),
+        ("report.pdf", b"\n\n%PDF-1.7 body"),
+        ("bundle.tar.gz", b"\x1f\x8b" + b"\x00" * 100),
+        ("notes.txt", b"plain"),
+    )
+    data = resp.get_json()
+    assert data["rejected"] == ["holiday.PNG (content is not .png)"]
+    assert [f["filename"] for f in data["files"]] == ["report.pdf", "bundle.tar.gz", "notes.txt"]
+
+
+def test_rejected_parts_are_never_staged(monkeypatch, tmp_path):
+    monkeypatch.setattr(srv, "UPLOAD_SIGNATURE_CHECK", True)
+    monkeypatch.setattr(srv, "STAGING_DIR", tmp_path)
+    assert srv.allowed_extension("a.TAR.GZ") == "tar.gz"
+
+    by_name = srv.IngestSink("setup.exe")
+    assert by_name.rejection == "type not allowed"
+    by_content = srv.IngestSink("photo.jpg")
+    for _ in range(10):
+        by_content.write(b"GIF89a" + b"\x00" * 65536)
+    by_content.finish()
+    assert by_content.rejection == "content is not .jpg"
+    assert by_name.path is None and by_content.path is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_upload_session_checks_signature_of_first_chunk(server, monkeypatch):
+    monkeypatch.setattr(srv, "UPLOAD_SIGNATURE_CHECK", True)
+    session = server.post("/api/uploads", json={"filename": "big.zip", "size": 2000, "chunk_size": 1000}).get_json()
+    resp = server.put(f"/api/uploads/{session['session_id']}?offset=0", data=b"x" * 1000)
+    assert resp.status_code == 415
+    resp = server.put(f"/api/uploads/{session['session_id']}?offset=0", data=b"PK\x03\x04" + b"x" * 996)
+    assert resp.status_code == 200
+
+
+def test_staging_files_are_cleaned_up(server):
+    _upload(server, ("a.txt", b"hello"), ("b.txt", b""))
+    assert not any(srv.STAGING_DIR.iterdir())
+
+
+def test_truncated_upload_leaves_no_staging_files(server):
+    body = (
+        b"--b\r\nContent-Disposition: form-data; name=\"files\"; filename=\"cut.txt\"\r\n\r\n"
+        + b"x" * (4 * srv.INGEST_CHUNK_SIZE) + b"\r\n--b--\r\n"
+    )
+    resp = server.post(
+        "/api/upload", input_stream=io.BytesIO(body[: len(body) // 2]), content_length=len(body),
+        content_type="multipart/form-data; boundary=b",
+    )
+    assert resp.status_code == 400
+    assert not list(srv.STAGING_DIR.glob("ingest-*"))
+
+
+def test_maintenance_sweeps_stale_staging_files(server):
+    srv.STAGING_DIR.mkdir(parents=True, exist_ok=True)
+    stale, fresh = srv.STAGING_DIR / "ingest-stale", srv.STAGING_DIR / "encoded-fresh"
+    stale.write_bytes(b"s")
+    fresh.write_bytes(b"f")
+    old = time.time() - srv.STAGING_STALE_SECONDS - 1
+    os.utime(stale, (old, old))
+    assert srv.sweep_staging() == 1
+    assert not stale.exists() and fresh.exists()
+
+
+def test_html_upload_keeps_small_files_inline(server):
+    resp = _upload(server, ("page.md", b"# hi"), url="/upload")
+    assert resp.status_code == 302
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    assert conn.execute("SELECT storage FROM blobs").fetchone() == ("inline",)
+    assert conn.execute("SELECT seq, data FROM blob_chunks").fetchall() == [(0, b"# hi")]
+    conn.close()
+
+
+def test_large_files_go_to_sharded_blob_tree(server):
+    payload = b"y" * (srv.INLINE_MAX_BYTES + 1)
+    digest = hashlib.sha256(payload).hexdigest()
+    _upload(server, ("big.pdf", payload))
+
+    path = srv.BLOB_ROOT / digest[:2] / digest[2:4] / digest
+    assert path.read_bytes() == payload
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    assert conn.execute("SELECT storage FROM blobs").fetchone() == ("fs",)
+    assert conn.execute("SELECT COUNT(*) FROM blob_chunks").fetchone() == (0,)
+    conn.close()
+
+    file_id = server.get("/api/files").get_json()["files"][0]["id"]
+    assert server.get(f"/files/{file_id}/download").data == payload
+    server.post(f"/files/{file_id}/delete")
+    assert not path.exists()
+
+
+def test_identical_uploads_are_stored_once(server):
+    payload = b"same pdf bytes" * 10000
+    first = _upload(server, ("a.pdf", payload)).get_json()
+    assert first["deduplicated"] == []
+
+    second = _upload(server, ("b.pdf", payload), ("c.pdf", payload)).get_json()
+    assert second["saved"] == 2
+    assert [d["filename"] for d in second["deduplicated"]] == ["b.pdf", "c.pdf"]
+    assert second["bytes_saved"] == 2 * len(payload)
+
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    assert conn.execute("SELECT COUNT(*), SUM(refcount) FROM blobs").fetchone() == (1, 3)
+    conn.close()
+
+
+def test_batch_upload_hashes_in_parallel_and_reports_failures(server, monkeypatch):
+    monkeypatch.setattr(srv, "HASH_LANE_MAX_PENDING", 2)
+    files = [(f"f{i:03}.txt", bytes([i]) * (srv.INGEST_CHUNK_SIZE * (i % 3) + i + 1)) for i in range(40)]
+    broken = hashlib.sha256(files[7][1]).hexdigest()
+    put = srv.InlineBlobStore.put
+
+    def flaky_put(self, conn, sink):
+        if sink.sha256 == broken:
+            raise OSError("disk on fire")
+        return put(self, conn, sink)
+
+    monkeypatch.setattr(srv.InlineBlobStore, "put", flaky_put)
+    monkeypatch.setattr(srv, "INLINE_MAX_BYTES", 1 << 30)
+    data = _upload(server, *files).get_json()
+
+    assert data["saved"] == 39
+    assert data["failed"] == [{"filename": "f007.txt", "error": "disk on fire"}]
+    by_name = {f["filename"]: f for f in data["files"]}
+    for name, content in files:
+        if name != "f007.txt":
+            assert by_name[name]["sha256"] == hashlib.sha256(content).hexdigest()
+            assert server.get(f"/files/{by_name[name]['id']}/download").data == content
+
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM blobs WHERE sha256 = ?", (broken,)).fetchone() == (0,)
+    assert conn.execute("SELECT COUNT(*) FROM blob_chunks WHERE sha256 = ?", (broken,)).fetchone() == (0,)
+    conn.close()
+    assert server.get("/api/files").get_json()["total"] == 39
+
+
+def test_delete_frees_payload_after_last_reference(server):
+    payload = b"q" * (srv.INLINE_MAX_BYTES + 10)
+    digest = hashlib.sha256(payload).hexdigest()
+    _upload(server, ("one.zip", payload), ("two.zip", payload))
+    path = srv.BLOB_ROOT / digest[:2] / digest[2:4] / digest
+    ids = [f["id"] for f in server.get("/api/files").get_json()["files"]]
+
+    server.post(f"/files/{ids[0]}/delete")
+    assert path.exists()
+    assert server.get(f"/files/{ids[1]}/download").data == payload
+
+    server.post(f"/files/{ids[1]}/delete")
+    assert not path.exists()
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+    conn.close()
+
+
+def test_text_is_compressed_at_rest_and_sent_encoded(server):
+    payload = b"the quick brown fox jumps over the lazy dog\n" * 5000
+    digest = hashlib.sha256(payload).hexdigest()
+    _upload(server, ("notes.txt", payload), ("photo.png", payload[:40000]))
+
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    blobs = dict((r[0], r[1:]) for r in conn.execute("SELECT sha256, encoding, size_bytes, stored_bytes FROM blobs"))
+    conn.close()
+    encoding, size, stored = blobs[digest]
+    assert (encoding, size) == ("gzip", len(payload)) and stored < size // 10
+    assert blobs[hashlib.sha256(payload[:40000]).hexdigest()] == ("identity", 40000, 40000)
+
+    file_id = [f["id"] for f in server.get("/api/files").get_json()["files"] if f["original_filename"] == "notes.txt"][0]
+    encoded = server.get(f"/files/{file_id}/download", headers={"Accept-Encoding": "gzip, br"})
+    assert encoded.headers["Content-Encoding"] == "gzip"
+    assert encoded.headers["Vary"] == "Accept-Encoding"
+    assert encoded.content_length == stored
+    assert gzip.decompress(encoded.data) == payload
+
+    plain = server.get(f"/files/{file_id}/download")
+    assert "Content-Encoding" not in plain.headers
+    assert plain.data == payload and plain.content_length == len(payload)
+    assert plain.headers["ETag"] != encoded.headers["ETag"]
+
+    ranged = server.get(f"/files/{file_id}/download", headers={"Range": "bytes=5-9,100000-100009"})
+    assert b"\r\n\r\n" + payload[100000:100010] + b"\r\n" in ranged.data
+    assert b"\r\n\r\n" + payload[5:10] + b"\r\n" in ranged.data
+
+
+def test_xz_payloads_are_decoded_for_every_client(server, monkeypatch):
+    monkeypatch.setattr(srv, "COMPRESSION_OVERRIDE", "xz")
+    payload = b"col1,col2,col3\n" * 20000
+    _upload(server, ("sheet.xls", payload))
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    assert conn.execute("SELECT encoding FROM blobs").fetchone() == ("xz",)
+    conn.close()
+
+    file_id = server.get("/api/files").get_json()["files"][0]["id"]
+    resp = server.get(f"/files/{file_id}/download", headers={"Accept-Encoding": "gzip, xz"})
+    assert "Content-Encoding" not in resp.headers
+    assert resp.data == payload
+
+
+def _stored_id(client):
+    return client.get("/api/files").get_json()["files"][0]["id"]
+
+
+def test_download_sets_strong_etag_and_answers_304(server):
+    payload = b"etag me"
+    _upload(server, ("e.txt", payload))
+    file_id = _stored_id(server)
+
+    resp = server.get(f"/files/{file_id}/download")
+    digest = hashlib.sha256(payload).hexdigest()
+    assert resp.headers["ETag"] == f'"{digest}"'
+    assert resp.headers["Accept-Ranges"] == "bytes"
+
+    resp = server.get(f"/files/{file_id}/download", headers={"If-None-Match": f'"{digest}"'})
+    assert resp.status_code == 304
+    assert resp.data == b""
+
+
+def test_single_range_on_inline_and_fs_payloads(server):
+    small = bytes(range(256)) * 10
+    large = bytes(range(256)) * (srv.INLINE_MAX_BYTES // 128)
+    _upload(server, ("small.bin.txt", small))
+    _upload(server, ("large.bin.txt", large))
+    files = server.get("/api/files").get_json()["files"]
+
+    for entry, payload in zip(files, (large, small)):
+        resp = server.get(f"/files/{entry['id']}/download", headers={"Range": "bytes=100-1099"})
+        assert resp.status_code == 206
+        assert resp.headers["Content-Range"] == f"bytes 100-1099/{len(payload)}"
+        assert resp.data == payload[100:1100]
+
+        resp = server.get(f"/files/{entry['id']}/download", headers={"Range": "bytes=-10"})
+        assert resp.data == payload[-10:]
+
+
+def test_multi_range_returns_byteranges(server):
+    payload = b"0123456789" * 100
+    _upload(server, ("r.txt", payload))
+    file_id = _stored_id(server)
+
+    resp = server.get(f"/files/{file_id}/download", headers={"Range": "bytes=0-4,10-14"})
+    assert resp.status_code == 206
+    assert resp.mimetype == "multipart/byteranges"
+    assert len(resp.data) == resp.content_length
+    assert b"Content-Range: bytes 0-4/1000\r\n\r\n01234\r\n" in resp.data
+    assert b"Content-Range: bytes 10-14/1000\r\n\r\n01234\r\n" in resp.data
+
+
+def test_unsatisfiable_and_stale_if_range(server):
+    _upload(server, ("u.txt", b"short"))
+    file_id = _stored_id(server)
+
+    resp = server.get(f"/files/{file_id}/download", headers={"Range": "bytes=50-60"})
+    assert resp.status_code == 416
+    assert resp.headers["Content-Range"] == "bytes */5"
+
+    resp = server.get(f"/files/{file_id}/download", headers={"Range": "bytes=0-1", "If-Range": '"other"'})
+    assert resp.status_code == 200
+    assert resp.data == b"short"
+
+
+
+@pytest.mark.skipif(fcntl is None, reason="needs fcntl to inspect descriptor modes")
+def test_staged_payloads_are_fsynced_through_write_handles(server, monkeypatch):
+    # Windows refuses fsync on a read-only handle; hold POSIX to the same rule
+    real_fsync, synced = os.fsync, []
+
+    def fsync(fd):
+        assert fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_ACCMODE != os.O_RDONLY
+        synced.append(fd)
+        real_fsync(fd)
+
+    monkeypatch.setattr(os, "fsync", fsync)
+    text = b"compressible line\n" * 8000
+    blob = os.urandom(srv.INLINE_MAX_BYTES + 1)
+    assert _upload(server, ("notes.txt", text), ("blob.zip", blob)).get_json()["saved"] == 2
+    payload = os.urandom(srv.INLINE_MAX_BYTES + 1)
+    sid = _create_session(server, payload, chunk_size=len(payload))["session_id"]
+    server.put(f"/api/uploads/{sid}?offset=0", data=payload)
+    assert server.post(f"/api/uploads/{sid}/complete").status_code == 200
+    assert len(synced) >= 3
+    downloads = [server.get(f"/files/{f['id']}/download").data for f in server.get("/api/files").get_json()["files"]]
+    assert sorted(downloads) == sorted([text, blob, payload])
+
+def _create_session(client, payload, name="big.zip", chunk_size=1000, **extra):
+    body = {"filename": name, "size": len(payload), "chunk_size": chunk_size, **extra}
+    resp = client.post("/api/uploads", json=body)
+    assert resp.status_code == 201
+    return resp.get_json()
+
+
+def test_upload_session_out_of_order_chunks(server):
+    payload = bytes(range(256)) * 10
+    state = _create_session(server, payload, sha256=hashlib.sha256(payload).hexdigest())
+    sid = state["session_id"]
+    assert state["chunk_count"] == 3 and state["missing"] == [[0, 2]]
+
+    for offset in (2000, 0):
+        resp = server.put(f"/api/uploads/{sid}?offset={offset}", data=payload[offset:offset + 1000])
+        assert resp.status_code == 200
+    assert server.get(f"/api/uploads/{sid}").get_json()["missing"] == [[1, 1]]
+    assert server.post(f"/api/uploads/{sid}/complete").status_code == 409
+
+    server.put(f"/api/uploads/{sid}?offset=1000", data=payload[1000:2000])
+    done = server.post(f"/api/uploads/{sid}/complete").get_json()
+    assert done["sha256"] == hashlib.sha256(payload).hexdigest()
+
+    listed = server.get("/api/files").get_json()["files"]
+    assert listed[0]["id"] == done["id"]
+    assert server.get(f"/files/{done['id']}/download").data == payload
+    assert server.get(f"/api/uploads/{sid}").status_code == 404
+
+
+def test_upload_session_bounds_chunk_count_and_reports_ranges(server, monkeypatch):
+    monkeypatch.setattr(srv, "UPLOAD_MIN_CHUNK_SIZE", 64 * 1024)
+    resp = server.post("/api/uploads", json={"filename": "big.zip", "size": 3 * 1024 * 1024, "chunk_size": 1})
+    assert resp.status_code == 400 and "65536" in resp.get_json()["error"]
+    # Huge files need chunks that keep them under MAX_SESSION_CHUNKS
+    resp = server.post("/api/uploads", json={"filename": "big.zip", "size": srv.MAX_SESSION_BYTES, "chunk_size": 64 * 1024})
+    assert resp.status_code == 400
+    # Smaller files than the minimum go in one chunk
+    assert _create_session(server, b"s" * 1000)["chunk_count"] == 1
+
+    state = _create_session(server, b"r" * (5 * 64 * 1024), chunk_size=64 * 1024)
+    sid = state["session_id"]
+    for idx in (1, 2, 4):
+        server.put(f"/api/uploads/{sid}?offset={idx * 64 * 1024}", data=b"r" * (64 * 1024))
+    state = server.get(f"/api/uploads/{sid}").get_json()
+    assert state["received"] == [[1, 2], [4, 4]] and state["missing"] == [[0, 0], [3, 3]]
+
+
+def test_concurrent_session_completes_store_the_file_once(server, monkeypatch):
+    import threading
+
+    payload = b"q" * 2000
+    sid = _create_session(server, payload)["session_id"]
+    for offset in (0, 1000):
+        server.put(f"/api/uploads/{sid}?offset={offset}", data=payload[offset:offset + 1000])
+    # Both calls get past the session lookup before either stores anything
+    both_hashed = threading.Barrier(2, timeout=5)
+    from_staged = srv.IngestSink.from_staged
+
+    def hashed_together(*args, **kwargs):
+        sink = from_staged(*args, **kwargs)
+        both_hashed.wait()
+        return sink
+
+    monkeypatch.setattr(srv.IngestSink, "from_staged", staticmethod(hashed_together))
+    statuses = []
+
+    def complete():
+        statuses.append(srv.app.test_client().post(f"/api/uploads/{sid}/complete").status_code)
+
+    threads = [threading.Thread(target=complete) for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(statuses) == [200, 404]
+    assert server.get("/api/files").get_json()["total"] == 1
+
+
+def test_upload_session_rejects_bad_chunks_and_hash(server):
+    payload = b"a" * 1500
+    sid = _create_session(server, payload, sha256="0" * 64)["session_id"]
+    assert server.put(f"/api/uploads/{sid}?offset=500", data=b"a" * 1000).status_code == 400
+    assert server.put(f"/api/uploads/{sid}?offset=1000", data=b"a" * 1000).status_code == 400
+
+    server.put(f"/api/uploads/{sid}?offset=0", data=payload[:1000])
+    server.put(f"/api/uploads/{sid}?offset=1000", data=payload[1000:])
+    assert server.post(f"/api/uploads/{sid}/complete").status_code == 422
+
+
+def test_upload_sessions_survive_and_expire(server):
+    payload = b"b" * 2000
+    sid = _create_session(server, payload)["session_id"]
+    server.put(f"/api/uploads/{sid}?offset=0", data=payload[:1000])
+
+    conn = srv.get_db()
+    assert srv.gc_upload_sessions(conn) == 0
+    assert server.get(f"/api/uploads/{sid}").get_json()["received"] == [[0, 0]]
+    assert srv.gc_upload_sessions(conn, now=time.time() + srv.UPLOAD_SESSION_TTL + 1) == 1
+    conn.close()
+    assert server.get(f"/api/uploads/{sid}").status_code == 404
+    assert not srv._session_path(sid).exists()
+
+
+
+def test_maintenance_loop_sweeps_abandoned_sessions(server, monkeypatch):
+    sid = _create_session(server, b"c" * 2000)["session_id"]
+    monkeypatch.setattr(srv, "UPLOAD_SESSION_TTL", -1)
+    monkeypatch.setattr(srv, "MAINTENANCE_INTERVAL", 0.01)
+    stop = srv.start_maintenance()
+    try:
+        for _ in range(200):
+            if not srv._session_path(sid).exists():
+                break
+            time.sleep(0.01)
+    finally:
+        stop.set()
+    assert server.get(f"/api/uploads/{sid}").status_code == 404
+    assert not srv._session_path(sid).exists()
+
+def test_pool_reuses_tuned_connections(server):
+    conn = srv.get_db()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == srv.DB_BUSY_TIMEOUT_MS
+    # Nested checkouts on one thread share the connection
+    inner = srv.get_db()
+    assert inner is conn
+    inner.close()
+    conn.close()
+
+    before = srv.pool_stats()
+    for n in range(5):
+        # Distinct pages, so none is answered from the listing cache
+        server.get(f"/api/files?limit={n + 1}")
+    after = server.get("/api/db/pool").get_json()
+    assert after["opened"] == before["opened"]
+    assert after["reused"] >= before["reused"] + 5
+    assert after["in_use"] == before["in_use"]
+
+
+def test_pool_rolls_back_uncommitted_work_on_release(server):
+    conn = srv.get_db()
+    conn.execute("DELETE FROM blobs")
+    conn.execute(
+        "INSERT INTO blobs (sha256, size_bytes, storage, refcount) VALUES ('x', 0, 'inline', 1)"
+    )
+    conn.close()
+    conn = srv.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+    conn.close()
+
+
+def test_pool_hands_out_distinct_connections_per_thread(server):
+    import threading
+
+    seen = []
+    barrier = threading.Barrier(3)
+    in_use = srv.pool_stats()["in_use"]
+
+    def worker():
+        conn = srv.get_db()
+        barrier.wait()
+        seen.append(conn)
+        conn.execute("SELECT COUNT(*) FROM files").fetchone()
+        barrier.wait()
+        conn.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len({id(c) for c in seen}) == 3
+    assert srv.pool_stats()["in_use"] == in_use
+
+
+def test_streamed_inline_download_returns_connection(server):
+    _upload(server, ("s.txt", b"inline body"))
+    file_id = _stored_id(server)
+    in_use = srv.pool_stats()["in_use"]
+    for headers in ({}, {"Range": "bytes=0-3"}):
+        resp = server.get(f"/files/{file_id}/download", headers=headers)
+        assert resp.data.startswith(b"inli")
+        resp.close()
+        assert srv.pool_stats()["in_use"] == in_use
+
+
+def _seed_files(count):
+    conn = srv.get_db()
+    for i in range(count):
+        conn.execute(
+            "INSERT INTO files (original_filename, stored_filename, content_type, size_bytes, sha256, uploaded_at) "
+            "VALUES (?, ?, 'text/plain', 1, 'x', '2024-01-01T00:00:00Z')",
+            (f"f{i}.txt", f"x_f{i}.txt"),
+        )
+        srv.bump_meta(conn, "file_count")
+    conn.commit()
+    conn.close()
+
+
+def test_api_files_keyset_pagination(server):
+    _seed_files(25)
+    page = server.get("/api/files?limit=10").get_json()
+    assert [f["id"] for f in page["files"]] == list(range(25, 15, -1))
+    assert page["total"] == 25
+    assert page["prev_before_id"] is None
+
+    ids = [f["id"] for f in page["files"]]
+    while page["next_after_id"]:
+        page = server.get(f"/api/files?limit=10&after_id={page['next_after_id']}").get_json()
+        ids += [f["id"] for f in page["files"]]
+    assert ids == list(range(25, 0, -1))
+
+    back = server.get("/api/files?limit=10&before_id=5").get_json()
+    assert [f["id"] for f in back["files"]] == list(range(15, 5, -1))
+    assert back["prev_before_id"] == 15 and back["next_after_id"] == 6
+
+
+def test_api_files_field_projection(server):
+    _seed_files(2)
+    files = server.get("/api/files?fields=original_filename").get_json()["files"]
+    assert files == [{"id": 2, "original_filename": "f1.txt"}, {"id": 1, "original_filename": "f0.txt"}]
+    assert server.get("/api/files?fields=data").status_code == 400
+
+
+def test_api_files_total_tracks_writes(server):
+    _upload(server, ("a.txt", b"a"), ("b.txt", b"b"))
+    assert server.get("/api/files").get_json()["total"] == 2
+    server.post(f"/files/{_stored_id(server)}/delete")
+    assert server.get("/api/files").get_json()["total"] == 1
+
+
+def test_inline_backend_streams_fixed_size_chunks(server, monkeypatch):
+    monkeypatch.setattr(srv, "STORAGE_BACKEND", "inline")
+    payload = bytes(range(251)) * 1000
+    _upload(server, ("chunked.pdf", payload))
+    file_id = _stored_id(server)
+
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    sizes = [n for (n,) in conn.execute("SELECT length(data) FROM blob_chunks ORDER BY seq")]
+    conn.close()
+    assert sizes[:-1] == [srv.PAYLOAD_CHUNK_SIZE] * (len(sizes) - 1)
+    assert sum(sizes) == len(payload)
+
+    assert server.get(f"/files/{file_id}/download").data == payload
+    start = srv.PAYLOAD_CHUNK_SIZE - 5
+    resp = server.get(f"/files/{file_id}/download", headers={"Range": f"bytes={start}-{start + 9}"})
+    assert resp.data == payload[start:start + 10]
+
+
+def test_archive_streams_zip_of_selected_files(server):
+    text = b"compress me please " * 4000
+    _upload(server, ("a.txt", text), ("pic.png", b"\x89PNG" + bytes(range(256)) * 300), ("a.txt", b"second a"))
+    ids = [f["id"] for f in server.get("/api/files").get_json()["files"]]
+
+    resp = server.get(f"/api/files/archive?ids={','.join(map(str, ids))}")
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/zip"
+    assert resp.content_length is None
+    with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+        infos = {info.filename: info for info in zf.infolist()}
+        assert set(infos) == {"a.txt", "a (2).txt", "pic.png"}
+        assert infos["pic.png"].compress_type == zipfile.ZIP_STORED
+        assert infos["a.txt"].compress_type == zipfile.ZIP_DEFLATED
+        assert zf.read("a.txt") == text
+        assert zf.read("a (2).txt") == b"second a"
+        assert zf.testzip() is None
+
+
+def test_archive_by_filter_and_bad_selections(server):
+    _upload(server, ("report.pdf", b"%PDF-1.4 one"), ("notes.md", b"# two"))
+    resp = server.get("/api/files/archive?q=report")
+    with zipfile.ZipFile(io.BytesIO(resp.data)) as zf:
+        assert zf.namelist() == ["report.pdf"]
+
+    assert server.get("/api/files/archive").status_code == 400
+    assert server.get("/api/files/archive?ids=1,x").status_code == 400
+    assert server.get("/api/files/archive?ids=999").status_code == 404
+
+
+def test_archive_returns_its_connection_when_the_body_is_never_read(server):
+    _upload(server, ("report.pdf", b"%PDF-1.4 one"))
+    in_use = srv.pool_stats()["in_use"]
+    resp = server.head("/api/files/archive?ids=1")
+    assert resp.status_code == 200
+    resp.close()  # as a WSGI server does once the (empty) body is sent
+    assert srv.pool_stats()["in_use"] == in_use
+    resp = server.get("/api/files/archive?ids=1", buffered=False)
+    resp.close()
+    assert srv.pool_stats()["in_use"] == in_use
+
+
+def test_archive_writes_zip64_records_for_large_entries(server, monkeypatch):
+    monkeypatch.setattr(zipfile, "ZIP64_LIMIT", 1000)
+    _upload(server, ("big.zip", b"z" * 5000))
+    file_id = server.get("/api/files").get_json()["files"][0]["id"]
+    data = server.get(f"/api/files/archive?ids={file_id}").data
+    assert b"PK\x06\x06" in data  # zip64 end of central directory
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        assert zf.read("big.zip") == b"z" * 5000
+
+
+def _freelist(conn):
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+def test_new_database_reclaims_pages_incrementally(server, monkeypatch):
+    monkeypatch.setattr(srv, "INLINE_MAX_BYTES", 1 << 30)
+    monkeypatch.setattr(srv, "VACUUM_STEP_PAGES", 16)
+    _upload(server, *[(f"r{i}.zip", bytes([i]) * 200_000) for i in range(3)])
+    for f in server.get("/api/files").get_json()["files"]:
+        server.post(f"/files/{f['id']}/delete")
+
+    space = server.get("/api/db/space?detail=1").get_json()
+    assert space["auto_vacuum"] == "incremental"
+    assert space["freelist_count"] > 100
+    assert 0.0 <= space["fragmentation"] <= 1.0
+
+    conn = srv.get_db()
+    try:
+        steps = []
+        assert srv.reclaim_free_pages(conn, max_pages=40, progress=steps.append) == 40
+        assert steps == [16, 32, 40]
+        srv.reclaim_free_pages(conn)
+        assert _freelist(conn) == 0
+    finally:
+        conn.close()
+
+
+def test_admin_compaction_converts_and_reports_progress(server):
+    srv._pool.clear()
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    conn.execute("PRAGMA auto_vacuum = NONE")
+    conn.execute("VACUUM")
+    conn.execute("CREATE TABLE scratch (x BLOB)")
+    conn.executemany("INSERT INTO scratch VALUES (?)", [(b"s" * 4000,)] * 200)
+    conn.commit()
+    conn.execute("DROP TABLE scratch")
+    conn.commit()
+    assert conn.execute("PRAGMA auto_vacuum").fetchone() == (0,)
+    conn.close()
+
+    resp = server.post("/api/admin/compact")
+    assert resp.status_code == 202
+    for _ in range(200):
+        status = server.get("/api/admin/compact").get_json()
+        if status["state"] != "running":
+            break
+        time.sleep(0.01)
+    assert status["state"] == "done" and status["phase"] == "done"
+    assert status["before"]["freelist_count"] > 150
+    assert status["after"]["freelist_count"] == 0
+    assert status["after"]["auto_vacuum"] == "incremental"
+
+
+def test_prefork_mode_keeps_alive_and_drains_on_sigterm(tmp_path):
+    import http.client
+    import os
+    import signal
+    import socket
+    import subprocess
+    import sys
+
+    if not hasattr(os, "fork"):
+        pytest.skip("prefork mode needs fork()")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    script = (
+        "import ServerFileuploader as s; "
+        f"s.start_server(host='127.0.0.1', port={port}, mode='prefork', workers=2, threads=2)"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    proc = subprocess.Popen([sys.executable, "-c", script], cwd=tmp_path, env=env)
+    try:
+        for _ in range(100):
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+                conn.request("GET", "/api/db/pool")
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        first = conn.getresponse()
+        first.read()
+        conn.request("GET", "/api/db/pool")  # same connection
+        second = conn.getresponse()
+        assert (first.version, second.status) == (11, 200)
+        assert second.getheader("Connection") != "close"
+        second.read()
+
+        # A request still in flight when SIGTERM arrives is completed
+        body = b"--b\r\nContent-Disposition: form-data; name=\"files\"; filename=\"late.txt\"\r\n\r\nlate\r\n--b--\r\n"
+        conn.putrequest("POST", "/api/upload")
+        conn.putheader("Content-Type", "multipart/form-data; boundary=b")
+        conn.putheader("Content-Length", str(len(body)))
+        conn.endheaders()
+        conn.send(body[:20])
+        time.sleep(0.2)
+        proc.send_signal(signal.SIGTERM)
+        time.sleep(0.2)
+        conn.send(body[20:])
+        resp = conn.getresponse()
+        assert resp.status == 200
+        assert json.loads(resp.read())["saved"] == 1
+        assert proc.wait(timeout=10) == 0
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+
+def _metric(text, sample):
+    for line in text.splitlines():
+        if line.startswith(sample + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+def test_metrics_export_requests_bytes_and_database_timings(server):
+    before = server.get("/metrics").get_data(as_text=True)
+    _upload(server, ("m.txt", b"m" * 3000), ("n.zip", b"n" * 70000))
+    file_id = server.get("/api/files").get_json()["files"][0]["id"]
+    server.get(f"/files/{file_id}/download").data
+    server.get("/api/files/archive?ids=" + str(file_id)).data
+    server.get("/nope")
+
+    resp = server.get("/metrics")
+    assert resp.mimetype == "text/plain"
+    text = resp.get_data(as_text=True)
+    assert "# TYPE fileuploader_http_request_duration_seconds histogram" in text
+    route = 'route="/files/<int:file_id>/download",method="GET"'
+    for sample in (
+        f'fileuploader_http_requests_total{{{route},status="200"}}',
+        f"fileuploader_http_request_duration_seconds_count{{{route}}}",
+        f'fileuploader_http_request_duration_seconds_bucket{{{route},le="+Inf"}}',
+        'fileuploader_http_requests_total{route="<unmatched>",method="GET",status="404"}',
+    ):
+        assert _metric(text, sample) - _metric(before, sample) == 1
+
+    sent = _metric(text, "fileuploader_http_sent_bytes_total") - _metric(before, "fileuploader_http_sent_bytes_total")
+    assert sent > 73000 + 100  # download plus the unsized archive stream
+    received = _metric(text, "fileuploader_http_received_bytes_total") - _metric(before, "fileuploader_http_received_bytes_total")
+    assert received > 73000
+    ingested = _metric(text, 'fileuploader_ingest_file_bytes_bucket{le="4096.0"}') - _metric(before, 'fileuploader_ingest_file_bytes_bucket{le="4096.0"}')
+    assert ingested == 1
+    assert _metric(text, "fileuploader_db_query_duration_seconds_count") > _metric(before, "fileuploader_db_query_duration_seconds_count")
+    assert _metric(text, "fileuploader_db_commit_duration_seconds_count") > _metric(before, "fileuploader_db_commit_duration_seconds_count")
+    assert _metric(text, "fileuploader_uploads_in_flight") == 0
+    assert _metric(text, "fileuploader_db_size_bytes") == srv.DATABASE_PATH.stat().st_size + (
+        srv.DATABASE_PATH.with_name("uploads.db-wal").stat().st_size
+    )
+
+
+def _image(fmt, size=(600, 400), mode="RGB"):
+    Image = pytest.importorskip("PIL.Image")
+    out = io.BytesIO()
+    Image.new(mode, size, (200, 40, 40, 128)[: len(mode)]).save(out, fmt)
+    return out.getvalue()
+
+
+def _thumbnail_rows(digest):
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    rows = conn.execute("SELECT size, content_type FROM thumbnails WHERE sha256 = ? ORDER BY size", (digest,)).fetchall()
+    conn.close()
+    return rows
+
+
+def test_thumbnails_are_rendered_cached_and_evicted(server):
+    from concurrent.futures import wait
+    from PIL import Image
+
+    payload = _image("JPEG")
+    digest = hashlib.sha256(payload).hexdigest()
+    _upload(server, ("photo.jpg", payload), ("logo.png", _image("PNG", (100, 300), "RGBA")))
+    wait(list(srv._thumbnail_jobs.values()))
+    assert _thumbnail_rows(digest) == [(size, "image/jpeg") for size in srv.THUMBNAIL_SIZES]
+
+    photo_id, logo_id = sorted(f["id"] for f in server.get("/api/files").get_json()["files"])
+    resp = server.get(f"/files/{photo_id}/thumbnail?size=100")
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/jpeg"
+    assert "immutable" in resp.headers["Cache-Control"]
+    assert Image.open(io.BytesIO(resp.data)).size == (100, 67)
+    assert server.get(f"/files/{photo_id}/thumbnail?size=100", headers={"If-None-Match": resp.headers["ETag"]}).status_code == 304
+    assert [size for size, _ in _thumbnail_rows(digest)] == [100, 128, 256]
+
+    # Transparent images stay PNG; sources smaller than the box are not upscaled
+    resp = server.get(f"/files/{logo_id}/thumbnail?size=512")
+    assert resp.mimetype == "image/png"
+    assert Image.open(io.BytesIO(resp.data)).size == (100, 300)
+
+    server.post(f"/files/{photo_id}/delete")
+    assert _thumbnail_rows(digest) == []
+    assert server.get(f"/files/{photo_id}/thumbnail").status_code == 404
+
+
+def test_thumbnail_rejects_bad_requests(server):
+    pytest.importorskip("PIL")
+    _upload(server, ("notes.txt", b"hello"), ("broken.png", b"not really a png"))
+    notes_id, broken_id = sorted(f["id"] for f in server.get("/api/files").get_json()["files"])
+    assert server.get(f"/files/{notes_id}/thumbnail").status_code == 415
+    assert server.get(f"/files/{broken_id}/thumbnail?size=5000").status_code == 400
+    resp = server.get(f"/files/{broken_id}/thumbnail?size=64")
+    assert resp.status_code == 422
+    assert "thumbnail" in resp.get_json()["error"]
+
+
+def test_listing_etag_follows_catalogue_generation(server, monkeypatch):
+    _upload(server, ("a.zip", b"one"))
+    first = server.get("/api/files")
+    etag = first.headers["ETag"]
+
+    with monkeypatch.context() as m:
+        # A matching tag is answered from the shared counter alone...
+        m.setattr(srv, "get_db", lambda: pytest.fail("queried SQLite"))
+        assert server.get("/api/files", headers={"If-None-Match": etag}).status_code == 304
+        # ...and a repeated page from the per-process cache
+        assert server.get("/api/files").data == first.data
+
+    _upload(server, ("b.zip", b"two"))
+    second = server.get("/api/files", headers={"If-None-Match": etag})
+    assert second.status_code == 200
+    assert second.headers["ETag"] != etag
+    assert [f["original_filename"] for f in second.get_json()["files"]] == ["b.zip", "a.zip"]
+
+    server.post(f"/files/{second.get_json()['files'][0]['id']}/delete")
+    third = server.get("/api/files", headers={"If-None-Match": second.headers["ETag"]})
+    assert third.status_code == 200
+    assert third.get_json()["total"] == 1
+
+
+def test_generation_is_shared_with_forked_workers(server):
+    import multiprocessing
+
+    before = srv.catalogue_etag()
+    child = multiprocessing.get_context("fork").Process(target=srv.publish_generation, args=(srv.catalogue_generation() + 5,))
+    child.start()
+    child.join()
+    assert srv.catalogue_etag() != before
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    persisted = conn.execute("SELECT value FROM catalog_meta WHERE key = 'generation'").fetchone()[0]
+    conn.close()
+    assert srv.catalogue_generation() == persisted + 5
+
+
+def test_index_page_is_paginated_and_streamed(server, monkeypatch):
+    monkeypatch.setattr(srv, "INDEX_PAGE_SIZE", 2)
+    _upload(server, ("a.zip", b"1"), ("b.zip", b"2"), ("c.zip", b"3"))
+    ids = sorted(f["id"] for f in server.get("/api/files").get_json()["files"])
+
+    resp = server.get("/")
+    assert resp.is_streamed
+    page = resp.get_data(as_text=True)
+    assert "Stored files (3)" in page
+    assert "c.zip" in page and "b.zip" in page and "a.zip" not in page
+    assert f"/?after_id={ids[1]}" in page
+
+    page = server.get(f"/?after_id={ids[1]}").get_data(as_text=True)
+    assert "a.zip" in page and "b.zip" not in page
+    assert "after_id=" not in page
+
+
+def test_change_feed_replays_adds_and_deletes(server):
+    start = server.get("/api/files").get_json()["change_seq"]
+    _upload(server, ("a.zip", b"1"), ("b.zip", b"2"))
+    ids = sorted(f["id"] for f in server.get("/api/files").get_json()["files"])
+    server.post(f"/files/{ids[0]}/delete")
+    _upload(server, ("c.zip", b"3"))
+
+    feed = server.get(f"/api/files/changes?since={start}&limit=2").get_json()
+    assert feed["resync"] is False and feed["has_more"] is True
+    # The add of a file deleted since is dropped; its delete is kept
+    assert [(c["op"], c["id"]) for c in feed["changes"]] == [("add", ids[1])]
+    assert feed["changes"][0]["file"]["original_filename"] == "b.zip"
+
+    feed = server.get(f"/api/files/changes?since={feed['next_since']}").get_json()
+    assert [c["op"] for c in feed["changes"]] == ["delete", "add"]
+    assert feed["changes"][0]["id"] == ids[0]
+    assert feed["changes"][1]["file"]["original_filename"] == "c.zip"
+    assert feed["has_more"] is False
+    assert feed["next_since"] == server.get("/api/files").get_json()["change_seq"]
+
+    again = server.get(f"/api/files/changes?since={feed['next_since']}").get_json()
+    assert again["changes"] == [] and again["next_since"] == feed["next_since"]
+
+
+def test_change_feed_asks_for_resync_after_compaction(server):
+    _upload(server, *[(f"f{i}.zip", bytes([i])) for i in range(5)])
+    conn = srv.get_db()
+    assert srv.compact_change_log(conn, keep=2) == 3
+    conn.close()
+
+    feed = server.get("/api/files/changes?since=1").get_json()
+    assert feed["resync"] is True
+    listing = server.get("/api/files").get_json()
+    assert feed["next_since"] == listing["change_seq"]
+    feed = server.get(f"/api/files/changes?since={listing['change_seq'] - 2}").get_json()
+    assert feed["resync"] is False and len(feed["changes"]) == 2
+
+
+def test_change_log_starts_with_a_resync_for_existing_files(tmp_path, monkeypatch):
+    db = tmp_path / "uploads.db"
+    conn = sqlite3.connect(db)
+    conn.execute(srv.FILES_SCHEMA.format(name="files"))
+    conn.execute(
+        "INSERT INTO files (original_filename, stored_filename, size_bytes, sha256, uploaded_at) VALUES ('old.txt', 'x', 1, 'd', 'now')"
+    )
+    conn.commit()
+    conn.close()
+    monkeypatch.setattr(srv, "DATABASE_PATH", db)
+    monkeypatch.setattr(srv, "STAGING_DIR", tmp_path / "staging")
+    monkeypatch.setattr(srv, "BLOB_ROOT", tmp_path / "blobs")
+    srv.init_db()
+    client = srv.app.test_client()
+
+    feed = client.get("/api/files/changes?since=0").get_json()
+    assert feed["resync"] is True
+    assert client.get(f"/api/files/changes?since={feed['next_since']}").get_json()["resync"] is False
+
+
+def _sse(chunks, count):
+    """The first ``count`` non-comment events of a text/event-stream body."""
+    events = []
+    for chunk in chunks:
+        for block in chunk.decode().split("\n\n"):
+            fields = dict(line.split(": ", 1) for line in block.splitlines() if not line.startswith(":"))
+            if "event" in fields:
+                events.append((fields["event"], int(fields["id"]), json.loads(fields["data"])))
+        if len(events) >= count:
+            return events
+    return events
+
+
+def test_event_stream_replays_and_pushes_changes(server, monkeypatch):
+    monkeypatch.setattr(srv, "EVENTS_POLL_INTERVAL", 0.02)
+    monkeypatch.setattr(srv, "EVENTS_HEARTBEAT", 0.2)
+    start = server.get("/api/files").get_json()["change_seq"]
+    _upload(server, ("a.zip", b"1"))
+    file_id = server.get("/api/files").get_json()["files"][0]["id"]
+
+    resp = server.get("/api/events", headers={"Last-Event-ID": str(start)}, buffered=False)
+    assert resp.mimetype == "text/event-stream"
+    chunks = iter(resp.response)
+    assert next(chunks).startswith(b"retry: ")
+    [(name, seq, data)] = _sse(chunks, 1)
+    assert (name, data["file"]["original_filename"]) == ("upload", "a.zip")
+
+    server.post(f"/files/{file_id}/delete")
+    srv.compact_database()
+    events = _sse(chunks, 2)
+    assert [(e[0], e[2].get("id")) for e in events] == [("delete", file_id), ("compaction", None)]
+    assert events[0][1] > seq and events[1][1] == server.get("/api/files").get_json()["change_seq"]
+    resp.close()
+
+    # Resuming from the last id seen replays only what came after it
+    resp = server.get("/api/events?since=" + str(seq), buffered=False)
+    assert [e[0] for e in _sse(iter(resp.response), 2)] == ["delete", "compaction"]
+    resp.close()
+
+
+def _start_prefork(tmp_path, **options):
+    """A prefork server in a subprocess; returns (process, port) once it accepts."""
+    import socket
+    import subprocess
+    import sys
+
+    if not hasattr(os, "fork"):
+        pytest.skip("prefork mode needs fork()")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    options = {"workers": 1, "threads": 1, **options}
+    script = (
+        "import ServerFileuploader as s; s.EVENTS_POLL_INTERVAL = 0.05; "
+        f"s.start_server(host='127.0.0.1', port={port}, mode='prefork', "
+        + ", ".join(f"{k}={v!r}" for k, v in options.items()) + ")"
+    )
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    proc = subprocess.Popen([sys.executable, "-c", script], cwd=tmp_path, env=env)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=5).close()
+            break
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    return proc, port
+
+
+def test_prefork_event_stream_subscribers_hold_no_worker_thread(tmp_path):
+    import socket
+
+    proc, port = _start_prefork(tmp_path)
+    subscribers = []
+    try:
+        for _ in range(3):
+            sub = socket.create_connection(("127.0.0.1", port), timeout=5)
+            sub.sendall(b"GET /api/events HTTP/1.1\r\nHost: x\r\n\r\n")
+            head = b""
+            while b"retry: " not in head:
+                head += sub.recv(4096)
+            assert b"text/event-stream" in head and b"chunked" not in head
+            subscribers.append(sub)
+
+        # The only worker thread is free again, so uploads still get through
+        body = b"--b\r\nContent-Disposition: form-data; name=\"files\"; filename=\"push.txt\"\r\n\r\npush\r\n--b--\r\n"
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as conn:
+            conn.sendall(
+                b"POST /api/upload HTTP/1.1\r\nHost: x\r\nConnection: close\r\n"
+                b"Content-Type: multipart/form-data; boundary=b\r\n"
+                + f"Content-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            assert conn.recv(4096).startswith(b"HTTP/1.1 200")
+        for sub in subscribers:
+            received = b""
+            while b"push.txt" not in received:
+                received += sub.recv(4096)
+            assert b"event: upload" in received
+    finally:
+        for sub in subscribers:
+            sub.close()
+        proc.kill()
+        proc.wait()
+
+
+def test_prefork_mode_started_from_a_thread_serves_in_process(tmp_path):
+    import subprocess
+    import sys
+
+    script = """
+import http.client, socket, threading, time
+import ServerFileuploader as s
+with socket.socket() as probe:
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+threading.Thread(target=s.start_server, kwargs=dict(host="127.0.0.1", port=port, mode="prefork", threads=2), daemon=True).start()
+for _ in range(100):
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        conn.request("GET", "/api/files")
+        print(conn.getresponse().status)
+        conn.close()
+        break
+    except ConnectionRefusedError:
+        time.sleep(0.05)
+"""
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    done = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env, capture_output=True, text=True, timeout=60)
+    assert done.stdout.split() == ["200"], done.stderr
+
+
+def test_prefork_sends_unsized_bodies_unframed_to_http10_clients(tmp_path):
+    import socket
+
+    proc, port = _start_prefork(tmp_path)
+    try:
+        def fetch(version):
+            with socket.create_connection(("127.0.0.1", port), timeout=5) as conn:
+                conn.sendall(f"GET / {version}\r\nHost: x\r\nConnection: close\r\n\r\n".encode())
+                raw = b""
+                while True:
+                    data = conn.recv(65536)
+                    if not data:
+                        return raw
+                    raw += data
+
+        head, _, body = fetch("HTTP/1.0").partition(b"\r\n\r\n")
+        assert head.startswith(b"HTTP/1.1 200") and b"chunked" not in head.lower()
+        assert b"content-length" not in head.lower() and b"connection: close" in head.lower()
+        assert body.rstrip().endswith(b"</html>")
+        # HTTP/1.1 clients still get chunked framing
+        assert b"transfer-encoding: chunked" in fetch("HTTP/1.1").partition(b"\r\n\r\n")[0].lower()
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def test_prefork_event_stream_reads_through_http_client(tmp_path):
+    import http.client
+
+    proc, port = _start_prefork(tmp_path)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    try:
+        conn.request("GET", "/api/events")
+        resp = conn.getresponse()
+        assert resp.status == 200 and resp.getheader("Content-Length") is None
+        assert resp.getheader("Content-Type").startswith("text/event-stream")
+        assert resp.readline().startswith(b"retry: ")
+        upload = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        body = b"--b\r\nContent-Disposition: form-data; name=\"files\"; filename=\"push.txt\"\r\n\r\npush\r\n--b--\r\n"
+        upload.request("POST", "/api/upload", body, {"Content-Type": "multipart/form-data; boundary=b"})
+        assert upload.getresponse().status == 200
+        upload.close()
+        lines = []
+        while b"push.txt" not in b"".join(lines):
+            lines.append(resp.readline())
+        assert b"event: upload\n" in lines
+    finally:
+        conn.close()
+        proc.kill()
+        proc.wait()
+
+
+def test_storage_stats_follow_uploads_and_deletes(server):
+    _upload(server, ("a.txt", b"a" * 10), ("b.txt", b"b" * 20), ("c.zip", b"PK" * 50))
+    a_id = next(f["id"] for f in server.get("/api/files").get_json()["files"] if f["original_filename"] == "a.txt")
+    server.post(f"/files/{a_id}/delete")
+
+    stats = server.get("/api/stats").get_json()
+    assert (stats["files"], stats["bytes"]) == (2, 120)
+    assert stats["by_type"] == {"text/plain": {"files": 1, "bytes": 20}, "application/zip": {"files": 1, "bytes": 100}}
+    [(day, totals)] = stats["by_day"].items()
+    assert day == time.strftime("%Y-%m-%d", time.gmtime()) and totals == {"files": 2, "bytes": 120}
+    assert stats["quotas"] == {}
+
+    # A database from before the stats table gets them backfilled once
+    conn = srv.get_db()
+    conn.execute("DROP TABLE storage_stats")
+    conn.commit()
+    conn.close()
+    srv.init_db()
+    assert server.get("/api/stats").get_json() == stats
+
+
+def test_quotas_refuse_uploads_up_front(server, monkeypatch):
+    monkeypatch.setattr(srv, "STORAGE_QUOTA_BYTES", 1000)
+    monkeypatch.setattr(srv, "TYPE_QUOTA_BYTES", {"text/*": 100})
+
+    resp = _upload(server, ("huge.zip", b"z" * 2000))
+    assert resp.status_code == 507 and resp.get_json()["free_bytes"] == 1000
+
+    # Parts over a type quota are rejected one by one, counting the batch so far
+    data = _upload(server, ("a.txt", b"a" * 60), ("b.txt", b"b" * 60), ("c.zip", b"c" * 60)).get_json()
+    assert [f["filename"] for f in data["files"]] == ["a.txt", "c.zip"]
+    assert data["rejected"] == ["b.txt (text/* storage quota of 100 bytes exceeded)"]
+
+    # Open sessions reserve their full size
+    session = server.post("/api/uploads", json={"filename": "s.zip", "size": 800, "chunk_size": 800}).get_json()
+    resp = server.post("/api/uploads", json={"filename": "t.zip", "size": 100})
+    assert resp.status_code == 507 and "storage quota" in resp.get_json()["error"]
+    stats = server.get("/api/stats").get_json()
+    assert stats["quotas"]["*"] == {"limit_bytes": 1000, "used_bytes": 120, "reserved_bytes": 800}
+    assert stats["quotas"]["text/*"]["used_bytes"] == 60
+
+    server.put(f"/api/uploads/{session['session_id']}?offset=0", data=b"s" * 800)
+    assert server.post(f"/api/uploads/{session['session_id']}/complete").status_code == 200
+    assert server.get("/api/stats").get_json()["quotas"]["*"]["used_bytes"] == 920
+
+
+def test_session_complete_compresses_before_taking_the_write_lock(server, monkeypatch):
+    monkeypatch.setattr(srv, "STORAGE_QUOTA_BYTES", 10 * 1024 * 1024)
+    payload = b"a line of text\n" * 10000
+    sid = _create_session(server, payload, name="notes.txt", chunk_size=len(payload))["session_id"]
+    server.put(f"/api/uploads/{sid}?offset=0", data=payload)
+    compress_sink, lock_free = srv.compress_sink, []
+
+    def probing_compress(sink, codec):
+        other = sqlite3.connect(srv.DATABASE_PATH, timeout=0)
+        try:
+            other.execute("BEGIN IMMEDIATE")
+            other.rollback()
+            lock_free.append(True)
+        except sqlite3.OperationalError:
+            lock_free.append(False)
+        finally:
+            other.close()
+        compress_sink(sink, codec)
+
+    monkeypatch.setattr(srv, "compress_sink", probing_compress)
+    # Refused at the quota check: the session and its part file survive, the encoded copy does not
+    monkeypatch.setattr(srv, "STORAGE_QUOTA_BYTES", 1000)
+    assert server.post(f"/api/uploads/{sid}/complete").status_code == 507
+    assert srv._session_path(sid).exists() and not list(srv.STAGING_DIR.glob("encoded-*"))
+
+    monkeypatch.setattr(srv, "STORAGE_QUOTA_BYTES", 10 * 1024 * 1024)
+    done = server.post(f"/api/uploads/{sid}/complete").get_json()
+    assert lock_free == [True, True]
+    assert server.get(f"/files/{done['id']}/download").data == payload
+
+
+def test_cdc_backend_shares_chunks_between_versions(server, monkeypatch):
+    import random
+
+    monkeypatch.setattr(srv, "STORAGE_BACKEND", "cdc")
+    v1 = random.Random(7).randbytes(1024 * 1024)
+    v2 = v1[:500_000] + b"an edit in the middle" + v1[500_000:]
+    _upload(server, ("report.docx", v1))
+    # The second version arrives through a resumable session
+    session = server.post("/api/uploads", json={"filename": "report.docx", "size": len(v2), "chunk_size": len(v2)}).get_json()
+    server.put(f"/api/uploads/{session['session_id']}?offset=0", data=v2)
+    v2_id = server.post(f"/api/uploads/{session['session_id']}/complete").get_json()["id"]
+    v1_id = next(f["id"] for f in server.get("/api/files").get_json()["files"] if f["id"] != v2_id)
+
+    assert server.get(f"/files/{v1_id}/download").data == v1
+    assert server.get(f"/files/{v2_id}/download").data == v2
+    resp = server.get(f"/files/{v2_id}/download", headers={"Range": "bytes=499990-500030"})
+    assert resp.status_code == 206 and resp.data == v2[499990:500031]
+
+    report = server.get("/api/stats/dedup").get_json()
+    assert report["logical_bytes"] == report["cdc"]["referenced_bytes"] == len(v1) + len(v2)
+    # Only the chunk around the edit differs
+    assert report["cdc"]["chunk_bytes"] < len(v1) + 2 * srv.CDC_MAX_SIZE
+    assert report["dedup_ratio"] > 1.5
+
+    server.post(f"/files/{v1_id}/delete")
+    assert server.get(f"/files/{v2_id}/download").data == v2
+    server.post(f"/files/{v2_id}/delete")
+    conn = srv.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM cdc_chunks").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM cdc_manifests").fetchone()[0] == 0
+    conn.close()
+
+
+def test_pure_python_chunker_finds_content_defined_boundaries(monkeypatch):
+    import random
+
+    data = random.Random(3).randbytes(3 * 1024 * 1024)
+    native = srv.fastcdc_cy
+    monkeypatch.setattr(srv, "fastcdc_cy", None)
+    pieces = [data[i:i + 100_000] for i in range(0, len(data), 100_000)]
+    chunks = list(srv.cdc_split(pieces))
+    assert b"".join(chunks) == data
+    assert all(srv.CDC_MIN_SIZE <= len(c) <= srv.CDC_MAX_SIZE for c in chunks[:-1])
+
+    # Bytes in front shift the data, not the boundaries after the first cut
+    shifted = list(srv.cdc_split([b"prefix" + data]))
+    assert chunks[2:] == shifted[2:]
+
+    if native is not None:
+        monkeypatch.setattr(srv, "fastcdc_cy", native)
+        assert list(srv.cdc_split(pieces)) == chunks
+
+
+
+def test_cdc_store_needs_fastcdc_unless_pure_python_is_allowed(monkeypatch, capsys):
+    monkeypatch.setattr(srv, "STORAGE_BACKEND", "cdc")
+    monkeypatch.setattr(srv, "fastcdc_cy", None)
+    monkeypatch.setattr(srv, "CDC_PURE_PYTHON", False)
+    with pytest.raises(RuntimeError, match="fastcdc"):
+        srv.check_storage_backend()
+    with pytest.raises(RuntimeError, match="fastcdc"):
+        srv.start_server(mode="dev")
+
+    monkeypatch.setattr(srv, "CDC_PURE_PYTHON", True)
+    srv.check_storage_backend()
+    assert "WARNING" in capsys.readouterr().out
+
+def test_failed_batch_commit_leaves_no_orphaned_payloads(server, monkeypatch):
+    def busy(conn, rows):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(srv, "insert_file_rows", busy)
+    data = _upload(server, ("big.zip", b"z" * (srv.INLINE_MAX_BYTES + 1)), ("small.txt", b"s")).get_json()
+    assert data["saved"] == 0
+    assert sorted(f["filename"] for f in data["failed"]) == ["big.zip", "small.txt"]
+
+    conn = srv.get_db()
+    assert conn.execute("SELECT COUNT(*) FROM blobs").fetchone()[0] == 0
+    assert conn.execute("SELECT COUNT(*) FROM blob_chunks").fetchone()[0] == 0
+    conn.close()
+    assert not [p for p in srv.BLOB_ROOT.rglob("*") if p.is_file()]
+
+
+def test_pooled_server_answers_500_when_the_body_iterator_raises():
+    import http.client
+    import threading
+
+    def app(environ, start_response):
+        def body():
+            if environ["PATH_INFO"] == "/broken":
+                raise FileNotFoundError("payload vanished")
+            yield b"ok"
+
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return body()
+
+    server = srv.PooledWSGIServer("127.0.0.1", 0, app, threads=2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+        conn.request("GET", "/broken")
+        resp = conn.getresponse()
+        assert resp.status == 500 and resp.read() == b""
+        conn.close()
+        conn = http.client.HTTPConnection("127.0.0.1", server.server_port, timeout=5)
+        conn.request("GET", "/fine")
+        assert conn.getresponse().read() == b"ok"
+        conn.close()
+    finally:
+        server.drain()
+
+
+def test_new_event_subscriber_only_sees_what_comes_next(server, monkeypatch):
+    monkeypatch.setattr(srv, "EVENTS_POLL_INTERVAL", 0.02)
+    srv.event_hub()  # a hub that nobody listens to stops polling
+    _upload(server, *[(f"old{i}.zip", bytes([i])) for i in range(3)])
+
+    resp = server.get("/api/events", buffered=False)
+    chunks = iter(resp.response)
+    assert next(chunks).startswith(b"retry: ")
+    _upload(server, ("new.zip", b"n"))
+    [(name, seq, data)] = _sse(chunks, 1)
+    assert data["file"]["original_filename"] == "new.zip"
+    assert seq == server.get("/api/files").get_json()["change_seq"]
+    resp.close()
+
+
+def test_thread_held_event_streams_are_capped(server, monkeypatch):
+    monkeypatch.setitem(srv._thread_streams, "limit", 1)
+    first = server.get("/api/events", buffered=False)
+    assert first.status_code == 200
+    second = server.get("/api/events", buffered=False)
+    assert second.status_code == 503 and second.headers["Retry-After"]
+    first.close()
+    third = server.get("/api/events", buffered=False)
+    assert third.status_code == 200
+    third.close()
+    assert srv._thread_streams["open"] == 0
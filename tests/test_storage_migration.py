@@ -0,0 +1,95 @@
+import hashlib
+import io
+import sqlite3
+
+import pytest
+
+import ServerFileuploader as srv
+
+# Schema of uploads.db before payloads moved out of the files table
+LEGACY_SCHEMA = """
+    CREATE TABLE files (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        original_filename TEXT NOT NULL,
+        stored_filename TEXT NOT NULL,
+        content_type TEXT,
+        size_bytes INTEGER NOT NULL,
+        sha256 TEXT NOT NULL,
+        uploaded_at TEXT NOT NULL,
+        data BLOB NOT NULL
+    )
+"""
+
+
+@pytest.fixture
+def legacy_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(srv, "DATABASE_PATH", tmp_path / "legacy.db")
+    monkeypatch.setattr(srv, "STAGING_DIR", tmp_path / "staging")
+    monkeypatch.setattr(srv, "BLOB_ROOT", tmp_path / "blobs")
+    payloads = {
+        "small.txt": b"tiny",
+        "big.zip": b"z" * (srv.INLINE_MAX_BYTES * 2),
+        "copy.zip": b"z" * (srv.INLINE_MAX_BYTES * 2),
+        "gone.pdf": b"p" * 100,
+    }
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    conn.execute(LEGACY_SCHEMA)
+    for name, payload in payloads.items():
+        conn.execute(
+            "INSERT INTO files (original_filename, stored_filename, content_type, size_bytes, sha256, uploaded_at, data) "
+            "VALUES (?, ?, 'application/octet-stream', ?, ?, '2024-01-01T00:00:00Z', ?)",
+            (name, "x_" + name, len(payload), hashlib.sha256(payload).hexdigest(), payload),
+        )
+    # Highest id was deleted before the migration; it must never be reused
+    conn.execute("DELETE FROM files WHERE original_filename = 'gone.pdf'")
+    conn.commit()
+    conn.close()
+    srv.app.config["TESTING"] = True
+    srv.init_db()
+    del payloads["gone.pdf"]
+    return srv.app.test_client(), payloads
+
+
+def _downloads(client):
+    files = client.get("/api/files").get_json()["files"]
+    return {f["original_filename"]: client.get(f"/files/{f['id']}/download").data for f in files}
+
+
+def test_legacy_payloads_are_served_before_migration(legacy_db):
+    client, payloads = legacy_db
+    assert srv.storage_migration_pending()
+    assert _downloads(client) == payloads
+    # Existing rows are indexed for search when the index is first created
+    found = client.get("/api/files/search?q=big").get_json()["files"]
+    assert [f["original_filename"] for f in found] == ["big.zip"]
+
+
+def _upload(client, name, payload):
+    client.post("/api/upload", data={"files": [(io.BytesIO(payload), name)]}, content_type="multipart/form-data")
+
+
+def test_batched_migration_drops_data_columns(legacy_db):
+    client, payloads = legacy_db
+    # Writes keep working against the legacy schema while migration is pending
+    _upload(client, "during.txt", b"during")
+    payloads["during.txt"] = b"during"
+    assert srv.migrate_blobs(batch_rows=1) == 2
+    assert not srv.storage_migration_pending()
+
+    conn = sqlite3.connect(srv.DATABASE_PATH)
+    columns = [r[1] for r in conn.execute("PRAGMA table_info(files)")]
+    storage = dict(conn.execute("SELECT size_bytes, storage FROM blobs").fetchall())
+    conn.close()
+    assert "data" not in columns
+    assert storage == {4: "inline", 6: "inline", srv.INLINE_MAX_BYTES * 2: "fs"}
+    assert _downloads(client) == payloads
+
+    _upload(client, "after.txt", b"after")
+    assert max(f["id"] for f in client.get("/api/files").get_json()["files"]) == 6
+
+
+def test_deleting_legacy_holder_keeps_shared_payload(legacy_db):
+    client, payloads = legacy_db
+    files = {f["original_filename"]: f["id"] for f in client.get("/api/files").get_json()["files"]}
+    client.post(f"/files/{files['big.zip']}/delete")
+    assert client.get(f"/files/{files['copy.zip']}/download").data == payloads["copy.zip"]